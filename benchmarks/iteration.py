@@ -0,0 +1,265 @@
+"""
+Benchmark QuerySet iteration, iter_no_cache and iter_fetch_related.
+
+Usage: python benchmarks/iteration.py [--host mongodb://...] [--documents 10000]
+           [--width 20] [--batch-sizes 100,1000,5000] [--depths 1,2,3]
+           [--output results.json]
+
+Synthetic documents with --width string fields are created in throwaway
+collections of the --db database (the collections are dropped at the end),
+each referencing a chain of related documents --depths deep. The following
+cases are then run over all of them:
+
+- queryset: plain iteration over the QuerySet (which caches the documents)
+- iter_no_cache: at each of the --batch-sizes
+- fetch_related: iter_fetch_related at each of the --depths and --batch-sizes
+
+For each case, the throughput, the time to the first document, the longest
+wait between two documents (i.e. the cost of fetching a batch) and the peak
+memory allocated (measured with tracemalloc in a separate run, since it
+slows down the iteration) are reported as JSON, so that runs can be saved
+and compared.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import mongoengine
+import pymongo
+from mongoengine import Document, ReferenceField, StringField, connect
+
+from flask_common.mongo.utils import iter_fetch_related, iter_no_cache
+
+
+class BenchLevel3(Document):
+    name = StringField()
+
+
+class BenchLevel2(Document):
+    name = StringField()
+    parent = ReferenceField(BenchLevel3)
+
+
+class BenchLevel1(Document):
+    name = StringField()
+    parent = ReferenceField(BenchLevel2)
+
+
+RELATED_CLASSES = [BenchLevel1, BenchLevel2, BenchLevel3]
+
+MAX_DEPTH = len(RELATED_CLASSES)
+
+
+def make_item_class(width):
+    """Return a document class with the given number of string fields."""
+    attrs = {'field_%d' % i: StringField() for i in range(width)}
+    attrs['parent'] = ReferenceField(BenchLevel1)
+    attrs['meta'] = {'collection': 'bench_item'}
+    return type('BenchItem', (Document,), attrs)
+
+
+def get_field_dict(depth):
+    """Return the field_dict fetching the chain of parents depth levels deep."""
+    field_dict = True
+    for _ in range(depth - 1):
+        field_dict = {'parent': field_dict}
+    return {'parent': field_dict}
+
+
+def create_documents(item_class, count, width, related):
+    drop_collections(item_class)
+
+    # Create the related documents from the top of the chain down.
+    parents = [None]
+    for related_class in reversed(RELATED_CLASSES):
+        docs = [
+            related_class(name='%s %d' % (related_class.__name__, i))
+            for i in range(related)
+        ]
+        if 'parent' in related_class._fields:
+            for i, doc in enumerate(docs):
+                doc.parent = parents[i % len(parents)]
+        related_class.objects.insert(docs)
+        parents = list(related_class.objects.all())
+
+    value = 'x' * 20
+    for start in range(0, count, 1000):
+        item_class.objects.insert(
+            [
+                item_class(
+                    parent=parents[i % len(parents)],
+                    **{'field_%d' % f: value for f in range(width)}
+                )
+                for i in range(start, min(start + 1000, count))
+            ]
+        )
+
+
+def drop_collections(item_class):
+    item_class.drop_collection()
+    for related_class in RELATED_CLASSES:
+        related_class.drop_collection()
+
+
+def run_case(make_iter, depth):
+    """
+    Iterate over the documents returned by make_iter(), accessing a field of
+    each one and of its related documents, and return the number of
+    documents, the total time, the time to the first document and the
+    longest wait between two documents.
+    """
+    count = 0
+    first = None
+    max_wait = 0
+    start = last = time.monotonic()
+    for doc in make_iter():
+        obj = doc
+        for _ in range(depth):
+            obj = obj.parent
+        obj.name if depth else obj.field_0
+
+        now = time.monotonic()
+        if first is None:
+            first = now - start
+        max_wait = max(max_wait, now - last)
+        last = now
+        count += 1
+    return count, time.monotonic() - start, first or 0, max_wait
+
+
+def measure(make_iter, depth, repeat):
+    # warm up the connection pool and the server caches
+    run_case(make_iter, depth)
+
+    runs = [run_case(make_iter, depth) for _ in range(repeat)]
+    count = runs[0][0]
+    total = statistics.median(run[1] for run in runs)
+
+    tracemalloc.start()
+    try:
+        run_case(make_iter, depth)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'documents': count,
+        'median_ms': total * 1000,
+        'min_ms': min(run[1] for run in runs) * 1000,
+        'docs_per_sec': count / total if total else None,
+        'first_doc_ms': statistics.median(run[2] for run in runs) * 1000,
+        'max_wait_ms': statistics.median(run[3] for run in runs) * 1000,
+        'peak_memory_kb': peak / 1024,
+    }
+
+
+def get_cases(item_class, batch_sizes, depths):
+    """Yield (name, params, make_iter, depth) for each case to run."""
+    yield 'queryset', {}, lambda: item_class.objects.all(), 0
+
+    for batch_size in batch_sizes:
+        yield (
+            'iter_no_cache',
+            {'batch_size': batch_size},
+            lambda batch_size=batch_size: iter_no_cache(
+                item_class.objects.all().batch_size(batch_size)
+            ),
+            0,
+        )
+
+    for depth in depths:
+        for batch_size in batch_sizes:
+            yield (
+                'fetch_related',
+                {'batch_size': batch_size, 'depth': depth},
+                lambda batch_size=batch_size, depth=depth: iter_fetch_related(
+                    item_class.objects.all().batch_size(batch_size),
+                    get_field_dict(depth),
+                    batch_size=batch_size,
+                ),
+                depth,
+            )
+
+
+def parse_ints(value):
+    return [int(v) for v in value.split(',') if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+    )
+    parser.add_argument('--host', default='mongodb://localhost')
+    parser.add_argument('--db', default='flask_common_benchmarks')
+    parser.add_argument('--documents', type=int, default=10000)
+    parser.add_argument('--width', type=int, default=20)
+    parser.add_argument('--related', type=int, default=100)
+    parser.add_argument(
+        '--batch-sizes', type=parse_ints, default=[100, 1000, 5000]
+    )
+    parser.add_argument('--depths', type=parse_ints, default=[1, 2, 3])
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', help='file to write the JSON to')
+    args = parser.parse_args()
+
+    if args.width < 1:
+        parser.error('--width must be at least 1')
+    if any(depth < 1 or depth > MAX_DEPTH for depth in args.depths):
+        parser.error('--depths must be between 1 and %d' % MAX_DEPTH)
+
+    connect(args.db, host=args.host)
+    item_class = make_item_class(args.width)
+
+    try:
+        create_documents(item_class, args.documents, args.width, args.related)
+        results = []
+        for name, params, make_iter, depth in get_cases(
+            item_class, args.batch_sizes, args.depths
+        ):
+            result = {'case': name}
+            result.update(params)
+            result.update(measure(make_iter, depth, args.repeat))
+            results.append(result)
+            print(
+                '%-14s %-30s %10.0f docs/s'
+                % (
+                    name,
+                    ' '.join('%s=%s' % item for item in sorted(params.items())),
+                    result['docs_per_sec'] or 0,
+                ),
+                file=sys.stderr,
+            )
+    finally:
+        drop_collections(item_class)
+
+    output = {
+        'settings': {
+            'documents': args.documents,
+            'width': args.width,
+            'related': args.related,
+            'repeat': args.repeat,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'pymongo': pymongo.version,
+            'mongoengine': getattr(mongoengine, '__version__', None),
+            'time': int(time.time()),
+        },
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2, sort_keys=True)
+    else:
+        json.dump(output, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
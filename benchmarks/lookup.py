@@ -0,0 +1,118 @@
+"""
+Compare the batched queries of iter_fetch_related with the $lookup join mode.
+
+Usage: python benchmarks/lookup.py [--host mongodb://...] [--documents 1000]
+
+The documents and their related objects are created in throwaway
+collections of the --db database (the collections are dropped at the end),
+then both strategies are run over the same QuerySet a number of times and
+the median/min timings are printed. Point --host at a
+remote server to see the effect of the network latency.
+"""
+
+import argparse
+import statistics
+import time
+
+from mongoengine import Document, ReferenceField, StringField, connect
+
+from flask_common.mongo.utils import iter_fetch_related
+
+
+class BenchUser(Document):
+    name = StringField()
+    email = StringField()
+
+
+class BenchLead(Document):
+    name = StringField()
+    owner = ReferenceField(BenchUser)
+
+
+class BenchContact(Document):
+    name = StringField()
+    lead = ReferenceField(BenchLead)
+    owner = ReferenceField(BenchUser)
+
+
+FIELD_DICT = {'lead': True, 'owner': ['id', 'name']}
+
+
+def create_documents(count, users):
+    BenchUser.drop_collection()
+    BenchLead.drop_collection()
+    BenchContact.drop_collection()
+
+    user_docs = [BenchUser(name='user %d' % i) for i in range(users)]
+    BenchUser.objects.insert(user_docs)
+    user_docs = list(BenchUser.objects.all())
+
+    lead_docs = [
+        BenchLead(name='lead %d' % i, owner=user_docs[i % users])
+        for i in range(count)
+    ]
+    BenchLead.objects.insert(lead_docs)
+    lead_docs = list(BenchLead.objects.all())
+
+    BenchContact.objects.insert(
+        [
+            BenchContact(
+                name='contact %d' % i,
+                lead=lead_docs[i],
+                owner=user_docs[(i * 7) % users],
+            )
+            for i in range(count)
+        ]
+    )
+
+
+def run_strategy(lookup, batch_size):
+    qs = BenchContact.objects.order_by('name').batch_size(batch_size)
+    start = time.monotonic()
+    for contact in iter_fetch_related(qs, FIELD_DICT, lookup=lookup):
+        contact.lead.name
+        contact.owner.name
+    return time.monotonic() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--host', default='mongodb://localhost')
+    parser.add_argument('--db', default='flask_common_benchmarks')
+    parser.add_argument('--documents', type=int, default=1000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--repeat', type=int, default=10)
+    args = parser.parse_args()
+
+    connect(args.db, host=args.host)
+    create_documents(args.documents, args.users)
+
+    try:
+        print(
+            '%d contacts, %d users, batch size %d, %d runs'
+            % (args.documents, args.users, args.batch_size, args.repeat)
+        )
+        for name, lookup in (('batched queries', False), ('$lookup', True)):
+            # warm up the connection pool and the server caches
+            run_strategy(lookup, args.batch_size)
+            timings = [
+                run_strategy(lookup, args.batch_size)
+                for _ in range(args.repeat)
+            ]
+            print(
+                '%-16s median %8.1fms  min %8.1fms'
+                % (
+                    name,
+                    statistics.median(timings) * 1000,
+                    min(timings) * 1000,
+                )
+            )
+    finally:
+        BenchUser.drop_collection()
+        BenchLead.drop_collection()
+        BenchContact.drop_collection()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,7 @@ import uuid
 import sqlalchemy as db
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.declarative import declared_attr
-from sqlalchemy.orm import relationship, synonym
+from sqlalchemy.orm import object_session, relationship, synonym
 
 __all__ = [
     'MongoReference',
@@ -23,6 +23,10 @@ def MongoReference(field, ref_cls, queryset=None):
     To use a custom QuerySet (instead of the default `ref_cls.objects`),
     pass it as the `queryset` kwarg. You can also pass a function that
     resolves to a QuerySet.
+
+    When a flask_common.mongo.loader.BatchLoader is active, the references
+    of all the instances of the model in the object's session are fetched
+    with one query the first time one of them is accessed.
     """
 
     def _resolve_queryset():
@@ -31,14 +35,45 @@ def MongoReference(field, ref_cls, queryset=None):
         else:
             return queryset()
 
+    # the loader calls it to get the QuerySet, whether a QuerySet or a
+    # function was given
+    loader_queryset = None if queryset is None else _resolve_queryset
+
+    def _queue_session_refs(loader, obj):
+        session = object_session(obj)
+        if session is None:
+            return
+        for other in session.identity_map.values():
+            if type(other) is not type(obj):
+                continue
+            if hasattr(other, '_%s__cache' % field):
+                continue
+            # use __dict__ so that we don't refresh expired instances
+            other_id = other.__dict__.get(field)
+            if other_id is not None:
+                loader.queue(ref_cls, other_id, loader_queryset)
+
     def _get(obj):
-        qs = _resolve_queryset()
         if not hasattr(obj, '_%s__cache' % field):
+            # imported here so that mongoengine is only needed when Mongo
+            # references are used
+            from flask_common.mongo.loader import get_current_loader
+
             ref_id = getattr(obj, field)
+            loader = get_current_loader()
             if ref_id is None:
                 ref = None
+            elif loader is None:
+                ref = _resolve_queryset().get(pk=ref_id)
             else:
-                ref = qs.get(pk=ref_id)
+                if not loader.is_loaded(ref_cls, ref_id, loader_queryset):
+                    _queue_session_refs(loader, obj)
+                ref = loader.load(ref_cls, ref_id, loader_queryset)
+                if ref is None:
+                    raise ref_cls.DoesNotExist(
+                        '%s matching query does not exist.'
+                        % ref_cls._class_name
+                    )
             setattr(obj, '_%s__cache' % field, ref)
         return getattr(obj, '_%s__cache' % field)
 
@@ -0,0 +1,325 @@
+import asyncio
+import time
+from abc import ABCMeta, abstractmethod
+from collections import deque
+from functools import partial
+from itertools import islice
+
+from .utils import (
+    _check_forbidden_queries,
+    _FetchRelated,
+    _finish_report,
+    _get_find_kwargs,
+    _start_report,
+)
+
+
+class AsyncCollection(metaclass=ABCMeta):
+    """
+    Interface of a MongoDB collection used by the async helpers in this
+    module. Subclasses wrap a collection of a specific driver:
+
+    - MotorCollection wraps a collection of an async driver (Motor).
+    - ThreadPoolCollection wraps a sync pymongo collection and runs the
+      blocking calls in a thread pool. It doesn't need an async driver, so
+      it can be used with the regular mongoengine connection (e.g. in
+      tests).
+
+    Both methods take the same arguments as pymongo's Collection.find.
+    The async iterator returned by find_iter has an aclose() coroutine,
+    which kills the cursor on the server when the iteration stops early.
+
+    async_fetch_related builds its queries without the sync mongoengine
+    connection, so with a MotorCollection it doesn't need one, unless
+    filter_funcs are given (they usually build their QuerySets with
+    Document.objects, which opens the sync connection). async_iter_no_cache
+    takes a QuerySet, which is built through the sync connection.
+    """
+
+    @abstractmethod
+    async def find_all(self, filter, projection=None, **kwargs):
+        """Return a list of all the documents matching the query."""
+
+    @abstractmethod
+    def find_iter(self, filter, projection=None, **kwargs):
+        """Return an async iterator over the documents matching the query."""
+
+
+class MotorCollection(AsyncCollection):
+    """AsyncCollection wrapping a Motor (AsyncIOMotorCollection) collection."""
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    @classmethod
+    def factory(cls, database):
+        """
+        Return a function which returns the MotorCollection of a document
+        class in the given Motor database, to be passed as the
+        get_collection kwarg of the async helpers.
+        """
+        return lambda document_class: cls(
+            database[document_class._get_collection_name()]
+        )
+
+    async def find_all(self, filter, projection=None, **kwargs):
+        cursor = self.collection.find(filter, projection, **kwargs)
+        return await cursor.to_list(None)
+
+    def find_iter(self, filter, projection=None, **kwargs):
+        return _MotorCursor(self.collection.find(filter, projection, **kwargs))
+
+
+class _MotorCursor(object):
+    """Async iterator over a Motor cursor, which can be closed early."""
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        return await self.cursor.__anext__()
+
+    async def aclose(self):
+        await self.cursor.close()
+
+
+class ThreadPoolCollection(AsyncCollection):
+    """
+    AsyncCollection wrapping a sync pymongo collection. The blocking calls
+    are run in the given executor (defaults to the event loop's default
+    executor).
+    """
+
+    def __init__(self, collection, executor=None):
+        self.collection = collection
+        self.executor = executor
+
+    @classmethod
+    def factory(cls, executor=None):
+        """
+        Return a function which returns the ThreadPoolCollection of a
+        document class, to be passed as the get_collection kwarg of the
+        async helpers.
+        """
+        return lambda document_class: cls(
+            document_class._get_collection(), executor
+        )
+
+    def run(self, func, *args):
+        """Run the given blocking function in the executor."""
+        loop = asyncio.get_event_loop()
+        return loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def find_all(self, filter, projection=None, **kwargs):
+        return await self.run(
+            lambda: list(self.collection.find(filter, projection, **kwargs))
+        )
+
+    def find_iter(self, filter, projection=None, **kwargs):
+        return _ThreadPoolCursor(
+            self,
+            self.collection.find(filter, projection, **kwargs),
+            kwargs.get('batch_size') or 1000,
+        )
+
+
+class _ThreadPoolCursor(object):
+    """
+    Async iterator over a pymongo cursor. Documents are pulled from the
+    cursor in the executor of the ThreadPoolCollection, a batch at a time.
+    The cursor is closed if pulling a batch fails or is cancelled.
+    """
+
+    def __init__(self, collection, cursor, batch_size):
+        self.collection = collection
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.buffer = deque()
+        self.exhausted = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if not self.buffer and not self.exhausted:
+            fetch = self.collection.run(
+                lambda: list(islice(self.cursor, self.batch_size))
+            )
+            try:
+                batch = await asyncio.shield(fetch)
+            except BaseException:
+                # pymongo cursors aren't thread-safe, so let a cancelled
+                # fetch finish in its thread before closing the cursor
+                await asyncio.wait([fetch])
+                await self.aclose()
+                raise
+            self.buffer.extend(batch)
+            self.exhausted = len(batch) < self.batch_size
+        if not self.buffer:
+            raise StopAsyncIteration
+        return self.buffer.popleft()
+
+    async def aclose(self):
+        self.buffer.clear()
+        if not self.exhausted:
+            self.exhausted = True
+            await self.collection.run(self.cursor.close)
+
+
+class _AsyncDocumentIterator(object):
+    """
+    Async iterator hydrating the raw documents of a cursor, which closes the
+    cursor when used as an async context manager.
+    """
+
+    def __init__(self, cursor, document_class):
+        self.cursor = cursor
+        self.document_class = document_class
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        son = await self.cursor.__anext__()
+        return self.document_class._from_son(son)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, tb):
+        await self.aclose()
+
+    async def aclose(self):
+        """Close the cursor, e.g. when the iteration is stopped early."""
+        await self.cursor.aclose()
+
+
+def async_iter_no_cache(query_set, get_collection=None):
+    """Async counterpart of iter_no_cache. Sample usage:
+
+    async for lead in async_iter_no_cache(Lead.objects.filter(status=...)):
+        ...
+
+    The QuerySet is only used to build the query: its filter, loaded fields,
+    cursor options, hint, ordering, skip, limit and batch size (which
+    defaults to 1000, like in iter_no_cache) are sent to the AsyncCollection
+    returned by get_collection(document_class), and the raw documents are
+    hydrated with _from_son. get_collection defaults to
+    ThreadPoolCollection.factory(). ForbiddenQueriesQuerySets are checked
+    before the query is sent.
+
+    If the iteration may stop early (e.g. with a break or an exception),
+    use the iterator as an async context manager, so that the cursor is
+    closed rather than left open on the server until it times out:
+
+    async with async_iter_no_cache(Lead.objects.filter(...)) as leads:
+        async for lead in leads:
+            ...
+    """
+    if get_collection is None:
+        get_collection = ThreadPoolCollection.factory()
+
+    document_class = query_set._document
+    _check_forbidden_queries(query_set)
+    kwargs = _get_find_kwargs(query_set)
+    kwargs['batch_size'] = query_set._batch_size or 1000
+
+    projection = None
+    if query_set._loaded_fields:
+        projection = query_set._loaded_fields.as_dict()
+
+    cursor = get_collection(document_class).find_iter(
+        query_set._query, projection, **kwargs
+    )
+    return _AsyncDocumentIterator(cursor, document_class)
+
+
+class _AsyncFetchRelated(_FetchRelated):
+    """
+    _FetchRelated whose default QuerySets aren't bound to the sync
+    connection, since the queries are only sent through an AsyncCollection.
+    """
+
+    bind_collections = False
+
+
+async def async_fetch_related(
+    objs,
+    field_dict,
+    get_collection=None,
+    cache_map=None,
+    extra_filters=None,
+    batch_size=100,
+    filter_funcs=None,
+    as_dicts=False,
+    report=None,
+    shard_keys=None,
+    partial_cache_map=None,
+):
+    """Async counterpart of fetch_related. Sample usage:
+
+    await async_fetch_related(objs, {'user': True, 'lead': ['id', 'name']})
+
+    The arguments behave like in fetch_related (with an AdaptiveBatchSize,
+    only the time of the batches is measured). The batched queries are sent
+    to the AsyncCollection returned by get_collection(document_class)
+    (defaults to ThreadPoolCollection.factory()), and all the batches on the
+    same depth of the field_dict are issued concurrently with
+    asyncio.gather, so a prefetch takes one round trip per depth rather
+    than one per batch. Like with raw=True, the documents are hydrated with
+    _from_son.
+
+    filter_funcs and extra_filters are only used to build the queries, so
+    the filter functions must return QuerySets.
+    """
+    report, report_hook = _start_report(report, False)
+    start_time = time.monotonic()
+
+    if not objs:
+        return _finish_report(report, report_hook, start_time)
+
+    if get_collection is None:
+        get_collection = ThreadPoolCollection.factory()
+
+    fetcher = _AsyncFetchRelated(
+        objs,
+        field_dict,
+        cache_map=cache_map,
+        extra_filters=extra_filters,
+        batch_size=batch_size,
+        filter_funcs=filter_funcs,
+        raw=True,
+        as_dicts=as_dicts,
+        report=report,
+        shard_keys=shard_keys,
+        partial_cache_map=partial_cache_map,
+    )
+
+    async def fetch_batch(
+        document_class, fields_to_fetch, id_group, shard_filter
+    ):
+        start = time.monotonic()
+        _, query, projection = fetcher.get_planned_query(
+            document_class, fields_to_fetch, id_group, shard_filter
+        )
+        sons = await get_collection(document_class).find_all(
+            query, projection, batch_size=len(id_group)
+        )
+        batch_objs = fetcher.from_sons(document_class, sons)
+        elapsed = time.monotonic() - start
+        if fetcher.adaptive is not None:
+            # the BSON size isn't known here, so only the time is measured
+            fetcher.adaptive.record(document_class, len(sons), None, elapsed)
+        return batch_objs, elapsed
+
+    while fetcher.level:
+        batches = fetcher.plan_level()
+        results = await asyncio.gather(
+            *[fetch_batch(*batch) for batch in batches]
+        )
+        fetcher.finish_level(batches, results)
+
+    return _finish_report(report, report_hook, start_time)
@@ -0,0 +1,118 @@
+import threading
+
+from bson import BSON
+from bson.codec_options import CodecOptions
+from bson.raw_bson import RawBSONDocument
+
+from .lazy import LazySON
+
+
+class AdaptiveBatchSize(object):
+    """
+    Batch size which adapts to the size of the documents and the latency of
+    the queries, to be passed as the adaptive kwarg of iter_no_cache or as
+    the batch_size of fetch_related:
+
+    batch_size = AdaptiveBatchSize(target_bytes=1024 * 1024)
+    for lead in iter_no_cache(Lead.objects.all(), adaptive=batch_size):
+        ...
+
+    After every batch, the average BSON size and fetch time of a document are
+    measured, and the batch size is set to the number of documents that
+    fits both target_bytes and target_time. The size grows by at most
+    max_growth times per batch (so that a few fast batches don't make it
+    jump), shrinks right away, and stays within min_size and max_size.
+
+    Sizes are tracked separately by key (the document class), and the
+    instance can be reused across calls so that later calls start with a
+    tuned size. The current sizes are exposed in `sizes`, and the totals
+    measured for each key in `stats`, for tuning the targets.
+    """
+
+    def __init__(
+        self,
+        initial_size=100,
+        min_size=10,
+        max_size=10000,
+        target_bytes=2 * 1024 * 1024,
+        target_time=0.5,
+        max_growth=2,
+    ):
+        self.initial_size = initial_size
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_bytes = target_bytes
+        self.target_time = target_time
+        self.max_growth = max_growth
+
+        # Current batch size, by key
+        self.sizes = {}
+
+        # Batches, documents, bytes and time measured, by key
+        self.stats = {}
+
+        # Batches may be fetched concurrently by fetch_related
+        self._lock = threading.Lock()
+
+    def get_size(self, key=None):
+        """Return the current batch size for the given key."""
+        return self.sizes.get(key, self.initial_size)
+
+    def record(self, key, count, nbytes, elapsed):
+        """
+        Record a fetched batch of `count` documents, which took `elapsed`
+        seconds and `nbytes` bytes of BSON (None if unknown), and adjust the
+        batch size of the key accordingly.
+        """
+        if not count:
+            return
+
+        with self._lock:
+            stats = self.stats.setdefault(
+                key, {'batches': 0, 'documents': 0, 'bytes': 0, 'time': 0}
+            )
+            stats['batches'] += 1
+            stats['documents'] += count
+            stats['bytes'] += nbytes or 0
+            stats['time'] += elapsed
+
+            size = self.get_size(key)
+            candidates = [size * self.max_growth, self.max_size]
+            if nbytes:
+                candidates.append(self.target_bytes * count // nbytes)
+            if elapsed > 0:
+                candidates.append(int(self.target_time * count / elapsed))
+            self.sizes[key] = max(self.min_size, int(min(candidates)))
+
+
+_RAW_CODEC_OPTIONS = CodecOptions(document_class=RawBSONDocument)
+
+
+def raw_find(collection, query, projection=None, **kwargs):
+    """
+    Return a cursor over the given query which returns the documents as
+    RawBSONDocuments, so that their size can be measured or they can be
+    decoded lazily (see decode_raw).
+    """
+    raw_collection = collection.with_options(codec_options=_RAW_CODEC_OPTIONS)
+    return raw_collection.find(query, projection, **kwargs)
+
+
+def decode_raw(collection, raw_doc, lazy=False):
+    """
+    Decode a RawBSONDocument with the codec options of the collection, or
+    wrap it in a LazySON (which decodes the fields on access) if lazy.
+    """
+    if lazy:
+        return LazySON(raw_doc.raw, collection.codec_options)
+    return BSON(raw_doc.raw).decode(collection.codec_options)
+
+
+def set_cursor_batch_size(cursor, batch_size):
+    """
+    Change the batch size of the subsequent getMores of a pymongo cursor.
+
+    Cursor.batch_size can't be called once the query is sent, but the
+    getMores read the (private) batch size attribute every time.
+    """
+    cursor._Cursor__batch_size = batch_size
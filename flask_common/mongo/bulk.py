@@ -0,0 +1,207 @@
+import datetime
+import time
+from collections import OrderedDict, namedtuple
+
+from mongoengine import OperationError, ValidationError
+from mongoengine.queryset import transform
+from pymongo import DeleteOne, InsertOne, UpdateOne
+from pymongo.errors import BulkWriteError
+
+from .documents import DocumentBase, RandomPKDocument, SoftDeleteDocument
+
+BulkOperationError = namedtuple(
+    'BulkOperationError', ['document', 'operation', 'code', 'message']
+)
+
+
+class BulkWriterError(OperationError):
+    """
+    Raised when leaving a BulkWriter if some of its operations failed. The
+    failures are in `errors`, as a list of BulkOperationErrors.
+    """
+
+    def __init__(self, errors):
+        self.errors = errors
+        super(BulkWriterError, self).__init__(
+            '%d bulk write operation(s) failed, first error: %s'
+            % (len(errors), errors[0].message)
+        )
+
+
+class BulkWriter(object):
+    """
+    Context manager which buffers single-document writes and sends them as
+    unordered bulk_write calls, instead of doing a round trip per document.
+    Sample usage:
+
+    with BulkWriter(batch_size=1000) as writer:
+        for lead in iter_no_cache(Lead.objects.filter(status=None)):
+            writer.update(lead, set__status='active')
+
+    The buffered operations are flushed every batch_size operations, every
+    flush_interval seconds (checked when an operation is added), and when
+    leaving the block. If the block raises, the operations which are still
+    buffered are discarded and the exception is propagated. Since the
+    writes are unordered and deferred, the same document shouldn't be
+    written twice in a block if the order of the writes matters, and the
+    documents aren't reloaded after an update.
+
+    Like DocumentBase.update/modify/save, date_updated (and date_created
+    when inserting) is set on DocumentBase subclasses unless
+    update_date=False is passed. Like RandomPKDocument.save, an id is
+    generated when inserting a RandomPKDocument without one. Like
+    SoftDeleteDocument.delete, deleting a SoftDeleteDocument only sets its
+    is_deleted flag.
+
+    Operations that fail don't stop the other ones: their failures are
+    collected in `errors` (as BulkOperationErrors), and a BulkWriterError
+    is raised when leaving the block unless raise_errors is False. The
+    counts of the writes are in `stats`.
+    """
+
+    def __init__(self, batch_size=1000, flush_interval=None, raise_errors=True):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.raise_errors = raise_errors
+
+        # Failures of the flushed operations
+        self.errors = []
+
+        # Counts of the flushed operations
+        self.stats = {
+            'flushes': 0,
+            'inserted': 0,
+            'matched': 0,
+            'modified': 0,
+            'deleted': 0,
+            'upserted': 0,
+        }
+
+        # (document, operation) pairs to write, by collection
+        self._pending = OrderedDict()
+        self._pending_count = 0
+        self._last_flush = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # don't hide the exception raised in the block, if any, with one
+        # raised by the flush
+        if exc_type is not None:
+            self._pending = OrderedDict()
+            self._pending_count = 0
+            return
+
+        self.flush()
+        if self.errors and self.raise_errors:
+            raise BulkWriterError(self.errors)
+
+    def insert(self, document, update_date=True):
+        """Buffer the insertion of a new document."""
+        if isinstance(document, RandomPKDocument) and not document.id:
+            document.id = document._generate_pk()
+        if update_date and isinstance(document, DocumentBase):
+            now = datetime.datetime.utcnow()
+            if not document.date_created:
+                document.date_created = now
+            document.date_updated = now
+        document.validate()
+        self._add(document, InsertOne(document.to_mongo()))
+
+    def update(self, document, upsert=False, update_date=True, **kwargs):
+        """
+        Buffer an update of the given document, with the same kwargs as
+        Document.update (e.g. set__name='x', inc__count=1).
+        """
+        if not kwargs:
+            raise OperationError('No update parameters, would remove data')
+        if (
+            isinstance(document, SoftDeleteDocument)
+            and 'set__is_deleted' in kwargs
+            and kwargs['set__is_deleted'] is None
+        ):
+            raise ValidationError('is_deleted cannot be set to None')
+        if (
+            update_date
+            and isinstance(document, DocumentBase)
+            and 'set__date_updated' not in kwargs
+        ):
+            kwargs['set__date_updated'] = datetime.datetime.utcnow()
+        document_class = type(document)
+        self._add(
+            document,
+            UpdateOne(
+                transform.query(document_class, **document._object_key),
+                transform.update(document_class, **kwargs),
+                upsert=upsert,
+            ),
+        )
+
+    def delete(self, document):
+        """
+        Buffer the deletion of the given document, or the update of its
+        is_deleted flag if it's a SoftDeleteDocument.
+        """
+        if isinstance(document, SoftDeleteDocument):
+            # delete only if already saved, like SoftDeleteDocument.delete
+            if document.pk:
+                document.is_deleted = True
+                self.update(document, set__is_deleted=True)
+            return
+
+        self._add(
+            document,
+            DeleteOne(transform.query(type(document), **document._object_key)),
+        )
+
+    def _add(self, document, operation):
+        collection = document._get_collection()
+        self._pending.setdefault(collection.full_name, (collection, []))[
+            1
+        ].append((document, operation))
+        self._pending_count += 1
+
+        if self._pending_count >= self.batch_size or (
+            self.flush_interval is not None
+            and time.time() - self._last_flush >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Send all the buffered operations."""
+        pending = self._pending
+        self._pending = OrderedDict()
+        self._pending_count = 0
+        self._last_flush = time.time()
+
+        for collection, operations in pending.values():
+            self._write(collection, operations)
+
+    def _write(self, collection, operations):
+        try:
+            result = collection.bulk_write(
+                [operation for _, operation in operations], ordered=False
+            )
+            details = result.bulk_api_result
+        except BulkWriteError as exc:
+            details = exc.details
+            for error in details['writeErrors']:
+                document, operation = operations[error['index']]
+                self.errors.append(
+                    BulkOperationError(
+                        document, operation, error['code'], error['errmsg']
+                    )
+                )
+
+        self.stats['flushes'] += 1
+        self.stats['inserted'] += details['nInserted']
+        self.stats['matched'] += details['nMatched']
+        self.stats['modified'] += details['nModified']
+        self.stats['deleted'] += details['nRemoved']
+        self.stats['upserted'] += details['nUpserted']
+
+        # set the ids generated by pymongo on the inserted documents
+        for document, operation in operations:
+            if isinstance(operation, InsertOne) and document.pk is None:
+                document.pk = operation._doc['_id']
@@ -0,0 +1,495 @@
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Mapping, MutableMapping
+
+from bson import BSON
+
+
+def bson_size(obj):
+    """Approximate memory footprint of a document: the size of its BSON."""
+    son = getattr(obj, '_db_data', None)
+    if son is None:
+        son = obj.to_mongo()
+    return len(BSON.encode(son))
+
+
+class BoundedCacheMap(MutableMapping):
+    """
+    A bounded replacement for the cache_map dict passed into fetch_related.
+
+    It has the same { DocumentClass: { pk: obj } } interface as a plain dict,
+    but it doesn't grow without limit, so it can be shared across many
+    fetch_related calls in a long-running worker:
+
+    cache_map = BoundedCacheMap(max_entries=10000, ttl=300)
+    for batch in batches:
+        fetch_related(batch, {'user': True}, cache_map=cache_map)
+
+    - max_entries limits the number of cached objects per document class.
+      It's either an int applied to every class, or a dict in the form of
+      {document_class: max_entries} (classes missing from it are unlimited).
+    - max_bytes is an approximate memory budget for all the cached objects
+      (as measured by the sizeof function, which defaults to bson_size).
+    - ttl is the number of seconds after which a cached object expires.
+
+    When a limit is exceeded, the least recently used objects are evicted
+    (per document class for max_entries, across all classes for max_bytes).
+
+    Each document class' cache counts its hits, misses and evictions, e.g.
+    cache_map[User].hits. The totals are available on the cache map itself.
+    """
+
+    def __init__(
+        self,
+        max_entries=None,
+        max_bytes=None,
+        ttl=None,
+        sizeof=bson_size,
+        clock=time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.sizeof = sizeof
+        self.clock = clock
+
+        # approximate size of all the cached objects, in bytes
+        self.size = 0
+
+        # The lock is reentrant since evicting from one class cache can be
+        # triggered while inserting into another one.
+        self.lock = threading.RLock()
+
+        self._class_caches = {}
+
+        # monotonically increasing counter used to find the least recently
+        # used object across all the document classes
+        self._tick = 0
+
+    def __getitem__(self, document_class):
+        return self._class_caches[document_class]
+
+    def __setitem__(self, document_class, value):
+        with self.lock:
+            if document_class in self._class_caches:
+                del self[document_class]
+            class_cache = DocumentClassCache(self, document_class)
+            self._class_caches[document_class] = class_cache
+            class_cache.update(value)
+
+    def setdefault(self, document_class, default=None):
+        """
+        Return the cache of the document class, creating it (filled with
+        default) if it doesn't exist. Unlike checking for the class and then
+        setting it, this is atomic, so threads sharing the cache map can't
+        replace a class cache that another thread just filled.
+        """
+        with self.lock:
+            if document_class not in self._class_caches:
+                self[document_class] = {} if default is None else default
+            return self._class_caches[document_class]
+
+    def __delitem__(self, document_class):
+        with self.lock:
+            self._class_caches[document_class].clear()
+            del self._class_caches[document_class]
+
+    def __iter__(self):
+        return iter(list(self._class_caches))
+
+    def __len__(self):
+        return len(self._class_caches)
+
+    @property
+    def hits(self):
+        return sum(cache.hits for cache in self._class_caches.values())
+
+    @property
+    def misses(self):
+        return sum(cache.misses for cache in self._class_caches.values())
+
+    @property
+    def evictions(self):
+        return sum(cache.evictions for cache in self._class_caches.values())
+
+    def get_max_entries(self, document_class):
+        if isinstance(self.max_entries, dict):
+            return self.max_entries.get(document_class)
+        return self.max_entries
+
+    def _next_tick(self):
+        self._tick += 1
+        return self._tick
+
+    def _evict(self, class_cache):
+        """Evict objects until all the limits are respected again."""
+        max_entries = self.get_max_entries(class_cache.document_class)
+        if max_entries is not None:
+            while len(class_cache._entries) > max_entries:
+                class_cache._evict_lru()
+
+        if self.max_bytes is not None:
+            while self.size > self.max_bytes:
+                lru_caches = [
+                    cache
+                    for cache in self._class_caches.values()
+                    if cache._entries
+                ]
+                if not lru_caches:
+                    break
+                min(
+                    lru_caches, key=lambda cache: cache._lru_tick()
+                )._evict_lru()
+
+
+class DocumentClassCache(MutableMapping):
+    """
+    LRU cache of { pk: obj } for a single document class of a
+    BoundedCacheMap.
+    """
+
+    def __init__(self, cache_map, document_class):
+        self.cache_map = cache_map
+        self.document_class = document_class
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # pk -> (obj, size, expires_at, tick), least recently used first
+        self._entries = OrderedDict()
+
+    def __getitem__(self, pk):
+        with self.cache_map.lock:
+            entry = self._get_entry(pk)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(pk)
+            self.hits += 1
+            obj, size, expires_at, tick = entry
+            self._entries[pk] = (
+                obj,
+                size,
+                expires_at,
+                self.cache_map._next_tick(),
+            )
+            self._entries.move_to_end(pk)
+            return obj
+
+    def __contains__(self, pk):
+        with self.cache_map.lock:
+            return self._get_entry(pk) is not None
+
+    def __setitem__(self, pk, obj):
+        cache_map = self.cache_map
+        with cache_map.lock:
+            if pk in self._entries:
+                self._remove(pk)
+            size = cache_map.sizeof(obj) if cache_map.max_bytes else 0
+            expires_at = (
+                cache_map.clock() + cache_map.ttl
+                if cache_map.ttl is not None
+                else None
+            )
+            self._entries[pk] = (
+                obj,
+                size,
+                expires_at,
+                cache_map._next_tick(),
+            )
+            cache_map.size += size
+            cache_map._evict(self)
+
+    def __delitem__(self, pk):
+        with self.cache_map.lock:
+            if self._get_entry(pk) is None:
+                raise KeyError(pk)
+            self._remove(pk)
+
+    def __iter__(self):
+        with self.cache_map.lock:
+            self._remove_expired()
+            return iter(list(self._entries))
+
+    def __len__(self):
+        with self.cache_map.lock:
+            self._remove_expired()
+            return len(self._entries)
+
+    def __repr__(self):
+        return '<%s: %s (%d objects)>' % (
+            self.__class__.__name__,
+            self.document_class.__name__,
+            len(self._entries),
+        )
+
+    def _get_entry(self, pk):
+        """Return the entry for the given pk, unless it's missing/expired."""
+        entry = self._entries.get(pk)
+        if entry is not None and self._is_expired(entry):
+            self._remove(pk)
+            return None
+        return entry
+
+    def _is_expired(self, entry):
+        expires_at = entry[2]
+        return expires_at is not None and expires_at <= self.cache_map.clock()
+
+    def _remove(self, pk):
+        obj, size, expires_at, tick = self._entries.pop(pk)
+        self.cache_map.size -= size
+
+    def _remove_expired(self):
+        if self.cache_map.ttl is None:
+            return
+        for pk, entry in list(self._entries.items()):
+            if self._is_expired(entry):
+                self._remove(pk)
+
+    def _lru_tick(self):
+        return next(iter(self._entries.values()))[3]
+
+    def _evict_lru(self):
+        self._remove(next(iter(self._entries)))
+        self.evictions += 1
+
+
+class UnloadedFieldError(Exception):
+    """Raised on access to a field that wasn't loaded on a PartialDocument."""
+
+
+class PartialDocument(object):
+    """
+    Proxy of a partially fetched document, which raises UnloadedFieldError
+    on access to the fields that weren't loaded (rather than returning None
+    like the document does). Everything else is passed through to the
+    document.
+    """
+
+    __slots__ = ('_document', '_loaded_fields')
+
+    def __init__(self, document, loaded_fields):
+        object.__setattr__(self, '_document', document)
+        object.__setattr__(self, '_loaded_fields', frozenset(loaded_fields))
+
+    # make isinstance checks against the document class pass
+    @property
+    def __class__(self):
+        return self._document.__class__
+
+    def _check_field(self, name):
+        if name in self._document._fields and name not in self._loaded_fields:
+            raise UnloadedFieldError(
+                'Field %s of %s was not loaded (only %s were fetched)'
+                % (
+                    name,
+                    self._document.__class__.__name__,
+                    ', '.join(sorted(self._loaded_fields)),
+                )
+            )
+
+    def __getattr__(self, name):
+        self._check_field(name)
+        return getattr(self._document, name)
+
+    def __setattr__(self, name, value):
+        self._check_field(name)
+        setattr(self._document, name, value)
+
+    def __eq__(self, other):
+        if isinstance(other, PartialDocument):
+            other = other._document
+        return self._document == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._document)
+
+    def __repr__(self):
+        return '<PartialDocument: %r>' % (self._document,)
+
+
+class PartialCacheMap(object):
+    """
+    Cache of partially fetched objects (i.e. ones fetched with a list of
+    fields to fetch) which can be shared across fetch_related calls, e.g.
+    for the duration of a request:
+
+    partial_cache_map = PartialCacheMap()
+    fetch_related(contacts, {'lead': ['id', 'name']},
+                  partial_cache_map=partial_cache_map)
+    ...
+    # doesn't query the leads again
+    fetch_related(opportunities, {'lead': ['name']},
+                  partial_cache_map=partial_cache_map)
+
+    Each cached object records the fields it was fetched with, and it's
+    only used for requests of a subset of those fields. The cached objects
+    are wrapped in a PartialDocument (unless strict is False), so that
+    accessing a field which wasn't loaded raises an UnloadedFieldError
+    instead of silently returning None.
+    """
+
+    def __init__(self, strict=True):
+        self.strict = strict
+
+        # { document_class: { pk: [(fetched fields, obj), ...] } }
+        self._class_caches = {}
+
+    def add(self, document_class, fields, objs):
+        """
+        Cache the given {pk: obj} dict of objects of the document class
+        fetched with the given frozenset of fields. Objects of the same pk
+        fetched with a subset of the fields are replaced.
+        """
+        if self.strict:
+            # the pk is always loaded and so is the whole top-level field
+            # of any embedded fields
+            loaded_fields = {document_class._meta['id_field']}
+            loaded_fields.update(field.split('.', 1)[0] for field in fields)
+
+        class_cache = self._class_caches.setdefault(document_class, {})
+        for pk, obj in objs.items():
+            if self.strict and not isinstance(obj, PartialDocument):
+                obj = PartialDocument(obj, loaded_fields)
+            entries = [
+                (entry_fields, entry_obj)
+                for entry_fields, entry_obj in class_cache.get(pk, ())
+                if not entry_fields <= fields
+            ]
+            entries.append((fields, obj))
+            class_cache[pk] = entries
+
+    def get_objs(self, document_class, fields):
+        """
+        Return a {pk: obj} mapping of the cached objects of the document
+        class fetched with (at least) the given frozenset of fields.
+        """
+        return _PartialObjs(self._class_caches.get(document_class, {}), fields)
+
+    def clear(self):
+        self._class_caches.clear()
+
+
+class _PartialObjs(Mapping):
+    """Read-only view of a PartialCacheMap for a set of fields."""
+
+    def __init__(self, class_cache, fields):
+        self.class_cache = class_cache
+        self.fields = fields
+
+    def __getitem__(self, pk):
+        for entry_fields, obj in self.class_cache.get(pk, ()):
+            if entry_fields >= self.fields:
+                return obj
+        raise KeyError(pk)
+
+    def __iter__(self):
+        return (pk for pk in list(self.class_cache) if pk in self)
+
+    def __len__(self):
+        return sum(1 for pk in self)
+
+
+class InFlightTimeoutError(Exception):
+    """
+    Raised when waiting for an object which is being fetched by another
+    thread takes longer than the SingleFlight's timeout.
+    """
+
+
+class SingleFlight(object):
+    """
+    Registry of the objects being fetched, to be shared by the threads which
+    share a cache_map and passed as the single_flight kwarg of
+    fetch_related:
+
+    cache_map = BoundedCacheMap(max_entries=10000, ttl=300)
+    single_flight = SingleFlight(timeout=10)
+    ...
+    fetch_related(
+        objs, {'user': True}, cache_map=cache_map, single_flight=single_flight
+    )
+
+    If an object is requested while another thread is already fetching it,
+    the caller waits for that thread's result rather than querying it again.
+    Errors are propagated: if the query of the fetching thread fails, the
+    waiting threads get the same exception. If the result doesn't come in
+    `timeout` seconds, InFlightTimeoutError is raised.
+    """
+
+    def __init__(self, timeout=10):
+        self.timeout = timeout
+        self.lock = threading.Lock()
+
+        # _Flight of each object being fetched, by document class and pk
+        self._flights = {}
+
+    def claim(self, document_class, pks):
+        """
+        Claim the fetching of the given pks. Returns a tuple of the list of
+        pks the caller has to fetch (and then resolve or fail), and a dict
+        of {pk: flight} for the pks already being fetched by another thread.
+        """
+        claimed = []
+        in_flight = {}
+        with self.lock:
+            flights = self._flights.setdefault(document_class, {})
+            for pk in pks:
+                flight = flights.get(pk)
+                if flight is None:
+                    flights[pk] = _Flight()
+                    claimed.append(pk)
+                else:
+                    in_flight[pk] = flight
+        return claimed, in_flight
+
+    def resolve(self, document_class, pks, pk_to_obj):
+        """
+        Publish the objects fetched for the claimed pks (pks missing from
+        pk_to_obj resolve to None).
+        """
+        for pk, flight in self._pop_flights(document_class, pks):
+            flight.resolve(pk_to_obj.get(pk))
+
+    def fail(self, document_class, pks, exc):
+        """Propagate the error of the fetch of the claimed pks."""
+        for pk, flight in self._pop_flights(document_class, pks):
+            flight.fail(exc)
+
+    def wait(self, flight):
+        """
+        Wait for the result of a flight returned by claim, and return the
+        fetched object (or None if it doesn't exist).
+        """
+        if not flight.event.wait(self.timeout):
+            raise InFlightTimeoutError(
+                'Timed out waiting %ss for an in-flight fetch' % self.timeout
+            )
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def _pop_flights(self, document_class, pks):
+        with self.lock:
+            flights = self._flights.get(document_class, {})
+            return [(pk, flights.pop(pk)) for pk in pks if pk in flights]
+
+
+class _Flight(object):
+    __slots__ = ('event', 'result', 'error')
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+    def resolve(self, result):
+        self.result = result
+        self.event.set()
+
+    def fail(self, error):
+        self.error = error
+        self.event.set()
@@ -0,0 +1,162 @@
+from collections import OrderedDict, namedtuple
+from itertools import islice
+
+import numpy as np
+from mongoengine import (
+    BooleanField,
+    DateTimeField,
+    FloatField,
+    IntField,
+    LongField,
+)
+
+from .utils import (
+    _check_forbidden_queries,
+    _get_collection,
+    _get_find_kwargs,
+)
+
+Categorical = namedtuple('Categorical', ['codes', 'categories'])
+
+
+def export_columns(
+    query_set, fields, categorical=(), batch_size=None, size_hint=None
+):
+    """
+    Export the given fields of the QuerySet's documents into NumPy arrays,
+    without building any Document. Sample usage:
+
+    columns = export_columns(
+        Opportunity.objects.filter(organization=org),
+        ['value', 'date_won', 'status'],
+        categorical=['status'],
+    )
+    won = columns['status'].categories.tolist().index('won')
+    total = columns['value'][columns['status'].codes == won].sum()
+
+    Returns an OrderedDict of columns by field name. The documents are
+    fetched in batches of batch_size (by default the batch size of the
+    QuerySet, or 1000) with only the exported fields, and each batch is
+    copied into arrays which are preallocated for size_hint documents and
+    grow as needed, so the memory used is about the size of the arrays.
+
+    The dtype of a column depends on the field:
+    - IntField and LongField: int64, or float64 (with NaN for the missing
+      values) if any value is missing
+    - BooleanField: bool, or float64 if any value is missing
+    - FloatField: float64, with NaN for the missing values
+    - DateTimeField: datetime64[ms], with NaT for the missing values
+    - fields listed in categorical: a Categorical of int32 codes (-1 for
+      the missing values) and an object array of the distinct values, which
+      must be hashable (e.g. not lists)
+    - any other field: object, with the values as stored in MongoDB (e.g.
+      ObjectIds for references)
+
+    Only top level fields are supported.
+    """
+    document_class = query_set._document
+    columns = [
+        _Column(document_class, name, name in categorical) for name in fields
+    ]
+
+    if batch_size is None:
+        batch_size = query_set._batch_size or 1000
+    _check_forbidden_queries(query_set)
+    cursor = _get_collection(query_set).find(
+        query_set._query,
+        {column.db_field: True for column in columns},
+        batch_size=batch_size,
+        **_get_find_kwargs(query_set)
+    )
+
+    for column in columns:
+        column.allocate(size_hint or batch_size)
+
+    size = 0
+    try:
+        while True:
+            sons = list(islice(cursor, batch_size))
+            for column in columns:
+                column.extend(size, [son.get(column.db_field) for son in sons])
+            size += len(sons)
+            if len(sons) < batch_size:
+                break
+    finally:
+        cursor.close()
+
+    return OrderedDict((column.name, column.finish(size)) for column in columns)
+
+
+class _Column(object):
+    """Growable array of the values of a field."""
+
+    def __init__(self, document_class, name, categorical):
+        field_name = name
+        if field_name == 'pk':
+            field_name = document_class._meta['id_field']
+        if field_name not in document_class._fields:
+            raise ValueError('Cannot export %s' % name)
+        field = document_class._fields[field_name]
+
+        self.name = name
+        self.db_field = field.db_field
+        self.array = None
+
+        # distinct values of a categorical column, mapped to their codes
+        self.categories = OrderedDict() if categorical else None
+
+        if categorical:
+            self.dtype = np.int32
+        elif isinstance(field, BooleanField):
+            self.dtype = np.bool_
+        elif isinstance(field, DateTimeField):
+            self.dtype = np.dtype('datetime64[ms]')
+        elif isinstance(field, FloatField):
+            self.dtype = np.float64
+        elif isinstance(field, (IntField, LongField)):
+            self.dtype = np.int64
+        else:
+            self.dtype = object
+
+    def allocate(self, capacity):
+        self.array = np.empty(capacity, dtype=self.dtype)
+
+    def extend(self, start, values):
+        end = start + len(values)
+        if end > len(self.array):
+            self.array.resize(max(end, 2 * len(self.array)), refcheck=False)
+
+        if self.categories is not None:
+            values = [self._get_code(value) for value in values]
+        elif self.array.dtype.kind in 'bi' and any(
+            value is None for value in values
+        ):
+            # ints and bools can't be missing, so fall back to floats
+            self.array = self.array.astype(np.float64)
+
+        if self.array.dtype == object:
+            # assign one by one so that lists and dicts are kept as values
+            for i, value in enumerate(values, start):
+                self.array[i] = value
+        else:
+            self.array[start:end] = np.array(values, dtype=self.array.dtype)
+
+    def _get_code(self, value):
+        if value is None:
+            return -1
+        try:
+            return self.categories.setdefault(value, len(self.categories))
+        except TypeError:
+            raise ValueError(
+                'Cannot export %s as categorical: %r is not hashable'
+                % (self.name, value)
+            )
+
+    def finish(self, size):
+        self.array.resize(size, refcheck=False)
+        if self.categories is not None:
+            categories = np.empty(len(self.categories), dtype=object)
+            for i, value in enumerate(self.categories):
+                categories[i] = value
+            return Categorical(self.array, categories)
+        return self.array
@@ -0,0 +1,141 @@
+import struct
+from collections import OrderedDict
+from collections.abc import MutableMapping
+
+from bson import BSON
+from bson.codec_options import DEFAULT_CODEC_OPTIONS
+from bson.errors import InvalidBSON
+
+
+class LazySON(MutableMapping):
+    """
+    Mapping over a raw BSON document which only decodes a top-level field
+    when it's first accessed, and caches the decoded value.
+
+    Documents hydrated with a LazySON as their son (see the lazy kwarg of
+    iter_no_cache and fetch_related) keep it as their _db_data, and since
+    the fields are only converted with to_python when they're accessed,
+    neither the BSON decoding nor the conversion is done for the fields
+    that are never read. That's a big saving on wide documents with
+    expensive fields (e.g. encrypted or phone fields), when only a few of
+    them are used.
+
+    Finding a field scans the names and sizes of the elements once (without
+    decoding their values), then each field is decoded on its own with the
+    C decoder of bson.
+    """
+
+    __slots__ = ('_raw', '_codec_options', '_offsets', '_values')
+
+    def __init__(self, raw, codec_options=DEFAULT_CODEC_OPTIONS):
+        self._raw = raw
+        self._codec_options = codec_options
+
+        # (start, end) of each element in the raw document by name (None
+        # for the keys that were assigned), built on first access
+        self._offsets = None
+
+        # decoded (or assigned) values by name
+        self._values = {}
+
+    @property
+    def raw(self):
+        return self._raw
+
+    def _get_offsets(self):
+        if self._offsets is None:
+            self._offsets = _index_elements(self._raw)
+        return self._offsets
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        start, end = self._get_offsets()[key]
+        value = _decode_element(self._raw, start, end, self._codec_options)
+        self._values[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._get_offsets().setdefault(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key):
+        del self._get_offsets()[key]
+        self._values.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self._get_offsets()
+
+    def __iter__(self):
+        return iter(list(self._get_offsets()))
+
+    def __len__(self):
+        return len(self._get_offsets())
+
+    def __repr__(self):
+        return 'LazySON(%r)' % dict(self)
+
+
+def _read_int32(raw, pos):
+    return struct.unpack_from('<i', raw, pos)[0]
+
+
+# Size of the values of the fixed size BSON types, by type byte
+_FIXED_SIZES = {
+    0x01: 8,  # double
+    0x06: 0,  # undefined
+    0x07: 12,  # ObjectId
+    0x08: 1,  # boolean
+    0x09: 8,  # datetime
+    0x0A: 0,  # null
+    0x10: 4,  # int32
+    0x11: 8,  # timestamp
+    0x12: 8,  # int64
+    0x13: 16,  # decimal128
+    0x7F: 0,  # max key
+    0xFF: 0,  # min key
+}
+
+
+def _get_value_size(raw, element_type, pos):
+    size = _FIXED_SIZES.get(element_type)
+    if size is not None:
+        return size
+    if element_type in (0x02, 0x0D, 0x0E):  # string, code, symbol
+        return 4 + _read_int32(raw, pos)
+    if element_type in (0x03, 0x04, 0x0F):  # document, array, code w/ scope
+        return _read_int32(raw, pos)
+    if element_type == 0x05:  # binary (length, subtype, data)
+        return 5 + _read_int32(raw, pos)
+    if element_type == 0x0B:  # regex (pattern and options cstrings)
+        pattern_end = raw.index(b'\x00', pos)
+        return raw.index(b'\x00', pattern_end + 1) + 1 - pos
+    if element_type == 0x0C:  # DBPointer (string and ObjectId)
+        return 4 + _read_int32(raw, pos) + 12
+    raise InvalidBSON('Unknown BSON element type %r' % element_type)
+
+
+def _index_elements(raw):
+    """Return the (start, end) of each element of a raw document by name."""
+    offsets = OrderedDict()
+    pos = 4
+    end_of_document = len(raw) - 1
+    while pos < end_of_document:
+        element_type = raw[pos]
+        name_end = raw.index(b'\x00', pos + 1)
+        name = raw[pos + 1 : name_end].decode('utf-8')
+        end = name_end + 1 + _get_value_size(raw, element_type, name_end + 1)
+        offsets[name] = (pos, end)
+        pos = end
+    return offsets
+
+
+def _decode_element(raw, start, end, codec_options):
+    """Decode a single element by wrapping it in a document of its own."""
+    element = raw[start:end]
+    son = BSON(struct.pack('<i', len(element) + 5) + element + b'\x00').decode(
+        codec_options
+    )
+    return next(iter(son.values()))
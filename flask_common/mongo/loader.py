@@ -0,0 +1,212 @@
+import threading
+
+from flask_common.utils import grouper
+from mongoengine import ListField, ReferenceField, SafeReferenceField
+
+from .utils import _id_from_value, _setattr_unchanged
+
+_local = threading.local()
+
+
+def get_current_loader():
+    """Return the innermost active BatchLoader of this thread, if any."""
+    stack = getattr(_local, 'stack', None)
+    return stack[-1] if stack else None
+
+
+class BatchLoader(object):
+    """
+    Request-scoped loader which batches single-document dereferences, e.g.:
+
+    with BatchLoader():
+        contacts = list(Contact.objects.filter(...))
+        for contact in contacts:
+            print(contact.lead.name)
+
+    Dereferences requested while the loader is active are queued and
+    deduplicated per document class, and the first time a value is needed,
+    all the queued IDs of its class are fetched with one $in query (per
+    batch_size IDs). Fetched documents are kept for the lifetime of the
+    loader, so the same document is never fetched twice in a scope.
+
+    Documents using the BatchLoaderMixin queue their references when
+    they're loaded and dereference them through the loader, and so do
+    flask_common.db.MongoReference fields (for the other instances in the
+    same SQLAlchemy session). The loader can also be used directly:
+
+    loader.queue(User, user_id)
+    ...
+    user = loader.load(User, user_id)
+
+    A loader is usually activated for the duration of a request, e.g. in a
+    before_request/teardown_request pair, or with a with block as above.
+    Loaders are thread-local and can be nested.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+
+        # IDs to fetch with the next query, by (document_class, queryset)
+        self._queued = {}
+
+        # Fetched documents (or None for missing ones) by
+        # (document_class, queryset) and pk
+        self._loaded = {}
+
+    def __enter__(self):
+        if not hasattr(_local, 'stack'):
+            _local.stack = []
+        _local.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        _local.stack.remove(self)
+
+    def queue(self, document_class, pk, queryset=None):
+        """
+        Queue the pk of a document of the given class to be fetched along
+        with the next load of the same class. queryset is an optional
+        QuerySet, or function returning one, to fetch the documents with
+        (defaults to document_class.objects).
+        """
+        key = (document_class, queryset)
+        pk = _to_python_pk(document_class, pk)
+        if pk not in self._loaded.get(key, ()):
+            self._queued.setdefault(key, set()).add(pk)
+
+    def is_loaded(self, document_class, pk, queryset=None):
+        key = (document_class, queryset)
+        return _to_python_pk(document_class, pk) in self._loaded.get(key, ())
+
+    def load(self, document_class, pk, queryset=None):
+        """
+        Return the document of the given class and pk (or None if it
+        doesn't exist), fetching it along with all the queued pks of the
+        same class unless it was fetched before.
+        """
+        key = (document_class, queryset)
+        pk = _to_python_pk(document_class, pk)
+        loaded = self._loaded.setdefault(key, {})
+        if pk not in loaded:
+            self._queued.setdefault(key, set()).add(pk)
+            self._fetch(key)
+        return loaded[pk]
+
+    def clear(self):
+        self._queued.clear()
+        self._loaded.clear()
+
+    def _fetch(self, key):
+        document_class, queryset = key
+        # calling a QuerySet returns a filtered copy of it
+        qs = document_class.objects if queryset is None else queryset()
+        loaded = self._loaded.setdefault(key, {})
+        pks = list(self._queued.pop(key, ()))
+        for pk_group in grouper(self.batch_size, pks):
+            for obj in qs.filter(pk__in=pk_group).batch_size(self.batch_size):
+                loaded[obj.pk] = obj
+            for pk in pk_group:
+                loaded.setdefault(pk, None)
+
+
+def _to_python_pk(document_class, pk):
+    """
+    Normalize a pk (e.g. an ObjectId stored as a string) so that it matches
+    the pk of the fetched document.
+    """
+    pk_field = document_class._fields[document_class._meta['id_field']]
+    return pk_field.to_python(pk)
+
+
+class BatchLoaderMixin(object):
+    """
+    Opt-in document mixin which routes the dereferences of the document's
+    ReferenceFields and SafeReferenceFields through the current
+    BatchLoader (see BatchLoader). When such a document is loaded, the IDs
+    of its references are queued, and accessing a reference field loads the
+    related document along with all the queued ones of the same class:
+
+    class Contact(BatchLoaderMixin, Document):
+        lead = ReferenceField(Lead)
+
+    with BatchLoader():
+        contacts = list(Contact.objects.filter(...))
+        for contact in contacts:
+            contact.lead.name  # one query for all the contacts' leads
+
+    Only the references of the documents loaded before the first access are
+    batched together. When the documents are streamed (e.g. by iterating
+    over a QuerySet or with iter_no_cache), each one is loaded right before
+    it's used, so every access still runs its own query: use
+    iter_fetch_related instead.
+
+    Note that accessing the reference field loads the related document even
+    if only its pk is used afterwards. Outside of a BatchLoader, the
+    document behaves as usual.
+    """
+
+    @classmethod
+    def _from_son(cls, son, *args, **kwargs):
+        obj = super(BatchLoaderMixin, cls)._from_son(son, *args, **kwargs)
+        loader = get_current_loader()
+        if loader is not None:
+            for field, db_field in _get_reference_fields(type(obj)).values():
+                val = son.get(db_field)
+                if val:
+                    loader.queue(
+                        field.document_type, _id_from_value(field, val)
+                    )
+        return obj
+
+    def __getattribute__(self, name):
+        reference_fields = _get_reference_fields(type(self))
+        if name not in reference_fields:
+            return super(BatchLoaderMixin, self).__getattribute__(name)
+
+        loader = get_current_loader()
+        if loader is None:
+            return super(BatchLoaderMixin, self).__getattribute__(name)
+
+        field, db_field = reference_fields[name]
+        if isinstance(field, SafeReferenceField):
+            # we need to use _db_data for safe references because touching
+            # them triggers a query
+            if name not in self._internal_data:
+                val = self._db_data.get(db_field)
+                if val:
+                    rel_obj = loader.load(
+                        field.document_type, _id_from_value(field, val)
+                    )
+                    _setattr_unchanged(self, name, rel_obj)
+                    return rel_obj
+        else:
+            val = super(BatchLoaderMixin, self).__getattribute__(name)
+            if val is not None and getattr(val, '_lazy', False):
+                rel_obj = loader.load(field.document_type, val.pk)
+                if rel_obj is not None:
+                    _setattr_unchanged(self, name, rel_obj)
+                    return rel_obj
+            return val
+
+        return super(BatchLoaderMixin, self).__getattribute__(name)
+
+
+# {document_class: {field_name: (field, db_field)}} of the single reference
+# fields of the classes using the BatchLoaderMixin
+_reference_fields = {}
+
+
+def _get_reference_fields(document_class):
+    fields = _reference_fields.get(document_class)
+    if fields is None:
+        fields = {
+            field_name: (
+                field,
+                document_class._db_field_map.get(field_name, field_name),
+            )
+            for field_name, field in document_class._fields.items()
+            if isinstance(field, ReferenceField)
+            and not isinstance(field, ListField)
+        }
+        _reference_fields[document_class] = fields
+    return fields
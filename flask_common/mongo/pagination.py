@@ -0,0 +1,170 @@
+import base64
+import binascii
+from collections import namedtuple
+
+from bson import BSON
+from bson.errors import BSONError
+
+KeysetPage = namedtuple('KeysetPage', ['objs', 'next_token'])
+
+
+class InvalidPageToken(ValueError):
+    """Raised by keyset_paginate when given a malformed or foreign token."""
+
+
+def keyset_paginate(query_set, sort, limit, token=None):
+    """
+    Return a page of the QuerySet's documents in the given sort order,
+    starting after the position encoded in token (or at the beginning if
+    it's None). Sample usage:
+
+    page = keyset_paginate(
+        Lead.objects.filter(organization=org),
+        ('-date_updated', 'id'),
+        limit=50,
+        token=request.args.get('cursor'),
+    )
+    return {'data': page.objs, 'cursor': page.next_token}
+
+    Returns a KeysetPage of (objs, next_token), where next_token is an
+    opaque string encoding the sort key of the last document, to be passed
+    back in to get the next page (None on the last page, or if the page is
+    empty). limit must be at least 1.
+
+    Unlike skip/limit, the next page is selected with a range predicate on
+    the sort key (e.g. {$or: [{date_updated: {$lt: d}}, {date_updated: d,
+    _id: {$gt: id}}]}), so with an index matching the filter and the sort,
+    every page costs the same no matter how deep it is.
+
+    sort is a sequence of field names, prefixed with - for a descending
+    order, like in order_by. The primary key is appended if it's not the
+    last field, so that the sort key is unique. The sort fields must be top
+    level fields which are always set (documents with a missing or null
+    sort field would be skipped).
+    """
+    if limit < 1:
+        raise ValueError('limit must be at least 1')
+
+    document_class = query_set._document
+    sort = _get_sort_fields(document_class, sort)
+
+    if token is not None:
+        values = _decode_token(token, document_class, sort)
+        query_set = query_set.filter(__raw__=_get_after_query(sort, values))
+
+    objs = list(
+        query_set.order_by(
+            *[
+                ('-' if direction < 0 else '') + field_name
+                for field_name, _, direction in sort
+            ]
+        ).limit(limit + 1)
+    )
+
+    next_token = None
+    if len(objs) > limit:
+        objs = objs[:limit]
+        next_token = _encode_token(sort, objs[-1])
+
+    return KeysetPage(objs, next_token)
+
+
+def _get_sort_fields(document_class, sort):
+    """
+    Return a list of (field_name, db_field, direction) for the given sort,
+    ending with the primary key.
+    """
+    id_field = document_class._meta['id_field']
+    sort_fields = []
+    for key in sort:
+        direction = 1
+        if key.startswith('-'):
+            key, direction = key[1:], -1
+        elif key.startswith('+'):
+            key = key[1:]
+        if key == 'pk':
+            key = id_field
+        if key not in document_class._fields:
+            raise ValueError('Cannot paginate by %s' % key)
+        sort_fields.append(
+            (key, document_class._fields[key].db_field, direction)
+        )
+
+    if not sort_fields or sort_fields[-1][0] != id_field:
+        sort_fields.append(
+            (id_field, document_class._fields[id_field].db_field, 1)
+        )
+    return sort_fields
+
+
+def _get_after_query(sort, values):
+    """
+    Return the query matching the documents after the given sort key: the
+    ones with a greater (or lesser for descending fields) first field, or
+    the same first field and a greater second field, and so on.
+    """
+    clauses = []
+    for i, (_, db_field, direction) in enumerate(sort):
+        clause = {
+            prev_db_field: prev_value
+            for (_, prev_db_field, _), prev_value in zip(sort[:i], values)
+        }
+        clause[db_field] = {'$gt' if direction > 0 else '$lt': values[i]}
+        clauses.append(clause)
+    return {'$or': clauses}
+
+
+def _get_sort_spec(sort):
+    return ['%s:%d' % (db_field, direction) for _, db_field, direction in sort]
+
+
+def _encode_token(sort, obj):
+    fields = obj._fields
+    values = [
+        fields[field_name].to_mongo(getattr(obj, field_name))
+        for field_name, _, _ in sort
+    ]
+    data = BSON.encode({'s': _get_sort_spec(sort), 'v': values})
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def _decode_token(token, document_class, sort):
+    try:
+        data = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        decoded = BSON(data).decode()
+    except (BSONError, binascii.Error, TypeError, ValueError):
+        raise InvalidPageToken('Invalid page token')
+
+    # reject tokens of a different sort, since their values would be
+    # compared to the wrong fields
+    if decoded.get('s') != _get_sort_spec(sort) or len(
+        decoded.get('v', ())
+    ) != len(sort):
+        raise InvalidPageToken('Page token does not match the sort')
+
+    # The values end up in a raw query, so make sure a forged token can't
+    # smuggle operators (e.g. {'$ne': None}) or values of another type in.
+    values = decoded['v']
+    for (field_name, _, _), value in zip(sort, values):
+        field = document_class._fields[field_name]
+        try:
+            valid = not _has_operator(value) and (
+                field.to_mongo(field.to_python(value)) == value
+            )
+        except Exception:
+            valid = False
+        if not valid:
+            raise InvalidPageToken('Invalid value in page token')
+    return values
+
+
+def _has_operator(value):
+    """Return whether the value contains a dict with a $-prefixed key."""
+    if isinstance(value, dict):
+        return any(
+            str(key).startswith('$') or _has_operator(sub_value)
+            for key, sub_value in value.items()
+        )
+    if isinstance(value, (list, tuple)):
+        return any(_has_operator(sub_value) for sub_value in value)
+    return False
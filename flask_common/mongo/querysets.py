@@ -2,8 +2,64 @@ from flask import current_app
 
 from mongoengine import Q, QuerySet
 
+from .utils import iter_fetch_related
 
-class NotDeletedQuerySet(QuerySet):
+
+class PrefetchRelatedMixin(object):
+    """
+    QuerySet mixin adding a prefetch_related method, e.g.:
+
+    for activity in Activity.objects.filter(...).prefetch_related({
+        'user': True,
+        'lead': ['id', 'display_name'],
+    }):
+        ...
+
+    Iterating over a QuerySet with prefetch_related streams the documents
+    without caching them, in batches of the QuerySet's batch size, and calls
+    fetch_related once per batch before yielding the batch's documents. Any
+    extra kwargs are passed to fetch_related (see iter_fetch_related).
+
+    Pass lookup=True to join the related objects on the server with $lookup
+    instead (see lookup_related).
+
+    Since the documents aren't cached, such a QuerySet has no len() (use
+    count() instead), which also keeps list() from running the query or a
+    count for its length hint before the iteration starts.
+    """
+
+    _prefetch_related = None
+
+    def prefetch_related(self, field_dict, **kwargs):
+        queryset = self.clone()
+        queryset._prefetch_related = (field_dict, kwargs)
+        return queryset
+
+    def _clone_into(self, new_qs):
+        new_qs = super(PrefetchRelatedMixin, self)._clone_into(new_qs)
+        new_qs._prefetch_related = self._prefetch_related
+        return new_qs
+
+    def __len__(self):
+        # list() falls back to a default length hint on a TypeError
+        if self._prefetch_related is not None:
+            raise TypeError(
+                'QuerySets with prefetch_related have no len(), use count()'
+            )
+        return super(PrefetchRelatedMixin, self).__len__()
+
+    def __iter__(self):
+        if self._prefetch_related is None:
+            return super(PrefetchRelatedMixin, self).__iter__()
+        field_dict, kwargs = self._prefetch_related
+        return iter_fetch_related(self.clone(), field_dict, **kwargs)
+
+
+class PrefetchRelatedQuerySet(PrefetchRelatedMixin, QuerySet):
+    """QuerySet that supports prefetch_related (see PrefetchRelatedMixin)."""
+
+
+class NotDeletedQuerySet(PrefetchRelatedMixin, QuerySet):
     """QuerySet that doesn't return soft-deleted documents by default."""
 
     def __call__(
@@ -1,8 +1,35 @@
+import queue
+import threading
+import time
+from collections import ChainMap, OrderedDict, namedtuple
+from concurrent.futures import Executor, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
+
+from bson import SON
 from flask_common.utils import grouper
-from mongoengine import ListField, ReferenceField, SafeReferenceField
+from mongoengine import (
+    DictField,
+    EmbeddedDocumentField,
+    GenericReferenceField,
+    ListField,
+    QuerySet,
+    ReferenceField,
+    SafeReferenceField,
+)
+from mongoengine.base import get_document
+from pymongo.errors import CursorNotFound
+
+from .batching import (
+    AdaptiveBatchSize,
+    decode_raw,
+    raw_find,
+    set_cursor_batch_size,
+)
+from .cache import PartialCacheMap
 
 
-def iter_no_cache(query_set):
+def iter_no_cache(query_set, adaptive=None, read_ahead=None, lazy=False):
     """Iterate over a MongoEngine QuerySet without caching it.
 
     Useful for iterating over large result sets / bulk actions.
@@ -10,10 +37,48 @@ def iter_no_cache(query_set):
     If a batch size is not set, apply a sensible default of 1000
     that's better than what Mongo server is doing (101 first and
     then as many as it can fit in 4MB) to avoid cursor timeouts.
+
+    Pass a flask_common.mongo.batching.AdaptiveBatchSize as adaptive to
+    adjust the batch size after every batch instead, based on the BSON size
+    of the documents and the time the batch took. In that case, the
+    QuerySet is only used to build the query (its filter, loaded fields,
+    ordering, skip and limit), and the documents are hydrated with
+    _from_son.
+
+    Pass read_ahead=N to fetch the batches in a background thread, which
+    keeps up to N batches buffered ahead of the consumer, so that waiting
+    for the next batch overlaps with processing the current one. The cursor
+    is only used by the background thread, and it's closed when the
+    iteration ends, fails or is abandoned (i.e. when the iterator is closed
+    or garbage collected).
+
+    Pass lazy=True to hydrate the documents with a
+    flask_common.mongo.lazy.LazySON, which only decodes the BSON of a field
+    when it's accessed (like with an adaptive batch size, the QuerySet is
+    then only used to build the query). This makes iterating over wide
+    documents much cheaper when only a few of their fields are used.
     """
-    if query_set._batch_size is None:
-        query_set = query_set.batch_size(1000)
+    if adaptive is None and not read_ahead and not lazy:
+        if query_set._batch_size is None:
+            query_set = query_set.batch_size(1000)
+        yield from _iter_documents(query_set)
+        return
+
+    if adaptive is not None or lazy:
+        batches = _iter_raw_batches(query_set, adaptive, lazy)
+    else:
+        batches = _iter_batches(query_set)
+    if read_ahead:
+        batches = _iter_read_ahead(batches, read_ahead)
+
+    try:
+        for batch in batches:
+            yield from batch
+    finally:
+        batches.close()
+
 
+def _iter_documents(query_set):
     next = query_set.__next__
 
     while True:
@@ -23,6 +88,370 @@ def iter_no_cache(query_set):
             return
 
 
+def iter_fetch_related(query_set, field_dict, lookup=False, **kwargs):
+    """Iterate over a MongoEngine QuerySet without caching it, fetching
+    related objects for each batch of documents before yielding them.
+
+    Documents are pulled in batches of the QuerySet's batch size (which
+    defaults to 1000, like in iter_no_cache) and fetch_related is called once
+    per batch with the given field_dict and any extra kwargs. This avoids
+    both the N+1 dereferences while streaming and materializing the whole
+    result set for one big fetch_related call.
+
+    Unless a cache_map is passed in the kwargs, each batch gets a fresh one,
+    so that memory usage stays flat.
+
+    With lookup=True, the documents and their related objects are instead
+    fetched together, in a single aggregation with a $lookup stage per field
+    (see lookup_related).
+    """
+    if lookup:
+        return lookup_related(query_set, field_dict, **kwargs)
+    return _iter_fetch_related(query_set, field_dict, **kwargs)
+
+
+def _iter_batches(query_set):
+    if query_set._batch_size is None:
+        query_set = query_set.batch_size(1000)
+    batch_size = query_set._batch_size
+
+    documents = _iter_documents(query_set)
+    try:
+        while True:
+            batch = list(islice(documents, batch_size))
+            if batch:
+                yield batch
+            if len(batch) < batch_size:
+                return
+    finally:
+        query_set._cursor.close()
+
+
+def _iter_read_ahead(batches, read_ahead):
+    """
+    Pull the items of the batches iterator in a background thread, keeping
+    up to read_ahead of them buffered, and yield them. An exception raised
+    by the iterator is re-raised in the consumer. When the consumer stops
+    early, the background thread is stopped and the iterator is closed.
+    """
+    buffer = queue.Queue(maxsize=read_ahead)
+    stop = threading.Event()
+
+    def put(item):
+        # don't block forever if the consumer is gone
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for batch in batches:
+                if not put((batch, None)):
+                    return
+            put((_END_OF_BATCHES, None))
+        except Exception as e:
+            put((None, e))
+        finally:
+            batches.close()
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            batch, error = buffer.get()
+            if error is not None:
+                raise error
+            if batch is _END_OF_BATCHES:
+                return
+            yield batch
+    finally:
+        stop.set()
+        thread.join()
+
+
+_END_OF_BATCHES = object()
+
+
+def _check_forbidden_queries(query_set):
+    """
+    Run the check of a ForbiddenQueriesQuerySet, which is otherwise only done
+    when the QuerySet itself is iterated.
+    """
+    check = getattr(query_set, '_check_for_forbidden_queries', None)
+    if check is not None:
+        check()
+
+
+def _get_collection(query_set):
+    """Return the collection of a QuerySet, with its read preference."""
+    collection = query_set._collection
+    if query_set._read_preference is not None:
+        collection = collection.with_options(
+            read_preference=query_set._read_preference
+        )
+    return collection
+
+
+def _get_find_kwargs(query_set):
+    """
+    Return the cursor options (e.g. no_cursor_timeout), hint, sort, skip and
+    limit of a QuerySet as kwargs for find. The projection is left to the
+    caller.
+    """
+    kwargs = {
+        key: value
+        for key, value in query_set._cursor_args.items()
+        if key not in ('fields', 'projection')
+    }
+    if query_set._hint not in (-1, None):
+        kwargs['modifiers'] = {'$hint': query_set._hint}
+    if query_set._ordering:
+        kwargs['sort'] = query_set._ordering
+    if query_set._skip:
+        kwargs['skip'] = query_set._skip
+    if query_set._limit:
+        kwargs['limit'] = query_set._limit
+    return kwargs
+
+
+def _iter_raw_batches(query_set, adaptive=None, lazy=False):
+    _check_forbidden_queries(query_set)
+    document_class = query_set._document
+    collection = _get_collection(query_set)
+    kwargs = _get_find_kwargs(query_set)
+
+    projection = None
+    if query_set._loaded_fields:
+        projection = query_set._loaded_fields.as_dict()
+
+    if adaptive is None:
+        batch_size = query_set._batch_size or 1000
+    else:
+        batch_size = adaptive.get_size(document_class)
+    cursor = raw_find(
+        collection,
+        query_set._query,
+        projection,
+        batch_size=batch_size,
+        **kwargs
+    )
+
+    # Pull exactly one batch of the cursor at a time, so that the batch size
+    # can be changed before the next getMore.
+    try:
+        while True:
+            start = time.monotonic()
+            raw_docs = list(islice(cursor, batch_size))
+            if adaptive is not None:
+                adaptive.record(
+                    document_class,
+                    len(raw_docs),
+                    sum(len(raw_doc.raw) for raw_doc in raw_docs),
+                    time.monotonic() - start,
+                )
+
+            if raw_docs:
+                yield [
+                    document_class._from_son(
+                        decode_raw(collection, raw_doc, lazy)
+                    )
+                    for raw_doc in raw_docs
+                ]
+
+            if len(raw_docs) < batch_size:
+                return
+
+            if adaptive is not None:
+                batch_size = adaptive.get_size(document_class)
+                set_cursor_batch_size(cursor, batch_size)
+    finally:
+        cursor.close()
+
+
+def parallel_scan(
+    query_set,
+    func,
+    partitions=4,
+    executor=None,
+    checkpoints=None,
+    on_checkpoint=None,
+    max_retries=3,
+):
+    """Scan a MongoEngine QuerySet in parallel, by ranges of _id. Sample
+    usage:
+
+    def backfill(leads):
+        ...
+
+    checkpoints = parallel_scan(Lead.objects.filter(...), backfill, 8)
+
+    The _id space of the QuerySet is split into the given number of ranges
+    (see get_id_ranges), which are scanned concurrently in the given
+    executor (a concurrent.futures.Executor, or the number of workers of a
+    ThreadPoolExecutor created for the duration of the call, one per range
+    by default). Each range is scanned in _id order with iter_no_cache and
+    func is called with each batch of documents (of the QuerySet's batch
+    size, 1000 by default). The QuerySet's ordering is ignored, and it can't
+    have a skip or a limit.
+
+    Progress is recorded in checkpoints, a list with a dict per range:
+    {'min_id': ..., 'max_id': ..., 'last_id': ..., 'done': ...}, where
+    last_id is the _id of the last document of the last batch processed.
+    It's updated after every batch, and on_checkpoint (if given) is called
+    with it (under a lock, so it can be persisted as is, e.g. in a Mongo
+    document). To resume an interrupted scan, pass the persisted checkpoints
+    back in: the finished ranges are skipped and the others continue after
+    their last_id. A batch may thus be processed twice if the scan is
+    interrupted while func is running, so func should be idempotent.
+
+    If a range's cursor times out (e.g. func is slow), the range is resumed
+    from its checkpoint, up to max_retries times. Any other error is
+    re-raised once the running ranges finish (the ones that haven't started
+    yet are skipped), and the scan can be resumed from the checkpoints.
+
+    Returns the checkpoints.
+    """
+    if query_set._skip or query_set._limit:
+        raise ValueError('Cannot scan a QuerySet with a skip or a limit')
+
+    if checkpoints is None:
+        checkpoints = [
+            {'min_id': min_id, 'max_id': max_id, 'last_id': None, 'done': False}
+            for min_id, max_id in get_id_ranges(query_set, partitions)
+        ]
+
+    if executor is None:
+        executor = len(checkpoints)
+    if not isinstance(executor, Executor):
+        with ThreadPoolExecutor(max_workers=max(executor, 1)) as pool:
+            return parallel_scan(
+                query_set,
+                func,
+                executor=pool,
+                checkpoints=checkpoints,
+                on_checkpoint=on_checkpoint,
+                max_retries=max_retries,
+            )
+
+    lock = threading.Lock()
+
+    def save_checkpoint():
+        if on_checkpoint is not None:
+            with lock:
+                on_checkpoint(checkpoints)
+
+    futures = [
+        executor.submit(
+            _scan_range,
+            query_set,
+            func,
+            checkpoint,
+            save_checkpoint,
+            max_retries,
+        )
+        for checkpoint in checkpoints
+        if not checkpoint['done']
+    ]
+    try:
+        for future in futures:
+            future.result()
+    except Exception:
+        # don't start the remaining ranges (the running ones still finish)
+        for future in futures:
+            future.cancel()
+        raise
+
+    return checkpoints
+
+
+def get_id_ranges(query_set, partitions, sample_size=None):
+    """
+    Split the _id space of the documents matching the QuerySet into up to
+    the given number of (min_id, max_id) ranges of roughly the same number
+    of documents. min_id is inclusive and max_id exclusive, and None means
+    unbounded, so the ranges cover the whole _id space.
+
+    The boundaries are the quantiles of a $sample of the matching _ids
+    (sample_size defaults to 100 per partition), which is much cheaper than
+    sorting all of them (like $bucketAuto does), but only approximate.
+    """
+    if partitions <= 1:
+        return [(None, None)]
+
+    if sample_size is None:
+        sample_size = partitions * 100
+
+    pipeline = []
+    if query_set._query:
+        pipeline.append({'$match': query_set._query})
+    pipeline.append({'$sample': {'size': sample_size}})
+    pipeline.append({'$project': {'_id': 1}})
+    ids = sorted(
+        doc['_id'] for doc in query_set._collection.aggregate(pipeline)
+    )
+
+    boundaries = sorted(
+        {ids[len(ids) * i // partitions] for i in range(1, partitions)}
+        if ids
+        else ()
+    )
+    edges = [None] + boundaries + [None]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def _scan_range(query_set, func, checkpoint, save_checkpoint, max_retries):
+    id_field = query_set._document._meta['id_field']
+    retries = 0
+    while True:
+        filters = {}
+        if checkpoint['last_id'] is not None:
+            filters['%s__gt' % id_field] = checkpoint['last_id']
+        elif checkpoint['min_id'] is not None:
+            filters['%s__gte' % id_field] = checkpoint['min_id']
+        if checkpoint['max_id'] is not None:
+            filters['%s__lt' % id_field] = checkpoint['max_id']
+        range_qs = query_set.filter(**filters).order_by(id_field)
+
+        try:
+            for batch in _iter_batches(range_qs):
+                func(batch)
+                checkpoint['last_id'] = batch[-1].pk
+                save_checkpoint()
+        except CursorNotFound:
+            retries += 1
+            if retries > max_retries:
+                raise
+            continue
+
+        checkpoint['done'] = True
+        save_checkpoint()
+        return
+
+
+def _iter_fetch_related(query_set, field_dict, **kwargs):
+    if query_set._batch_size is None:
+        query_set = query_set.batch_size(1000)
+    batch_size = query_set._batch_size
+
+    batch = []
+    for obj in iter_no_cache(query_set):
+        batch.append(obj)
+        if len(batch) == batch_size:
+            fetch_related(batch, field_dict, **kwargs)
+            for batch_obj in batch:
+                yield batch_obj
+            batch = []
+
+    if batch:
+        fetch_related(batch, field_dict, **kwargs)
+        for obj in batch:
+            yield obj
+
+
 def fetch_related(
     objs,
     field_dict,
@@ -30,6 +459,15 @@ def fetch_related(
     extra_filters=None,
     batch_size=100,
     filter_funcs=None,
+    executor=None,
+    raw=False,
+    as_dicts=False,
+    report=None,
+    dry_run=False,
+    shard_keys=None,
+    partial_cache_map=None,
+    single_flight=None,
+    lazy=False,
 ):
     """
     Recursively fetches related objects for the given document instances.
@@ -47,11 +485,11 @@ def fetch_related(
     In this sample, users and leads for all objs will be fetched and attached.
     Then, lead.created_by and lead.updated_by users are fetched in one query
     and attached. Finally, a contact will be pulled in, only fetching the ID
-    from the database.
+    from the database. See FetchRelatedPlan for the supported fields.
 
-    Note that the function doesn't merge queries for the same document class
-    across multiple (recursive) function calls, but it never fetches the same
-    related object twice.
+    The field_dict is processed breadth-first, so there's at most one batched
+    query set per document class per depth, and the same related object is
+    never fetched twice.
 
     Be *very* cautious when pulling in only specific fields for a related
     object. Accessing fields that haven't been pulled will falsely show None
@@ -77,244 +515,1632 @@ def fetch_related(
     The function takes an optional dict filter_funcs in the form
     {document_class: filter_func} which represents the function that is used
     to fetch and filter documents (defaults to document_class.objects.filter).
+    Like batch_size, extra_filters and filter_funcs only apply to the first
+    depth.
+
+    Pass an executor (a concurrent.futures.Executor, or an int to create a
+    ThreadPoolExecutor with that many workers) to issue the batched queries
+    concurrently. The other options are described in _FetchRelated, and the
+    report and dry_run kwargs in FetchRelatedReport.
     """
+    if executor is not None and not isinstance(executor, Executor):
+        with ThreadPoolExecutor(max_workers=executor) as pool:
+            return fetch_related(
+                objs,
+                field_dict,
+                cache_map=cache_map,
+                extra_filters=extra_filters,
+                batch_size=batch_size,
+                filter_funcs=filter_funcs,
+                executor=pool,
+                raw=raw,
+                as_dicts=as_dicts,
+                report=report,
+                dry_run=dry_run,
+                shard_keys=shard_keys,
+                partial_cache_map=partial_cache_map,
+                single_flight=single_flight,
+                lazy=lazy,
+            )
+
+    report, report_hook = _start_report(report, dry_run)
+    start_time = time.monotonic()
+
     if not objs:
-        return
+        return _finish_report(report, report_hook, start_time)
+
+    fetcher = _FetchRelated(
+        objs,
+        field_dict,
+        cache_map=cache_map,
+        extra_filters=extra_filters,
+        batch_size=batch_size,
+        filter_funcs=filter_funcs,
+        raw=raw,
+        as_dicts=as_dicts,
+        report=report,
+        shard_keys=shard_keys,
+        partial_cache_map=partial_cache_map,
+        single_flight=single_flight,
+        lazy=lazy,
+    )
+
+    while fetcher.level:
+        batches = fetcher.plan_level()
+
+        if dry_run:
+            fetcher.add_planned_queries(batches)
+            report.print_planned_queries()
+            return _finish_report(report, report_hook, start_time)
+
+        batches = fetcher.claim_level(batches)
+        try:
+            if executor is None:
+                results = (fetcher.fetch_batch(*batch) for batch in batches)
+            else:
+                futures = [
+                    executor.submit(fetcher.fetch_batch, *batch)
+                    for batch in batches
+                ]
+                results = (future.result() for future in futures)
+
+            fetcher.finish_level(batches, results)
+        except Exception as e:
+            fetcher.fail_level(e)
+            raise
+
+    return _finish_report(report, report_hook, start_time)
+
+
+class _FetchRelated(object):
+    """
+    State of a single fetch_related call.
+
+    The field_dict tree is walked breadth-first, one level at a time: for
+    each level, plan_level returns the batches that need to be fetched as
+    (document_class, fields_to_fetch, id_group, shard_filter) tuples, where
+    shard_filter is a tuple of (shard_key_field, value) pairs (empty when
+    the document class doesn't have a shard key), and finish_level
+    takes the results of fetch_batch for each of them, caches the fetched
+    objects, attaches them and moves on to the next level. Running the
+    batches is left to the caller, so that they can be run sequentially,
+    in an executor or concurrently on an event loop (see
+    flask_common.mongo.aio).
+
+    The options of fetch_related which change how the batches are queried
+    and cached:
+
+    - batch_size: the number of IDs per query on the first depth (the deeper
+      levels use nested_batch_size). It can also be a
+      flask_common.mongo.batching.AdaptiveBatchSize, which sizes the batches
+      of each document class on every depth based on the BSON size of its
+      documents and the time the previous batches took. The sizes are
+      chosen when a depth is planned, so pass the same instance to
+      subsequent calls to reuse the measurements. The batches are then
+      queried like with raw=True, so that their size can be measured.
+    - raw: skip the QuerySet machinery and send the batched queries (with
+      the same filters and projection) directly to the pymongo collection,
+      hydrating the documents with _from_son. This is noticeably cheaper
+      when prefetching thousands of references.
+    - lazy: hydrate the related objects with a flask_common.mongo.lazy.LazySON
+      (see iter_no_cache), so that only the fields which are accessed get
+      decoded. The batches are then queried like with raw=True.
+    - as_dicts: attach plain dicts (raw documents, as returned by pymongo)
+      instead of documents, which is the cheapest option for read-only
+      serializers. Such dicts don't have any related objects of their own,
+      so they're never cached in the cache_map and the field_dict can't
+      contain sub-dicts.
+    - shard_keys: a dict in the form {document_class: shard_key}, to query
+      each shard separately when the related objects are in a sharded
+      collection and the objs span many shard key values (so extra_filters
+      can't be used). The shard_key is either the name of the shard key
+      field, whose value for each related object is taken from the same
+      attribute of the object referencing it, or a tuple of
+      (shard_key_field, get_value), where get_value returns the shard key
+      value given the referencing object:
+
+      fetch_related(contacts, {'lead': True}, shard_keys={
+          Lead: 'organization_id',
+          User: ('organization_id', lambda contact: contact.lead_org_id),
+      })
+
+      The IDs are then grouped by their shard key value and each batch is
+      fetched with a {shard_key_field: value, _id: {$in: ids}} query, so it
+      only hits the shard that owns it. References whose shard key value is
+      None (and generic references) are fetched without a shard key. Unlike
+      extra_filters, shard_keys apply on every depth.
+    - partial_cache_map: a flask_common.mongo.cache.PartialCacheMap, to reuse
+      the objects fetched with specific fields across calls. It serves
+      requests for a subset of the fields an object was fetched with, and
+      its objects raise an UnloadedFieldError on access to the fields that
+      weren't fetched, rather than returning None.
+    - single_flight: a flask_common.mongo.cache.SingleFlight shared by the
+      threads which share the cache_map. Objects which are already being
+      fetched by another thread are then waited for instead of being queried
+      again (this only applies to full objects, not to the ones fetched with
+      specific fields or as dicts).
+
+    If the cache_map is reused for a long time (e.g. across batches in a
+    worker), use a flask_common.mongo.cache.BoundedCacheMap, which evicts
+    the least recently used objects instead of growing without limit. The
+    objects are assigned from this call's full_map, so evictions during the
+    call don't matter.
+    """
+
+    # Whether the default QuerySets are bound to the sync mongoengine
+    # connection (document_class.objects). When False, they're built without
+    # a collection, and only their query and projection can be used.
+    bind_collections = True
+
+    # Batch size of the levels below the first one, which (like the
+    # extra_filters and filter_funcs) don't use the batch_size of the call
+    nested_batch_size = 100
+
+    def __init__(
+        self,
+        objs,
+        field_dict,
+        cache_map=None,
+        extra_filters=None,
+        batch_size=100,
+        filter_funcs=None,
+        raw=False,
+        as_dicts=False,
+        report=None,
+        shard_keys=None,
+        partial_cache_map=None,
+        single_flight=None,
+        lazy=False,
+    ):
+        if not isinstance(field_dict, FetchRelatedPlan):
+            field_dict = FetchRelatedPlan(field_dict)
+
+        if as_dicts and any(
+            isinstance(sub_field_dict, dict)
+            for sub_field_dict in field_dict.field_dict.values()
+        ):
+            raise ValueError(
+                'Cannot fetch related objects of related objects fetched as '
+                'dicts'
+            )
 
-    if extra_filters is None:
-        extra_filters = {}
-
-    if filter_funcs is None:
-        filter_funcs = {}
-
-    # Cache map holds a map of pks to objs for objects we fetched, over all
-    # iterations / from previous calls, by document class (doesn't include
-    # partially fetched objects)
-    if cache_map is None:
-        cache_map = {}
-
-    # Cache map for partial fetches (i.e. ones where only specific fields
-    # were requested). is only temporary since we don't want to cache partial
-    # data through subsequent calls of this function
-    partial_cache_map = {}
-
-    # Helper mapping: field_name -> (
-    #   field instance,
-    #   name of the field in the db,
-    #   document class,
-    #   fields to fetch (or None if the whole related obj should be fetched)
-    # )
-    field_info = {}
-
-    # IDs to fetch and their fetch options, by document class
-    fetch_map = {}
-
-    def id_from_value(field, val):
-        if field.dbref:
-            return val.id
+        if isinstance(batch_size, AdaptiveBatchSize):
+            self.adaptive = batch_size
+            self.batch_size = None
         else:
-            return val
+            self.adaptive = None
+            self.batch_size = batch_size
+        self.extra_filters = extra_filters or {}
+        self.filter_funcs = filter_funcs or {}
+        self.raw = raw
+        self.lazy = lazy
+        self.as_dicts = as_dicts
+        self.report = report
+        self.shard_keys = {
+            document_class: _get_shard_key(shard_key)
+            for document_class, shard_key in (shard_keys or {}).items()
+        }
 
-    def get_instance_for_each_type(objs):
-        instances = []
-        types = []
-        for obj in objs:
-            if type(obj) not in types:
-                instances.append(obj)
-                types.append(type(obj))
-        return instances
+        # Cache map holds a map of pks to objs for objects we fetched, over
+        # all iterations / from previous calls, by document class (doesn't
+        # include partially fetched objects)
+        self.cache_map = {} if cache_map is None else cache_map
+
+        # Full objects fetched or found in the cache map during this call, by
+        # document class. Objects are assigned from here rather than from the
+        # cache map, which may evict them in the meantime if it's bounded.
+        self.full_map = {}
+
+        # Cache map for partial fetches (i.e. ones where only specific fields
+        # were requested). Unless a PartialCacheMap is given, it's only
+        # temporary since we don't want to cache partial data through
+        # subsequent calls of this function
+        if partial_cache_map is None or as_dicts:
+            partial_cache_map = PartialCacheMap(strict=False)
+        self.partial_cache_map = partial_cache_map
+
+        # The pks claimed in the SingleFlight for the level being fetched, as
+        # (document_class, pks) pairs, and the flights of the pks which are
+        # being fetched by other threads, as (document_class, {pk: flight})
+        # pairs
+        self.single_flight = None if as_dicts else single_flight
+        self.claimed = []
+        self.in_flight = []
+
+        # Cache of (collection, query, projection) used for raw queries, by
+        # (document class, fields to fetch, shard filter, first depth)
+        self.raw_query_map = {}
+
+        # Each level is a list of (objs, _PlanNode) pairs: the top-level
+        # objs with the root node of the plan, then the related objects
+        # fetched for each field with the node of that field's sub-dict, and
+        # so on.
+        self.level = [(objs, field_dict.root)]
+        self.depth = 0
+
+        # (objs, _FieldInfo) pairs of the level being fetched
+        self.level_fields = []
 
-    def setattr_unchanged(obj, key, val):
+    def get_pk_to_obj(self, document_class, fields_to_fetch):
         """
-        Sets an attribute on the given document object without changing the
-        _changed_fields set. This is because we don't actually modify the
-        related objects.
+        Return a mapping of pks to objects of the given document class
+        available in this call which contain at least the requested fields.
         """
-        changed = key in obj._changed_fields
-        setattr(obj, key, val)
-        if not changed and key in obj._changed_fields:
-            obj._changed_fields.remove(key)
-
-    # Populate the field_info
-    instances = get_instance_for_each_type(objs)
-    for field_name, sub_field_dict in field_dict.items():
-
-        instance = [
-            instance
-            for instance in instances
-            if instance and field_name in instance.__class__._fields
-        ]
-        if not instance:
-            continue  # None of the objects contains this field
-
-        instance = instance[0]
-        field = instance.__class__._fields[field_name]
-        db_field = instance._db_field_map.get(field_name, field_name)
-        if isinstance(field, ReferenceField):  # includes SafeReferenceListField
-            document_class = field.document_type
-        elif isinstance(field, ListField) and isinstance(
-            field.field, ReferenceField
-        ):
-            document_class = field.field.document_type
-        else:
-            raise NotImplementedError(
-                '%s class not supported for fetch_related'
-                % field.__class__.__name__
+        pk_to_obj = self.full_map.setdefault(document_class, {})
+        if fields_to_fetch is None:
+            return pk_to_obj
+        return ChainMap(
+            self.partial_cache_map.get_objs(document_class, fields_to_fetch),
+            pk_to_obj,
+        )
+
+    def is_available(self, document_class, pk_to_obj, pk):
+        """
+        Check whether an object is already available in this call or in the
+        cache map, without having to fetch it.
+        """
+        if pk in pk_to_obj:
+            return True
+        if self.as_dicts:
+            return False
+        obj = self.cache_map.get(document_class, {}).get(pk)
+        if obj is not None:
+            self.full_map[document_class][pk] = obj
+            return True
+        return False
+
+    def get_queryset(self, document_class, fields_to_fetch, **filters):
+        # extra_filters and filter_funcs only apply to the first depth
+        top_level = self.depth == 0
+        filter_func = (
+            self.filter_funcs.get(document_class) if top_level else None
+        )
+        if filter_func is None and self.bind_collections:
+            filter_func = document_class.objects.filter
+        elif filter_func is None:
+            queryset_class = document_class._meta.get(
+                'queryset_class', QuerySet
             )
-        fields_to_fetch = (
-            sub_field_dict
-            if isinstance(sub_field_dict, (list, tuple))
-            else None
+            filter_func = queryset_class(document_class, None).filter
+        cls_filters = (
+            self.extra_filters.get(document_class, {}) if top_level else {}
         )
-        field_info[field_name] = (
-            field,
-            db_field,
-            document_class,
-            fields_to_fetch,
+        qs = filter_func(**dict(cls_filters, **filters)).clear_cls_query()
+
+        # only fetch the requested fields
+        if fields_to_fetch:
+            qs = qs.only(*sorted(fields_to_fetch))
+
+        return qs
+
+    def get_raw_query(self, document_class, fields_to_fetch, shard_filter=()):
+        key = (document_class, fields_to_fetch, shard_filter, self.depth == 0)
+        if key not in self.raw_query_map:
+            qs = self.get_queryset(
+                document_class, fields_to_fetch, **dict(shard_filter)
+            )
+            self.raw_query_map[key] = (
+                qs._collection if self.bind_collections else None,
+                qs._query,
+                qs._loaded_fields.as_dict() if fields_to_fetch else None,
+            )
+        return self.raw_query_map[key]
+
+    def get_planned_query(
+        self, document_class, fields_to_fetch, id_group, shard_filter=()
+    ):
+        """
+        Return the (collection, query, projection) that fetches the given
+        batch of IDs.
+        """
+        collection, query, projection = self.get_raw_query(
+            document_class, fields_to_fetch, shard_filter
         )
+        pk_field = document_class._fields[document_class._meta['id_field']]
+        query = dict(
+            query,
+            _id={
+                '$in': [
+                    pk_field.prepare_query_value('in', pk) for pk in id_group
+                ]
+            },
+        )
+        return collection, query, projection
 
-    # Determine what IDs we want to fetch
-    for field_name, sub_field_dict in field_dict.items():
-        field, db_field, document_class, fields_to_fetch = field_info.get(
-            field_name
-        ) or (None, None, None, None)
-        if not field:
-            continue
+    def fetch_batch(
+        self, document_class, fields_to_fetch, id_group, shard_filter=()
+    ):
+        """
+        Fetch the given batch, returning a tuple of the fetched objects and
+        the time the query took.
+        """
+        start = time.monotonic()
+        batch_objs = self.query_batch(
+            document_class, fields_to_fetch, id_group, shard_filter
+        )
+        return batch_objs, time.monotonic() - start
 
-        # we need to use _db_data for safe references because touching their
-        # pks triggers a query
-        if isinstance(field, SafeReferenceField):
-            ids = {
-                id_from_value(field, obj._db_data.get(db_field, None))
-                for obj in objs
-                if field_name not in obj._internal_data
-                and obj._db_data.get(db_field, None)
-            }
-        elif isinstance(field, ListField):
-            ids = [
-                obj._db_data.get(db_field, [])
-                for obj in objs
-                if field_name not in obj._internal_data
-            ]
-            ids = {
-                id_from_value(field.field, item)
-                for sublist in ids
-                for item in sublist
-            }  # flatten the list of lists
-        elif isinstance(field, ReferenceField):
-            ids = {
-                getattr(obj, field_name).pk
-                for obj in objs
-                if getattr(obj, field_name, None)
-                and getattr(getattr(obj, field_name), '_lazy', False)
-            }
+    def get_batch_size(self, document_class):
+        if self.adaptive is not None:
+            return self.adaptive.get_size(document_class)
+        if self.depth:
+            return self.nested_batch_size
+        return self.batch_size
 
-        # remove ids of objects that are already in the cache map
-        if document_class in cache_map:
-            ids -= set(cache_map[document_class])
+    def query_batch(
+        self, document_class, fields_to_fetch, id_group, shard_filter=()
+    ):
+        if self.adaptive is not None or self.lazy:
+            return self.query_raw_batch(
+                document_class, fields_to_fetch, id_group, shard_filter
+            )
 
-        # no point setting up the data structures for fields where there's nothing to fetch
-        if not ids:
-            continue
+        if not (self.raw or self.as_dicts):
+            qs = self.get_queryset(
+                document_class,
+                fields_to_fetch,
+                pk__in=id_group,
+                **dict(shard_filter)
+            )
+
+            # We have to apply this at the end, or only() won't work.
+            qs = qs.batch_size(self.get_batch_size(document_class))
 
-        # set up cache maps for the newly seen document class
-        if document_class not in cache_map:
-            cache_map[document_class] = {}
-        if document_class not in partial_cache_map:
-            partial_cache_map[document_class] = {}
+            return list(qs)
 
-        # set up a fetch map for this document class
+        collection, query, projection = self.get_planned_query(
+            document_class, fields_to_fetch, id_group, shard_filter
+        )
+        cursor = collection.find(
+            query, projection, batch_size=self.get_batch_size(document_class)
+        )
+        return self.from_sons(document_class, cursor)
+
+    def query_raw_batch(
+        self, document_class, fields_to_fetch, id_group, shard_filter=()
+    ):
+        """
+        Query a batch as RawBSONDocuments, to measure its size for the
+        adaptive batch size and/or to hydrate the objects lazily.
+        """
+        start = time.monotonic()
+        collection, query, projection = self.get_planned_query(
+            document_class, fields_to_fetch, id_group, shard_filter
+        )
+        raw_docs = list(
+            raw_find(collection, query, projection, batch_size=len(id_group))
+        )
+        if self.adaptive is not None:
+            self.adaptive.record(
+                document_class,
+                len(raw_docs),
+                sum(len(raw_doc.raw) for raw_doc in raw_docs),
+                time.monotonic() - start,
+            )
+        lazy = self.lazy and not self.as_dicts
+        return self.from_sons(
+            document_class,
+            [decode_raw(collection, raw_doc, lazy) for raw_doc in raw_docs],
+        )
+
+    def from_sons(self, document_class, sons):
+        """Turn the raw documents of a batch into the objects to attach."""
+        if self.as_dicts:
+            return list(sons)
+        from_son = document_class._from_son
+        return [from_son(son) for son in sons]
+
+    def add_to_fetch_map(
+        self, fetch_map, document_class, fields_to_fetch, ids, shard_filter=()
+    ):
+        # remove ids of objects that are already in the cache maps
+        pk_to_obj = self.get_pk_to_obj(document_class, fields_to_fetch)
+        ids = {
+            pk
+            for pk in ids
+            if not self.is_available(document_class, pk_to_obj, pk)
+        }
+
+        # no point setting up the data structures for fields where there's
+        # nothing to fetch
+        if not ids:
+            return
+
+        # set up a fetch map for this document class. If the same document
+        # class is requested with different fields_to_fetch (e.g.
+        # { user: ["id"], created_by: ["id", "name"] }), fetch a union of the
+        # requested fields, or the whole objects if any of the fields
+        # requests them (e.g. { created_by: True })
         if document_class in fetch_map:
-            fetch_map[document_class]['ids'] |= ids
-
-            # make sure we don't allow partial fetching if the same document class
-            # has conflicting fields_to_fetch (e.g. { user: ["id"], created_by: True })
-            # TODO this could be improved to fetch a union of all requested fields
-            if fields_to_fetch != fetch_map[document_class]['fields_to_fetch']:
-                raise RuntimeError(
-                    'Cannot specify different fields_to_fetch for the same document class %s'
-                    % document_class
-                )
+            fetch_opts = fetch_map[document_class]
+            fetch_opts['ids'].setdefault(shard_filter, set()).update(ids)
+            if fields_to_fetch is None or fetch_opts['fields_to_fetch'] is None:
+                fetch_opts['fields_to_fetch'] = None
+            else:
+                fetch_opts['fields_to_fetch'] |= fields_to_fetch
         else:
             fetch_map[document_class] = {
-                'ids': ids,
+                'ids': {shard_filter: ids},
                 'fields_to_fetch': fields_to_fetch,
             }
 
-    # Fetch objects and cache them
-    for document_class, fetch_opts in fetch_map.items():
-        cls_filters = extra_filters.get(document_class, {})
+    def plan_level(self):
+        """
+        Resolve the fields of the current level and return the batches
+        that need to be fetched for it.
+        """
+        report = self.report
+
+        # Determine what IDs we want to fetch and their fetch options, by
+        # document class (and shard key value) for the whole level
+        fetch_map = {}
+        self.level_fields = []
+        requested_ids = {}
+        for level_objs, node in _split_embedded(self.level):
+            for class_objs, info in node.get_field_infos(level_objs):
+                self.level_fields.append((class_objs, info))
+                for document_class, shard_filter, ids in self.get_ids_to_fetch(
+                    class_objs, info
+                ):
+                    if report is not None:
+                        requested_ids.setdefault(document_class, set())
+                        requested_ids[document_class] |= ids
+                    self.add_to_fetch_map(
+                        fetch_map,
+                        document_class,
+                        info.fields_to_fetch,
+                        ids,
+                        shard_filter,
+                    )
+
+        if report is not None:
+            for document_class, ids in requested_ids.items():
+                stats = report.get_stats(self.depth, document_class)
+                stats['requested_ids'] += len(ids)
+                stats['cached_ids'] += len(
+                    ids.difference(
+                        *fetch_map.get(document_class, {'ids': {}})[
+                            'ids'
+                        ].values()
+                    )
+                )
 
         # Fetch objects in batches. Also set the batch size so we don't do
         # multiple queries per batch.
-        for id_group in grouper(batch_size, list(fetch_opts['ids'])):
-            filter_func = filter_funcs.get(
-                document_class, document_class.objects.filter
+        return [
+            (
+                document_class,
+                fetch_opts['fields_to_fetch'],
+                id_group,
+                shard_filter,
+            )
+            for document_class, fetch_opts in fetch_map.items()
+            for shard_filter, ids in fetch_opts['ids'].items()
+            for id_group in grouper(
+                self.get_batch_size(document_class), list(ids)
+            )
+        ]
+
+    def get_ids_to_fetch(self, objs, info):
+        """
+        Return a list of (document_class, shard_filter, ids) tuples with the
+        IDs referenced by the given field of the objs. If the related
+        document class has a shard key, the IDs are grouped by the shard key
+        value of the objs referencing them.
+        """
+        shard_key = self.shard_keys.get(info.document_class)
+        if shard_key is None:
+            return [
+                (document_class, (), ids)
+                for document_class, ids in _get_ids_to_fetch(objs, info).items()
+            ]
+
+        shard_key_field, get_value = shard_key
+        objs_by_value = OrderedDict()
+        for obj in _get_objs_with_field(objs, info.name):
+            objs_by_value.setdefault(get_value(obj), []).append(obj)
+
+        ids_to_fetch = []
+        for value, value_objs in objs_by_value.items():
+            shard_filter = () if value is None else ((shard_key_field, value),)
+            ids_to_fetch.extend(
+                (document_class, shard_filter, ids)
+                for document_class, ids in _get_ids_to_fetch(
+                    value_objs, info
+                ).items()
+            )
+        return ids_to_fetch
+
+    def claim_level(self, batches):
+        """
+        Claim the IDs of the full objects in the given batches in the
+        SingleFlight (if any), and return the batches with only the IDs that
+        aren't being fetched by another thread already.
+        """
+        if self.single_flight is None:
+            return batches
+
+        claimed_batches = []
+        for batch in batches:
+            document_class, fields_to_fetch, id_group, shard_filter = batch
+            if fields_to_fetch is not None:
+                claimed_batches.append(batch)
+                continue
+
+            claimed, in_flight = self.single_flight.claim(
+                document_class, id_group
             )
-            qs = filter_func(pk__in=id_group, **cls_filters).clear_cls_query()
+            self.claimed.append((document_class, claimed))
 
-            # only fetch the requested fields
-            if fetch_opts['fields_to_fetch']:
-                qs = qs.only(*fetch_opts['fields_to_fetch'])
+            # Another thread may have cached some of the objects since the
+            # level was planned. They stay claimed, so that they're resolved
+            # from this call's objects, but they aren't fetched again.
+            pk_to_obj = self.full_map.setdefault(document_class, {})
+            to_fetch = [
+                pk
+                for pk in claimed
+                if not self.is_available(document_class, pk_to_obj, pk)
+            ]
 
-            # We have to apply this at the end, or only() won't work.
-            qs = qs.batch_size(batch_size)
+            if self.report is not None and (in_flight or claimed != to_fetch):
+                stats = self.report.get_stats(self.depth, document_class)
+                stats['inflight_ids'] += len(in_flight)
+                stats['cached_ids'] += len(claimed) - len(to_fetch)
+            if in_flight:
+                self.in_flight.append((document_class, in_flight))
+            if to_fetch:
+                claimed_batches.append(
+                    (document_class, fields_to_fetch, to_fetch, shard_filter)
+                )
+        return claimed_batches
 
-            # update the cache map - either the persistent one with full
-            # objects, or the ephemeral partial cache
-            update_dict = {obj.pk: obj for obj in qs}
-            if fetch_opts['fields_to_fetch'] is None:
-                cache_map[document_class].update(update_dict)
+    def fail_level(self, exc):
+        """Propagate an error to the threads waiting for the claimed IDs."""
+        for document_class, pks in self.claimed:
+            self.single_flight.fail(document_class, pks, exc)
+        self.claimed = []
+        self.in_flight = []
+
+    def finish_flights(self):
+        """
+        Publish the objects fetched for the claimed IDs, then wait for the
+        ones fetched by other threads and add them to this call's objects.
+        """
+        full_map = self.full_map
+        for document_class, pks in self.claimed:
+            self.single_flight.resolve(
+                document_class, pks, full_map.get(document_class, {})
+            )
+        self.claimed = []
+
+        for document_class, in_flight in self.in_flight:
+            pk_to_obj = full_map.setdefault(document_class, {})
+            class_cache = self.cache_map.setdefault(document_class, {})
+            for pk, flight in in_flight.items():
+                obj = self.single_flight.wait(flight)
+                if obj is not None:
+                    pk_to_obj[pk] = obj
+                    class_cache[pk] = obj
+        self.in_flight = []
+
+    def add_planned_queries(self, batches):
+        """Add the queries for the given batches to the report."""
+        for batch in batches:
+            document_class = batch[0]
+            collection, query, projection = self.get_planned_query(*batch)
+            self.report.add_planned_query(
+                self.depth, document_class, collection.name, query, projection
+            )
+
+    def finish_level(self, batches, results):
+        """
+        Cache and attach the objects fetched for the current level, given
+        the fetch_batch result for each batch, and move on to the next
+        level.
+        """
+        report = self.report
+        full_map = self.full_map
+        cache_map = self.cache_map
+
+        # set up cache maps for the newly seen document classes (with
+        # setdefault, which is atomic for BoundedCacheMaps shared by threads)
+        if not self.as_dicts:
+            for batch in batches:
+                cache_map.setdefault(batch[0], {})
+
+        # Cache the fetched objects - either in the persistent cache map with
+        # full objects, or in the ephemeral partial cache
+        for (document_class, fields_to_fetch, id_group, shard_filter), (
+            batch_objs,
+            query_time,
+        ) in zip(batches, results):
+            if self.as_dicts:
+                update_dict = {obj['_id']: obj for obj in batch_objs}
             else:
-                partial_cache_map[document_class].update(update_dict)
+                update_dict = {obj.pk: obj for obj in batch_objs}
 
-    # Assign objects
-    for field_name, sub_field_dict in field_dict.items():
-        field, db_field, document_class, fields_to_fetch = field_info.get(
-            field_name
-        ) or (None, None, None, None)
+            if report is not None:
+                stats = report.get_stats(self.depth, document_class)
+                stats['queries'] += 1
+                stats['documents'] += len(batch_objs)
+                stats['missing_ids'] += len(set(id_group) - set(update_dict))
+                stats['query_time'] += query_time
 
-        if not field:
-            continue
+            if fields_to_fetch is None:
+                full_map.setdefault(document_class, {}).update(update_dict)
+                if not self.as_dicts:
+                    cache_map[document_class].update(update_dict)
+            else:
+                self.partial_cache_map.add(
+                    document_class, fields_to_fetch, update_dict
+                )
 
-        # merge the permanent and temporary caches for the ease of assignment
-        pk_to_obj = cache_map.get(document_class, {}).copy()
-        pk_to_obj.update(partial_cache_map.get(document_class, {}))
+        if self.single_flight is not None:
+            self.finish_flights()
 
-        # if a dict of subfields was passed, go recursive
-        if pk_to_obj and isinstance(sub_field_dict, dict):
-            fetch_related(
-                list(pk_to_obj.values()), sub_field_dict, cache_map=cache_map
+        # Assign objects (each field gets the objects containing at least
+        # the fields it asked for) and collect the related objects whose
+        # fields should be fetched on the next level. The related objects of
+        # each sub-dict are merged, since objects of different classes (e.g.
+        # the targets of a generic reference) can reference the same ones.
+        next_level = OrderedDict()
+        for level_objs, info in self.level_fields:
+            related_objs = _attach_related(
+                level_objs,
+                info,
+                partial(
+                    self.get_pk_to_obj, fields_to_fetch=info.fields_to_fetch
+                ),
             )
 
-        # attach all the values to all the objects
-        for obj in objs:
-            if isinstance(field, SafeReferenceField):
-                if field_name not in obj._internal_data:
-                    val = obj._db_data.get(db_field, None)
-                    if val:
-                        setattr_unchanged(
-                            obj,
-                            field_name,
-                            pk_to_obj.get(id_from_value(field, val)),
-                        )
+            if related_objs and info.sub_node is not None:
+                next_level.setdefault(info.sub_node, OrderedDict()).update(
+                    (id(rel_obj), rel_obj) for rel_obj in related_objs
+                )
 
-            elif isinstance(field, ReferenceField):
-                val = getattr(obj, field_name, None)
-                if val and getattr(val, '_lazy', False):
-                    rel_obj = pk_to_obj.get(val.pk)
-                    if rel_obj:
-                        setattr_unchanged(obj, field_name, rel_obj)
-
-            elif isinstance(field, ListField):
-                if field_name not in obj._internal_data:
-                    value = list(
-                        filter(
-                            None,
-                            [
-                                pk_to_obj.get(id_from_value(field.field, val))
-                                for val in obj._db_data.get(db_field, [])
-                            ],
+        self.level = [
+            (list(related_objs.values()), sub_node)
+            for sub_node, related_objs in next_level.items()
+        ]
+        self.level_fields = []
+        self.depth += 1
+
+
+class FetchRelatedReport(object):
+    """
+    Report of what a fetch_related call did. Pass one as the report kwarg of
+    fetch_related (or a callable, which is then called with a new
+    FetchRelatedReport at the end of the call). The report is filled in and
+    returned by the call.
+
+    With dry_run=True, fetch_related plans the queries for the first depth,
+    prints them and stores them in the returned report's planned_queries,
+    but doesn't execute them (the queries for the deeper levels depend on
+    the results of the first one, so they can't be planned without running
+    it). Nothing is attached to the objs.
+
+    stats holds a dict of stats for each (depth, document_class) in the
+    order they were encountered:
+    - requested_ids: number of distinct IDs referenced by the objects
+    - cached_ids: number of those IDs served from the cache_map (or from
+      objects fetched earlier in the same call)
+    - queries: number of queries issued
+    - documents: number of documents returned by the queries
+    - missing_ids: number of IDs that were queried but not found, i.e.
+      dangling references (or references filtered out by extra_filters)
+    - inflight_ids: number of IDs that were being fetched by another thread
+      and waited for (see the single_flight kwarg of fetch_related)
+    - query_time: total time spent in the queries, in seconds. If they were
+      issued concurrently, this can be more than the wall time of the call.
+
+    wall_time is the total duration of the call, in seconds. planned_queries
+    lists the queries planned in a dry run.
+    """
+
+    def __init__(self):
+        self.stats = OrderedDict()
+        self.planned_queries = []
+        self.wall_time = None
+
+    def get_stats(self, depth, document_class):
+        key = (depth, document_class)
+        if key not in self.stats:
+            self.stats[key] = {
+                'requested_ids': 0,
+                'cached_ids': 0,
+                'queries': 0,
+                'documents': 0,
+                'missing_ids': 0,
+                'inflight_ids': 0,
+                'query_time': 0.0,
+            }
+        return self.stats[key]
+
+    @property
+    def queries(self):
+        return sum(stats['queries'] for stats in self.stats.values())
+
+    def add_planned_query(
+        self, depth, document_class, collection_name, query, projection
+    ):
+        self.planned_queries.append(
+            {
+                'depth': depth,
+                'document_class': document_class,
+                'collection': collection_name,
+                'filter': query,
+                'projection': projection,
+            }
+        )
+
+    def print_planned_queries(self):
+        print('-' * 80)
+        for planned in self.planned_queries:
+            # don't flood the output with the IDs
+            query = dict(
+                planned['filter'],
+                _id={'$in': '<%d ids>' % len(planned['filter']['_id']['$in'])},
+            )
+            print(
+                '[depth {}] {} [find] {} {}'.format(
+                    planned['depth'],
+                    planned['collection'],
+                    query,
+                    planned['projection'] or '',
+                )
+            )
+        print('-' * 80)
+
+    def __str__(self):
+        lines = []
+        for (depth, document_class), stats in self.stats.items():
+            lines.append(
+                '[depth %d] %s: %d requested, %d cached, %d queries, '
+                '%d documents, %d missing, %.1fms'
+                % (
+                    depth,
+                    document_class.__name__,
+                    stats['requested_ids'],
+                    stats['cached_ids'],
+                    stats['queries'],
+                    stats['documents'],
+                    stats['missing_ids'],
+                    stats['query_time'] * 1000,
+                )
+            )
+        if self.wall_time is not None:
+            lines.append('Total: %.1fms' % (self.wall_time * 1000))
+        return '\n'.join(lines)
+
+
+def _start_report(report, dry_run):
+    """
+    Return the FetchRelatedReport to fill in for the given report kwarg of
+    fetch_related, along with the hook to call with it (if any).
+    """
+    if report is not None and not isinstance(report, FetchRelatedReport):
+        return FetchRelatedReport(), report
+    if report is None and dry_run:
+        return FetchRelatedReport(), None
+    return report, None
+
+
+def _finish_report(report, report_hook, start_time):
+    """Finish the fetch_related report and pass it to the hook, if any."""
+    if report is None:
+        return None
+    report.wall_time = time.monotonic() - start_time
+    if report_hook is not None:
+        report_hook(report)
+    return report
+
+
+def fetch_reverse_related(
+    objs,
+    child_class,
+    field_name,
+    attr_name,
+    cache_map=None,
+    extra_filters=None,
+    batch_size=100,
+    filter_func=None,
+    fields_to_fetch=None,
+    order_by=None,
+):
+    """
+    Fetches the children referencing the given parent document instances
+    (i.e. the reverse, one-to-many side of a reference) and attaches them to
+    each parent as a list. Sample usage:
+
+    fetch_reverse_related(leads, Contact, 'lead', 'contacts')
+
+    In this sample, the contacts of all leads are fetched in batched
+    {'lead': {'$in': [...]}} queries and each lead gets a `contacts` list
+    attribute. The field_name can be a ReferenceField or a ListField of
+    references of the child_class, in which case a child is attached to
+    each of the parents it references.
+
+    Like in fetch_related, the parent IDs are queried in batches of
+    batch_size, fully fetched children are added to the cache_map (if one is
+    given), the extra_filters of the child_class (in the same
+    {document_class: filters} form, e.g. a shard key filter) are passed to
+    the QuerySet and filter_func (defaults to child_class.objects.filter) can
+    be used to fetch and filter the children. fields_to_fetch limits the
+    fetched fields of the children (the field_name is always fetched too)
+    and order_by is applied to their QuerySet, which determines the order of
+    each parent's list.
+
+    The reference from each child to its parent is set to the parent object,
+    so accessing it doesn't trigger another query.
+    """
+    if not objs:
+        return
+
+    cls_filters = (extra_filters or {}).get(child_class, {})
+
+    if filter_func is None:
+        filter_func = child_class.objects.filter
+
+    field = child_class._fields[field_name]
+    db_field = child_class._db_field_map.get(field_name, field_name)
+    if isinstance(field, ListField) and isinstance(field.field, ReferenceField):
+        ref_field = field.field
+    elif isinstance(field, ReferenceField):
+        ref_field = field
+    else:
+        raise NotImplementedError(
+            '%s class not supported for fetch_reverse_related'
+            % field.__class__.__name__
+        )
+
+    cache_children = fields_to_fetch is None and cache_map is not None
+    if cache_children:
+        cache_map.setdefault(child_class, {})
+
+    parents_by_pk = {}
+    for obj in objs:
+        setattr(obj, attr_name, [])
+        if obj.pk is not None:
+            parents_by_pk[obj.pk] = obj
+
+    for pk_group in grouper(batch_size, list(parents_by_pk)):
+        qs = filter_func(
+            **dict(cls_filters, **{field_name + '__in': pk_group})
+        ).clear_cls_query()
+        if fields_to_fetch:
+            # the reference to the parents is needed to attach the children
+            qs = qs.only(*set(fields_to_fetch) | {field_name})
+        if order_by:
+            qs = qs.order_by(*order_by)
+
+        for child in iter_no_cache(qs):
+            if cache_children:
+                cache_map[child_class][child.pk] = child
+
+            # we need to use _db_data because touching the reference would
+            # trigger a query for safe references
+            parent_ids = child._db_data.get(db_field)
+            if ref_field is field:
+                parent_ids = [parent_ids]
+            for parent_id in parent_ids or []:
+                parent = parents_by_pk.get(_id_from_value(ref_field, parent_id))
+                if parent is None:
+                    continue
+                getattr(parent, attr_name).append(child)
+                if ref_field is field:
+                    _setattr_unchanged(child, field_name, parent)
+
+
+# Prefix of the fields holding the related documents joined by $lookup
+_LOOKUP_PREFIX = '_lookup_'
+
+
+def lookup_related(query_set, field_dict, cache_map=None):
+    """
+    Iterate over a MongoEngine QuerySet without caching it, joining the
+    related objects on the server with $lookup. Sample usage:
+
+    for contact in lookup_related(Contact.objects.filter(...), {
+        'lead': True,
+        'owner': ['id', 'name'],
+    }):
+        ...
+
+    The QuerySet (its filter, ordering, skip, limit and loaded fields) is
+    turned into an aggregation pipeline with a $lookup stage per field, so
+    the documents and all their related objects are fetched in a single
+    round trip, rather than one for the documents plus one per related
+    document class with fetch_related. The related objects are then attached
+    the same way fetch_related attaches them. The fields to fetch (e.g.
+    ['id', 'name'] above) are picked from the joined documents (the
+    top-level field is kept for any embedded fields), so the whole related
+    documents are still sent over the wire.
+
+    It pays off on high-latency links. However, the related objects are
+    sent once per document referencing them (and each document along with
+    its related objects has to fit into 16MB), so the batched queries of
+    fetch_related (which remain the default of iter_fetch_related) are
+    cheaper when many documents reference the same objects.
+
+    Only one level of references to collections in the same database can be
+    joined: the field_dict can't contain sub-dicts or dotted paths, and only
+    ReferenceFields and ListFields of references (without dbrefs) are
+    supported, and ListFields require MongoDB 3.4+ (whose $lookup matches
+    the elements of an array). extra_filters and the other options of
+    fetch_related don't apply here.
+
+    Documents are pulled in batches of the QuerySet's batch size (1000 by
+    default) and the same related object is attached as the same instance
+    within a batch. If a cache_map is given, fully fetched related objects
+    are added to it, and objects which are already in it are reused.
+    """
+    document_class = query_set._document
+    if not isinstance(field_dict, FetchRelatedPlan):
+        field_dict = FetchRelatedPlan(field_dict)
+    root = field_dict.root
+    if root.embedded or any(
+        isinstance(sub_field_dict, _PlanNode)
+        for sub_field_dict in root.field_dict.values()
+    ):
+        raise ValueError(
+            'Only one level of related objects can be fetched with $lookup'
+        )
+    infos = list(root.resolve(document_class).values())
+
+    _check_forbidden_queries(query_set)
+    collection = _get_collection(query_set)
+    if any(
+        info.kind == _REFERENCE_LIST for info in infos
+    ) and _get_server_version(collection) < (3, 4):
+        raise NotImplementedError(
+            'Joining ListFields of references requires MongoDB 3.4+'
+        )
+
+    pipeline = [{'$match': query_set._query}]
+    if query_set._ordering:
+        pipeline.append({'$sort': SON(query_set._ordering)})
+    if query_set._skip:
+        pipeline.append({'$skip': query_set._skip})
+    if query_set._limit:
+        pipeline.append({'$limit': query_set._limit})
+    if query_set._loaded_fields:
+        projection = query_set._loaded_fields.as_dict()
+        # make sure the references are loaded along with the other fields
+        if any(projection.values()):
+            projection.update((info.db_field, 1) for info in infos)
+        pipeline.append({'$project': projection})
+
+    for info in infos:
+        pipeline.extend(_get_lookup_stages(collection, info))
+
+    batch_size = query_set._batch_size or 1000
+    cursor = collection.aggregate(pipeline, batchSize=batch_size)
+    return _iter_lookup_batches(
+        cursor, document_class, infos, batch_size, cache_map
+    )
+
+
+def _get_lookup_stages(collection, info):
+    """Return the pipeline stages joining the related objects of a field."""
+    if info.kind in (_REFERENCE, _SAFE_REFERENCE):
+        ref_field = info.field
+    elif info.kind == _REFERENCE_LIST:
+        ref_field = info.field.field
+    else:
+        raise NotImplementedError(
+            '%s class not supported for $lookup' % info.field.__class__.__name__
+        )
+    if ref_field.dbref:
+        raise NotImplementedError('References with dbrefs cannot be joined')
+
+    related_class = info.document_class
+    related_collection = related_class._get_collection()
+    if related_collection.database.name != collection.database.name:
+        raise ValueError(
+            'Cannot join %s from another database' % related_class.__name__
+        )
+
+    return [
+        {
+            '$lookup': {
+                'from': related_collection.name,
+                'localField': info.db_field,
+                'foreignField': '_id',
+                'as': _LOOKUP_PREFIX + info.db_field,
+            }
+        }
+    ]
+
+
+def _get_server_version(collection):
+    """Return the (major, minor) version of the server of a collection."""
+    return tuple(collection.database.client.server_info()['versionArray'][:2])
+
+
+def _iter_lookup_batches(cursor, document_class, infos, batch_size, cache_map):
+    """
+    Hydrate the documents returned by a lookup_related pipeline along with
+    their joined related objects, and attach them, a batch at a time.
+    """
+    while True:
+        sons = list(islice(cursor, batch_size))
+        if not sons:
+            return
+
+        # related objects of the batch, by (document class, fields to fetch)
+        related_maps = {}
+
+        # db fields to keep in the partially fetched related objects, by
+        # field (the projection isn't done on the server, since the $map
+        # expression it needs requires MongoDB 3.4+)
+        joined_fields = {
+            info.db_field: _get_joined_fields(info)
+            for info in infos
+            if info.fields_to_fetch is not None
+        }
+        objs = []
+        for son in sons:
+            for info in infos:
+                key = (info.document_class, info.fields_to_fetch)
+                pk_to_obj = related_maps.setdefault(key, {})
+                related_sons = son.pop(_LOOKUP_PREFIX + info.db_field, ())
+                for related_son in related_sons:
+                    pk = related_son['_id']
+                    if pk not in pk_to_obj:
+                        if info.db_field in joined_fields:
+                            related_son = {
+                                key: value
+                                for key, value in related_son.items()
+                                if key in joined_fields[info.db_field]
+                            }
+                        pk_to_obj[pk] = _get_joined_obj(
+                            info, related_son, cache_map
                         )
+            objs.append(document_class._from_son(son))
+
+        for info in infos:
+            _attach_related(
+                objs,
+                info,
+                lambda related_class, info=info: related_maps[
+                    (related_class, info.fields_to_fetch)
+                ],
+            )
+
+        for obj in objs:
+            yield obj
+
+
+def _get_joined_fields(info):
+    """Return the db fields to keep in the related objects of a field."""
+    related_class = info.document_class
+    db_fields = {'_id'}
+    for field_name in info.fields_to_fetch:
+        field_name = field_name.split('.', 1)[0]
+        db_fields.add(related_class._db_field_map.get(field_name, field_name))
+    return db_fields
+
+
+def _get_joined_obj(info, related_son, cache_map):
+    """
+    Return the related object for a document joined by lookup_related,
+    caching full objects in the cache_map.
+    """
+    related_class = info.document_class
+    if info.fields_to_fetch is not None or cache_map is None:
+        return related_class._from_son(related_son)
+
+    class_cache = cache_map.setdefault(related_class, {})
+    obj = class_cache.get(related_son['_id'])
+    if obj is None:
+        obj = related_class._from_son(related_son)
+        class_cache[obj.pk] = obj
+    return obj
+
+
+# Kinds of fields supported by fetch_related
+_GENERIC_REFERENCE = 'generic_reference'
+_GENERIC_REFERENCE_LIST = 'generic_reference_list'
+_SAFE_REFERENCE = 'safe_reference'
+_REFERENCE = 'reference'
+_REFERENCE_LIST = 'reference_list'
+_REFERENCE_DICT = 'reference_dict'
+
+# Resolved field from a fetch_related field_dict:
+# - name of the field
+# - field instance
+# - name of the field in the db
+# - kind of the field (one of the constants above)
+# - document class (None for generic references)
+# - frozenset of fields to fetch (or None if the whole related obj should be
+#   fetched)
+# - _PlanNode for the sub-dict of the field (or None if there's no sub-dict)
+_FieldInfo = namedtuple(
+    '_FieldInfo',
+    [
+        'name',
+        'field',
+        'db_field',
+        'kind',
+        'document_class',
+        'fields_to_fetch',
+        'sub_node',
+    ],
+)
+
+
+class FetchRelatedPlan(object):
+    """
+    A field_dict compiled for fetch_related, which can be executed many
+    times. Sample usage:
+
+    CONTACT_PLAN = FetchRelatedPlan(
+        {'lead': {'created_by': True}, 'owner': ['id', 'name']}, Contact
+    )
+
+    def get_contacts(...):
+        contacts = list(Contact.objects.filter(...))
+        CONTACT_PLAN.execute(contacts, cache_map=cache_map)
+
+    Besides ReferenceFields and ListFields of references, MapFields and
+    DictFields of references are supported, as well as GenericReferenceFields
+    (and ListFields of them), whose references are grouped by their document
+    class so that there's one batched query set per class. References nested
+    in embedded documents can be fetched with dotted paths, e.g.
+    'contacts.owner' fetches the owner reference of each embedded document
+    in the contacts field, which can be an EmbeddedDocumentField, or a
+    ListField, MapField or DictField of EmbeddedDocumentFields.
+
+    If the same document class is requested with different fields on the
+    same depth (e.g. {'user': ['id'], 'created_by': ['id', 'name']}), a
+    union of the requested fields is fetched in one query, and if any of the
+    fields asks for the whole object (e.g. {'user': ['id'], 'created_by':
+    True}), the whole objects are fetched.
+
+    On each call, fetch_related resolves its field_dict: it splits the
+    dotted paths, looks up the fields in the document classes of the objs
+    and figures out how to read and attach their references. A plan does
+    it once per document class and caches the result, which adds up for
+    hot endpoints that prefetch the same field_dict for small pages of
+    documents.
+
+    The field_dict is resolved eagerly for the given document classes (and
+    the related and embedded document classes reachable from them), so any
+    unsupported field raises at compile time. Other document classes are
+    resolved the first time they're encountered.
+
+    A plan can be passed anywhere a field_dict is expected (fetch_related,
+    iter_fetch_related, prefetch_related, async_fetch_related).
+    execute(objs, **kwargs) is a shortcut for fetch_related(objs, plan,
+    **kwargs).
+    """
+
+    def __init__(self, field_dict, *document_classes):
+        self.field_dict = field_dict
+        self.root = _PlanNode(field_dict)
+        for document_class in document_classes:
+            self.root.compile(document_class)
+
+    def execute(self, objs, **kwargs):
+        return fetch_related(objs, self, **kwargs)
+
+    def __repr__(self):
+        return '<%s: %r>' % (self.__class__.__name__, self.field_dict)
+
+
+class _PlanNode(object):
+    """
+    A compiled (sub-)dict of a FetchRelatedPlan.
+
+    field_dict contains the fields of the dict without dotted paths, with
+    sub-dicts replaced by their _PlanNodes. The dotted paths are grouped by
+    their first field, i.e. by the embedded documents they're nested in, in
+    the embedded dict in the form of {field_name: _PlanNode}.
+    """
+
+    def __init__(self, field_dict):
+        self.field_dict = {}
+        nested_field_dicts = {}
+        for field_name, sub_field_dict in field_dict.items():
+            if '.' in field_name:
+                field_name, path = field_name.split('.', 1)
+                nested_field_dicts.setdefault(field_name, {})[
+                    path
+                ] = sub_field_dict
+            elif isinstance(sub_field_dict, dict):
+                self.field_dict[field_name] = _PlanNode(sub_field_dict)
+            else:
+                self.field_dict[field_name] = sub_field_dict
+
+        self.embedded = {
+            field_name: _PlanNode(nested_field_dict)
+            for field_name, nested_field_dict in nested_field_dicts.items()
+        }
+
+        # resolved {field_name: _FieldInfo} by document class
+        self._infos_by_class = {}
+
+    def resolve(self, document_class):
+        """
+        Return the _FieldInfos of the fields of this node contained in the
+        given document class, in the form of {field_name: _FieldInfo}.
+        """
+        infos = self._infos_by_class.get(document_class)
+        if infos is None:
+            infos = {}
+            for field_name, sub_field_dict in self.field_dict.items():
+                field = document_class._fields.get(field_name)
+                if field is not None:
+                    infos[field_name] = _resolve_field(
+                        document_class, field_name, field, sub_field_dict
                     )
-                    setattr_unchanged(obj, field_name, value)
+            self._infos_by_class[document_class] = infos
+        return infos
+
+    def get_field_infos(self, objs):
+        """
+        Return a list of (objs, _FieldInfo) pairs for the fields of this node
+        contained in the objs. If the objs are of different document classes
+        (e.g. the targets of a GenericReferenceField), they're grouped by
+        class and each group is paired with the fields of its own class,
+        since the same field name can hold different references in each.
+        """
+        objs_by_class = OrderedDict()
+        for obj in objs:
+            objs_by_class.setdefault(obj.__class__, []).append(obj)
+        if len(objs_by_class) == 1:
+            document_class = next(iter(objs_by_class))
+            return [
+                (objs, info) for info in self.resolve(document_class).values()
+            ]
+
+        return [
+            (class_objs, info)
+            for document_class, class_objs in objs_by_class.items()
+            for info in self.resolve(document_class).values()
+        ]
+
+    def compile(self, document_class):
+        """
+        Resolve this node for the given document class, as well as the
+        nodes of the related and embedded document classes.
+        """
+        for info in self.resolve(document_class).values():
+            if info.sub_node is not None and info.document_class is not None:
+                info.sub_node.compile(info.document_class)
+
+        for field_name, node in self.embedded.items():
+            field = document_class._fields.get(field_name)
+            if field is None:
+                continue
+            embedded_field = _get_embedded_field(field)
+            node.compile(embedded_field.document_type)
+
+
+def _split_embedded(pairs):
+    """
+    Given a list of (objs, _PlanNode) pairs, return a list of pairs to fetch
+    the fields of, where the embedded documents of the objs are paired with
+    the nodes of the dotted paths nested in them (e.g. for 'contacts.owner',
+    the embedded documents in the contacts field of the objs are paired with
+    a node fetching their owner).
+    """
+    split_pairs = []
+    for objs, node in pairs:
+        if node.field_dict:
+            split_pairs.append((objs, node))
+
+        for field_name, embedded_node in node.embedded.items():
+            embedded_objs = _get_embedded_objs(objs, field_name)
+            if embedded_objs:
+                split_pairs.extend(
+                    _split_embedded([(embedded_objs, embedded_node)])
+                )
+
+    return split_pairs
+
+
+def _get_embedded_field(field):
+    """
+    Return the EmbeddedDocumentField of the given field, which can be an
+    EmbeddedDocumentField, or a ListField, MapField or DictField of
+    EmbeddedDocumentFields.
+    """
+    if isinstance(field, (ListField, DictField)):
+        embedded_field = field.field
+    else:
+        embedded_field = field
+    if not isinstance(embedded_field, EmbeddedDocumentField):
+        raise NotImplementedError(
+            '%s class not supported in fetch_related paths'
+            % field.__class__.__name__
+        )
+    return embedded_field
+
+
+def _get_embedded_objs(objs, field_name):
+    """
+    Return a list of embedded documents stored in the given field of the
+    objs.
+    """
+    embedded_objs = []
+    for obj in objs:
+        field = obj.__class__._fields.get(field_name)
+        if field is None:
+            continue  # This object doesn't contain this field
+
+        _get_embedded_field(field)
+
+        value = getattr(obj, field_name, None)
+        if not value:
+            continue
+        if isinstance(field, ListField):
+            embedded_objs.extend(item for item in value if item is not None)
+        elif isinstance(field, DictField):
+            embedded_objs.extend(
+                item for item in value.values() if item is not None
+            )
+        else:
+            embedded_objs.append(value)
+
+    return embedded_objs
+
+
+def _resolve_field(document_class, field_name, field, sub_field_dict):
+    """Resolve a field of the given document class into a _FieldInfo."""
+    db_field = document_class._db_field_map.get(field_name, field_name)
+    if isinstance(field, GenericReferenceField):
+        # the document class is stored along with each reference
+        kind, related_class = _GENERIC_REFERENCE, None
+    elif isinstance(field, ListField) and isinstance(
+        field.field, GenericReferenceField
+    ):
+        kind, related_class = _GENERIC_REFERENCE_LIST, None
+    elif isinstance(field, SafeReferenceField):
+        kind, related_class = _SAFE_REFERENCE, field.document_type
+    elif isinstance(field, ListField) and isinstance(
+        field.field, ReferenceField
+    ):
+        # includes SafeReferenceListFields
+        kind, related_class = _REFERENCE_LIST, field.field.document_type
+    elif isinstance(field, DictField) and isinstance(
+        field.field, ReferenceField
+    ):
+        # includes MapFields of references
+        kind, related_class = _REFERENCE_DICT, field.field.document_type
+    elif isinstance(field, ReferenceField):
+        kind, related_class = _REFERENCE, field.document_type
+    else:
+        raise NotImplementedError(
+            '%s class not supported for fetch_related'
+            % field.__class__.__name__
+        )
+    fields_to_fetch = (
+        frozenset(sub_field_dict)
+        if isinstance(sub_field_dict, (list, tuple))
+        else None
+    )
+    sub_node = sub_field_dict if isinstance(sub_field_dict, _PlanNode) else None
+    return _FieldInfo(
+        field_name,
+        field,
+        db_field,
+        kind,
+        related_class,
+        fields_to_fetch,
+        sub_node,
+    )
+
+
+def _get_shard_key(shard_key):
+    """
+    Return a (shard_key_field, get_value) tuple for a shard_keys value of
+    fetch_related.
+    """
+    if isinstance(shard_key, tuple):
+        return shard_key
+    return shard_key, lambda obj: getattr(obj, shard_key, None)
+
+
+def _id_from_value(field, val):
+    if field.dbref:
+        return val.id
+    else:
+        return val
+
+
+def _get_ids_to_fetch(objs, info):
+    """
+    Return a dict of IDs referenced by the given field of the objs, in the
+    form of {document_class: set_of_ids}.
+    """
+    field_name, field, db_field, kind = (
+        info.name,
+        info.field,
+        info.db_field,
+        info.kind,
+    )
+    objs = _get_objs_with_field(objs, field_name)
+
+    # we need to use _db_data for safe references because touching their
+    # pks triggers a query
+    if kind == _SAFE_REFERENCE:
+        ids = {
+            _id_from_value(field, obj._db_data.get(db_field, None))
+            for obj in objs
+            if field_name not in obj._internal_data
+            and obj._db_data.get(db_field, None)
+        }
+    elif kind in (_GENERIC_REFERENCE, _GENERIC_REFERENCE_LIST):
+        # generic references are grouped by the document class stored in
+        # the _cls of each reference
+        ids_by_class = {}
+        for obj in objs:
+            if field_name in obj._internal_data:
+                continue
+            values = obj._db_data.get(db_field) or []
+            if kind == _GENERIC_REFERENCE:
+                values = [values]
+            for val in values:
+                if val:
+                    document_class, pk = _class_and_id_from_generic_value(val)
+                    ids_by_class.setdefault(document_class, set()).add(pk)
+        return ids_by_class
+    elif kind == _REFERENCE_LIST:
+        ids = [
+            obj._db_data.get(db_field, [])
+            for obj in objs
+            if field_name not in obj._internal_data
+        ]
+        ids = {
+            _id_from_value(field.field, item)
+            for sublist in ids
+            for item in sublist
+        }  # flatten the list of lists
+    elif kind == _REFERENCE_DICT:
+        ids = {
+            _id_from_value(field.field, item)
+            for obj in objs
+            if field_name not in obj._internal_data
+            for item in (obj._db_data.get(db_field) or {}).values()
+        }
+    elif kind == _REFERENCE:
+        ids = {
+            getattr(obj, field_name).pk
+            for obj in objs
+            if getattr(obj, field_name, None)
+            and getattr(getattr(obj, field_name), '_lazy', False)
+        }
+
+    return {info.document_class: ids}
+
+
+def _class_and_id_from_generic_value(val):
+    """
+    Return the document class and the ID of a generic reference stored in
+    the db in the form of {'_cls': 'ClassName', '_ref': DBRef(...)}.
+    """
+    return get_document(val['_cls']), val['_ref'].id
+
+
+def _get_objs_with_field(objs, field_name):
+    """Filter out objects whose class doesn't contain the given field."""
+    return [obj for obj in objs if field_name in obj.__class__._fields]
+
+
+def _setattr_unchanged(obj, key, val):
+    """
+    Sets an attribute on the given document object without changing the
+    _changed_fields set. This is because we don't actually modify the
+    related objects.
+    """
+    changed = key in obj._changed_fields
+    setattr(obj, key, val)
+    if not changed and key in obj._changed_fields:
+        obj._changed_fields.remove(key)
+
+
+def _attach_related(objs, info, get_pk_to_obj):
+    """
+    Attach the related objects to the given field of the objs. The related
+    objects are looked up in the pk_to_obj mapping returned by
+    get_pk_to_obj(document_class). Returns a list of the attached related
+    objects (without duplicates).
+    """
+    field_name, field, db_field, kind = (
+        info.name,
+        info.field,
+        info.db_field,
+        info.kind,
+    )
+    objs = _get_objs_with_field(objs, field_name)
+    related_objs = {}
+
+    if info.document_class is not None:
+        pk_to_obj = get_pk_to_obj(info.document_class)
+    else:
+        pk_to_obj_by_class = {}
+
+        def get_generic_obj(val):
+            document_class, pk = _class_and_id_from_generic_value(val)
+            if document_class not in pk_to_obj_by_class:
+                pk_to_obj_by_class[document_class] = get_pk_to_obj(
+                    document_class
+                )
+            return pk_to_obj_by_class[document_class].get(pk)
+
+    # attach all the values to all the objects
+    if kind == _GENERIC_REFERENCE:
+        for obj in objs:
+            if field_name not in obj._internal_data:
+                val = obj._db_data.get(db_field, None)
+                if val:
+                    rel_obj = get_generic_obj(val)
+                    if rel_obj is not None:
+                        _setattr_unchanged(obj, field_name, rel_obj)
+                        related_objs[id(rel_obj)] = rel_obj
+
+    elif kind == _GENERIC_REFERENCE_LIST:
+        for obj in objs:
+            if field_name not in obj._internal_data:
+                value = list(
+                    filter(
+                        None,
+                        [
+                            get_generic_obj(val)
+                            for val in obj._db_data.get(db_field) or []
+                            if val
+                        ],
+                    )
+                )
+                _setattr_unchanged(obj, field_name, value)
+                related_objs.update((id(rel_obj), rel_obj) for rel_obj in value)
+
+    elif kind == _SAFE_REFERENCE:
+        for obj in objs:
+            if field_name not in obj._internal_data:
+                val = obj._db_data.get(db_field, None)
+                if val:
+                    rel_obj = pk_to_obj.get(_id_from_value(field, val))
+                    _setattr_unchanged(obj, field_name, rel_obj)
+                    if rel_obj is not None:
+                        related_objs[id(rel_obj)] = rel_obj
+
+    elif kind == _REFERENCE:
+        for obj in objs:
+            val = getattr(obj, field_name, None)
+            if val and getattr(val, '_lazy', False):
+                rel_obj = pk_to_obj.get(val.pk)
+                if rel_obj:
+                    _setattr_unchanged(obj, field_name, rel_obj)
+                    related_objs[id(rel_obj)] = rel_obj
+
+    elif kind == _REFERENCE_LIST:
+        for obj in objs:
+            if field_name not in obj._internal_data:
+                value = list(
+                    filter(
+                        None,
+                        [
+                            pk_to_obj.get(_id_from_value(field.field, val))
+                            for val in obj._db_data.get(db_field, [])
+                        ],
+                    )
+                )
+                _setattr_unchanged(obj, field_name, value)
+                related_objs.update((id(rel_obj), rel_obj) for rel_obj in value)
+
+    elif kind == _REFERENCE_DICT:
+        for obj in objs:
+            if field_name not in obj._internal_data:
+                value = {}
+                for key, val in (obj._db_data.get(db_field) or {}).items():
+                    rel_obj = pk_to_obj.get(_id_from_value(field.field, val))
+                    if rel_obj:
+                        value[key] = rel_obj
+                _setattr_unchanged(obj, field_name, value)
+                related_objs.update(
+                    (id(rel_obj), rel_obj) for rel_obj in value.values()
+                )
+
+    return list(related_objs.values())
@@ -24,5 +24,7 @@ setup(
         'cryptography',
         'padding',
         'pytest',
+        'numpy',
     ],
+    extras_require={'numpy': ['numpy']},
 )
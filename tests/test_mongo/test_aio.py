@@ -0,0 +1,173 @@
+import asyncio
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from mongoengine import Document, IntField, ReferenceField, StringField
+
+from flask_common.mongo.aio import (
+    ThreadPoolCollection,
+    async_fetch_related,
+    async_iter_no_cache,
+)
+from flask_common.mongo.query_counters import custom_query_counter
+from flask_common.mongo.utils import FetchRelatedReport
+
+
+class AsyncTestCase(unittest.TestCase):
+    def setUp(self):
+        super(AsyncTestCase, self).setUp()
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.get_collection = ThreadPoolCollection.factory(self.executor)
+
+    def tearDown(self):
+        super(AsyncTestCase, self).tearDown()
+        self.executor.shutdown()
+        self.loop.close()
+
+    def run_async(self, coro):
+        return self.loop.run_until_complete(coro)
+
+
+class AsyncIterNoCacheTestCase(AsyncTestCase):
+    def test_iter_no_cache(self):
+        class D(Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i).save()
+
+        async def collect(qs):
+            values = []
+            async for d in async_iter_no_cache(
+                qs, get_collection=self.get_collection
+            ):
+                values.append(d.i)
+            return values
+
+        self.assertEqual(
+            sorted(self.run_async(collect(D.objects.batch_size(3)))),
+            list(range(10)),
+        )
+        self.assertEqual(
+            self.run_async(
+                collect(D.objects.filter(i__gte=5).order_by('-i').limit(3))
+            ),
+            [9, 8, 7],
+        )
+
+    def test_early_exit(self):
+        class D(Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i).save()
+
+        async def get_first(qs):
+            async with async_iter_no_cache(
+                qs, get_collection=self.get_collection
+            ) as docs:
+                async for d in docs:
+                    return docs, d.i
+
+        docs, i = self.run_async(
+            get_first(D.objects.order_by('i').batch_size(2))
+        )
+        self.assertEqual(i, 0)
+
+        # the cursor is closed even though it wasn't exhausted
+        self.assertFalse(docs.cursor.cursor.alive)
+
+
+class AsyncFetchRelatedTestCase(AsyncTestCase):
+    def setUp(self):
+        super(AsyncFetchRelatedTestCase, self).setUp()
+
+        class User(Document):
+            name = StringField()
+
+        class Lead(Document):
+            name = StringField()
+            created_by = ReferenceField(User)
+
+        class Contact(Document):
+            lead = ReferenceField(Lead)
+            owner = ReferenceField(User)
+
+        User.drop_collection()
+        Lead.drop_collection()
+        Contact.drop_collection()
+
+        self.user1 = User.objects.create(name='u1')
+        self.user2 = User.objects.create(name='u2')
+        self.lead = Lead.objects.create(name='l1', created_by=self.user1)
+        self.contact = Contact.objects.create(lead=self.lead, owner=self.user2)
+
+        self.Contact = Contact
+        self.User = User
+
+    def test_fetch_related(self):
+        contact = self.Contact.objects.get(pk=self.contact.pk)
+        cache_map = {}
+        report = FetchRelatedReport()
+
+        with custom_query_counter() as q:
+            self.run_async(
+                async_fetch_related(
+                    [contact],
+                    {'lead': {'created_by': True}, 'owner': True},
+                    get_collection=self.get_collection,
+                    cache_map=cache_map,
+                    report=report,
+                )
+            )
+            self.assertEqual(q, 3)
+
+            self.assertEqual(contact.lead.name, 'l1')
+            self.assertEqual(contact.lead.created_by.name, 'u1')
+            self.assertEqual(contact.owner.name, 'u2')
+            self.assertEqual(q, 3)
+
+        self.assertEqual(report.queries, 3)
+        self.assertEqual(
+            set(cache_map[self.User]), {self.user1.pk, self.user2.pk}
+        )
+
+    def test_fetch_related_as_dicts(self):
+        contact = self.Contact.objects.get(pk=self.contact.pk)
+        self.run_async(
+            async_fetch_related(
+                [contact],
+                {'owner': ['name']},
+                get_collection=self.get_collection,
+                as_dicts=True,
+            )
+        )
+        self.assertEqual(contact.owner, {'_id': self.user2.pk, 'name': 'u2'})
+
+    def test_fetch_related_without_sync_collection(self):
+        contact = self.Contact.objects.get(pk=self.contact.pk)
+        collection = ThreadPoolCollection(
+            self.User._get_collection(), self.executor
+        )
+
+        # the queries are built without touching the sync collection, which
+        # isn't needed with an async driver
+        self.User._get_collection = classmethod(
+            lambda cls: self.fail('sync collection used')
+        )
+        try:
+            self.run_async(
+                async_fetch_related(
+                    [contact],
+                    {'owner': True},
+                    get_collection=lambda document_class: collection,
+                )
+            )
+        finally:
+            del self.User._get_collection
+        self.assertEqual(contact.owner.name, 'u2')
@@ -0,0 +1,56 @@
+import unittest
+
+from flask_common.mongo.batching import AdaptiveBatchSize
+
+
+class User(object):
+    pass
+
+
+class Lead(object):
+    pass
+
+
+class AdaptiveBatchSizeTestCase(unittest.TestCase):
+    def test_growth(self):
+        batch_size = AdaptiveBatchSize(initial_size=10, max_size=100)
+        self.assertEqual(batch_size.get_size(User), 10)
+
+        # fast and small batches double the size up to max_size
+        for expected_size in (20, 40, 80, 100, 100):
+            batch_size.record(User, batch_size.get_size(User), 100, 0.001)
+            self.assertEqual(batch_size.get_size(User), expected_size)
+
+        # sizes are tracked by key
+        self.assertEqual(batch_size.get_size(Lead), 10)
+        self.assertEqual(batch_size.sizes, {User: 100})
+        stats = batch_size.stats[User]
+        self.assertEqual(stats['batches'], 5)
+        self.assertEqual(stats['documents'], 250)
+        self.assertEqual(stats['bytes'], 500)
+        self.assertAlmostEqual(stats['time'], 0.005)
+
+    def test_targets(self):
+        batch_size = AdaptiveBatchSize(
+            initial_size=100, target_bytes=1000, target_time=1
+        )
+
+        # 100 bytes per document
+        batch_size.record(User, 100, 10000, 0.1)
+        self.assertEqual(batch_size.get_size(User), 10)
+
+        # 50ms per document
+        batch_size.record(User, 10, 100, 0.5)
+        self.assertEqual(batch_size.get_size(User), 20)
+
+        # unknown size
+        batch_size.record(User, 20, None, 2)
+        self.assertEqual(batch_size.get_size(User), 10)
+
+        # never below min_size
+        batch_size.record(User, 10, 10**6, 1)
+        self.assertEqual(batch_size.get_size(User), batch_size.min_size)
+
+        # empty batches are ignored
+        batch_size.record(Lead, 0, 0, 1)
+        self.assertEqual(batch_size.sizes, {User: batch_size.min_size})
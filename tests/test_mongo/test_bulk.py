@@ -0,0 +1,134 @@
+import unittest
+
+from mongoengine import (
+    IntField,
+    OperationError,
+    StringField,
+    ValidationError,
+)
+
+from flask_common.mongo.bulk import BulkWriter, BulkWriterError
+from flask_common.mongo.documents import (
+    DocumentBase,
+    RandomPKDocument,
+    SoftDeleteDocument,
+)
+from flask_common.mongo.query_counters import custom_query_counter
+
+
+class BulkWriterTestCase(unittest.TestCase):
+    def setUp(self):
+        super(BulkWriterTestCase, self).setUp()
+
+        class Lead(DocumentBase):
+            name = StringField(unique=True)
+            count = IntField(default=0)
+
+        Lead.drop_collection()
+        Lead.ensure_indexes()
+        self.leads = [Lead(name=str(i)).save() for i in range(5)]
+        self.Lead = Lead
+
+    def test_update(self):
+        date_updated = self.leads[0].date_updated
+        with custom_query_counter() as q:
+            with BulkWriter(batch_size=2) as writer:
+                for lead in self.leads:
+                    writer.update(lead, set__name='x' + lead.name, inc__count=2)
+            # 3 bulk writes, for 2 + 2 + 1 operations
+            self.assertEqual(q, 3)
+
+        self.assertEqual(writer.stats['modified'], 5)
+        lead = self.Lead.objects.get(pk=self.leads[0].pk)
+        self.assertEqual((lead.name, lead.count), ('x0', 2))
+        self.assertTrue(lead.date_updated > date_updated)
+
+    def test_update_without_date(self):
+        date_updated = self.leads[0].date_updated
+        with BulkWriter() as writer:
+            writer.update(self.leads[0], inc__count=1, update_date=False)
+        lead = self.Lead.objects.get(pk=self.leads[0].pk)
+        self.assertEqual(lead.count, 1)
+        self.assertEqual(lead.date_updated, date_updated)
+
+    def test_update_without_params(self):
+        with BulkWriter() as writer:
+            self.assertRaises(OperationError, writer.update, self.leads[0])
+
+    def test_insert_and_delete(self):
+        lead = self.Lead(name='new')
+        with BulkWriter() as writer:
+            writer.insert(lead)
+            writer.delete(self.leads[0])
+
+        self.assertTrue(lead.pk)
+        lead = self.Lead.objects.get(pk=lead.pk)
+        self.assertTrue(lead.date_created)
+        self.assertTrue(lead.date_updated)
+        self.assertEqual(self.Lead.objects.count(), 5)
+        self.assertEqual(writer.stats['inserted'], 1)
+        self.assertEqual(writer.stats['deleted'], 1)
+
+    def test_insert_random_pk(self):
+        class Task(DocumentBase, RandomPKDocument):
+            name = StringField()
+
+        Task.drop_collection()
+        task = Task(name='t')
+        with BulkWriter() as writer:
+            writer.insert(task)
+
+        # the id is generated like in RandomPKDocument.save
+        self.assertTrue(task.id.startswith('task_'))
+        self.assertEqual(Task.objects.get(pk=task.id).name, 't')
+
+    def test_exception_in_block(self):
+        with custom_query_counter() as q:
+            with self.assertRaises(ValueError):
+                with BulkWriter() as writer:
+                    # would fail on the duplicate name if it was flushed
+                    writer.insert(self.Lead(name='0'))
+                    raise ValueError
+
+            # the buffered operations are discarded
+            self.assertEqual(q, 0)
+        self.assertEqual(writer.errors, [])
+
+    def test_errors(self):
+        with self.assertRaises(BulkWriterError) as ctx:
+            with BulkWriter() as writer:
+                writer.insert(self.Lead(name='0'))
+                writer.insert(self.Lead(name='other'))
+                writer.update(self.leads[1], set__name='1b')
+
+        # the other operations are still done
+        errors = ctx.exception.errors
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0].document.name, '0')
+        self.assertEqual(errors[0].code, 11000)
+        self.assertEqual(self.Lead.objects.filter(name='other').count(), 1)
+        self.assertEqual(self.Lead.objects.filter(name='1b').count(), 1)
+
+    def test_errors_without_raising(self):
+        with BulkWriter(raise_errors=False) as writer:
+            writer.insert(self.Lead(name='0'))
+        self.assertEqual(len(writer.errors), 1)
+
+    def test_soft_delete(self):
+        class Task(DocumentBase, SoftDeleteDocument):
+            name = StringField()
+
+        Task.drop_collection()
+        task = Task(name='t').save()
+
+        with BulkWriter() as writer:
+            writer.delete(task)
+            self.assertRaises(
+                ValidationError, writer.update, task, set__is_deleted=None
+            )
+
+        # the document is only flagged as deleted
+        self.assertEqual(Task.objects.count(), 0)
+        task = Task.all_objects.get(pk=task.pk)
+        self.assertTrue(task.is_deleted)
+        self.assertEqual(writer.stats['deleted'], 0)
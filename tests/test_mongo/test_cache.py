@@ -0,0 +1,219 @@
+import threading
+import unittest
+
+from flask_common.mongo.cache import (
+    BoundedCacheMap,
+    InFlightTimeoutError,
+    PartialCacheMap,
+    PartialDocument,
+    SingleFlight,
+    UnloadedFieldError,
+)
+
+
+class User(object):
+    pass
+
+
+class Lead(object):
+    pass
+
+
+class Contact(object):
+    _fields = {'id': None, 'name': None, 'email': None}
+    _meta = {'id_field': 'id'}
+
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 0
+
+    def __call__(self):
+        return self.now
+
+
+class BoundedCacheMapTestCase(unittest.TestCase):
+    def test_dict_interface(self):
+        cache_map = BoundedCacheMap()
+        cache_map[User] = {1: 'u1'}
+        cache_map[User].update({2: 'u2'})
+
+        self.assertTrue(User in cache_map)
+        self.assertFalse(Lead in cache_map)
+        self.assertEqual(cache_map[User], {1: 'u1', 2: 'u2'})
+        self.assertEqual(set(cache_map[User]), {1, 2})
+        self.assertEqual(cache_map.get(Lead, {}).get(1), None)
+
+    def test_setdefault(self):
+        cache_map = BoundedCacheMap()
+        class_cache = cache_map.setdefault(User, {})
+        class_cache[1] = 'u1'
+
+        # an existing class cache is kept rather than replaced
+        self.assertTrue(cache_map.setdefault(User, {}) is class_cache)
+        self.assertEqual(cache_map[User], {1: 'u1'})
+
+        def fill(i):
+            cache_map.setdefault(Lead, {})[i] = 'l%d' % i
+
+        threads = [threading.Thread(target=fill, args=(i,)) for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(set(cache_map[Lead]), set(range(10)))
+
+    def test_max_entries(self):
+        cache_map = BoundedCacheMap(max_entries={User: 2})
+        cache_map[User] = {1: 'u1', 2: 'u2'}
+        cache_map[Lead] = {1: 'l1', 2: 'l2', 3: 'l3'}
+
+        # touch 1 so that 2 becomes the least recently used user
+        self.assertEqual(cache_map[User][1], 'u1')
+        cache_map[User][3] = 'u3'
+
+        self.assertEqual(set(cache_map[User]), {1, 3})
+        self.assertEqual(len(cache_map[Lead]), 3)
+        self.assertEqual(cache_map.evictions, 1)
+
+    def test_max_bytes(self):
+        cache_map = BoundedCacheMap(max_bytes=30, sizeof=lambda obj: 10)
+        cache_map[User] = {1: 'u1', 2: 'u2'}
+        cache_map[Lead] = {1: 'l1'}
+        self.assertEqual(cache_map.size, 30)
+
+        # the least recently used object is evicted across classes
+        cache_map[Lead][2] = 'l2'
+        self.assertEqual(cache_map.size, 30)
+        self.assertEqual(set(cache_map[User]), {2})
+        self.assertEqual(set(cache_map[Lead]), {1, 2})
+
+    def test_ttl(self):
+        clock = FakeClock()
+        cache_map = BoundedCacheMap(ttl=10, clock=clock)
+        cache_map[User] = {1: 'u1'}
+        clock.now = 5
+        cache_map[User][2] = 'u2'
+
+        clock.now = 10
+        self.assertFalse(1 in cache_map[User])
+        self.assertEqual(cache_map[User], {2: 'u2'})
+
+    def test_hits_and_misses(self):
+        cache_map = BoundedCacheMap()
+        cache_map[User] = {1: 'u1'}
+        self.assertEqual(cache_map[User].get(1), 'u1')
+        self.assertEqual(cache_map[User].get(2), None)
+        self.assertEqual(cache_map[User].get(1), 'u1')
+
+        self.assertEqual(cache_map[User].hits, 2)
+        self.assertEqual(cache_map.hits, 2)
+        self.assertEqual(cache_map.misses, 1)
+
+
+class PartialCacheMapTestCase(unittest.TestCase):
+    def test_subset_lookups(self):
+        cache_map = PartialCacheMap(strict=False)
+        contact = Contact(id=1, name='c1')
+        cache_map.add(Contact, frozenset(['name']), {1: contact})
+
+        self.assertEqual(
+            dict(cache_map.get_objs(Contact, frozenset(['name']))),
+            {1: contact},
+        )
+        self.assertEqual(
+            cache_map.get_objs(Contact, frozenset()).get(1), contact
+        )
+        self.assertFalse(1 in cache_map.get_objs(Contact, frozenset(['email'])))
+        self.assertEqual(len(cache_map.get_objs(User, frozenset())), 0)
+
+    def test_superset_replaces_subsets(self):
+        cache_map = PartialCacheMap(strict=False)
+        cache_map.add(Contact, frozenset(['name']), {1: Contact(id=1)})
+        cache_map.add(Contact, frozenset(['email']), {1: Contact(id=1)})
+        full = Contact(id=1)
+        cache_map.add(Contact, frozenset(['name', 'email']), {1: full})
+
+        self.assertEqual(
+            cache_map._class_caches[Contact][1],
+            [(frozenset(['name', 'email']), full)],
+        )
+        self.assertIs(cache_map.get_objs(Contact, frozenset(['name']))[1], full)
+
+    def test_strict(self):
+        cache_map = PartialCacheMap()
+        contact = Contact(id=1, name='c1', email=None)
+        cache_map.add(Contact, frozenset(['name']), {1: contact})
+
+        partial = cache_map.get_objs(Contact, frozenset(['name']))[1]
+        self.assertTrue(isinstance(partial, PartialDocument))
+        self.assertTrue(isinstance(partial, Contact))
+        self.assertEqual(partial, contact)
+        self.assertEqual(partial.id, 1)
+        self.assertEqual(partial.name, 'c1')
+        self.assertRaises(UnloadedFieldError, getattr, partial, 'email')
+
+        partial.name = 'c2'
+        self.assertEqual(contact.name, 'c2')
+        self.assertRaises(
+            UnloadedFieldError, setattr, partial, 'email', 'c@example.com'
+        )
+
+
+class SingleFlightTestCase(unittest.TestCase):
+    def test_claim(self):
+        single_flight = SingleFlight()
+        claimed, in_flight = single_flight.claim(User, [1, 2])
+        self.assertEqual(claimed, [1, 2])
+        self.assertEqual(in_flight, {})
+
+        claimed, in_flight = single_flight.claim(User, [2, 3])
+        self.assertEqual(claimed, [3])
+        self.assertEqual(list(in_flight), [2])
+
+        # classes are independent
+        self.assertEqual(single_flight.claim(Lead, [1]), ([1], {}))
+
+        # resolved pks can be claimed again
+        user = User()
+        single_flight.resolve(User, [1, 2], {2: user})
+        self.assertEqual(single_flight.wait(in_flight[2]), user)
+        claimed, in_flight = single_flight.claim(User, [1, 2, 3])
+        self.assertEqual(claimed, [1, 2])
+        self.assertEqual(list(in_flight), [3])
+
+    def test_wait(self):
+        single_flight = SingleFlight(timeout=5)
+        single_flight.claim(User, [1])
+        _, in_flight = single_flight.claim(User, [1])
+
+        user = User()
+        thread = threading.Thread(
+            target=single_flight.resolve, args=(User, [1], {1: user})
+        )
+        thread.start()
+        self.assertEqual(single_flight.wait(in_flight[1]), user)
+        thread.join()
+
+    def test_fail(self):
+        single_flight = SingleFlight()
+        single_flight.claim(User, [1, 2])
+        _, in_flight = single_flight.claim(User, [1, 2])
+
+        # missing objects resolve to None
+        single_flight.resolve(User, [1], {})
+        self.assertEqual(single_flight.wait(in_flight[1]), None)
+
+        single_flight.fail(User, [2], ValueError('connection lost'))
+        self.assertRaises(ValueError, single_flight.wait, in_flight[2])
+
+    def test_timeout(self):
+        single_flight = SingleFlight(timeout=0.01)
+        single_flight.claim(User, [1])
+        _, in_flight = single_flight.claim(User, [1])
+        self.assertRaises(
+            InFlightTimeoutError, single_flight.wait, in_flight[1]
+        )
@@ -0,0 +1,116 @@
+import datetime
+import unittest
+
+import numpy as np
+from mongoengine import (
+    BooleanField,
+    DateTimeField,
+    Document,
+    FloatField,
+    IntField,
+    ListField,
+    StringField,
+)
+
+from flask_common.mongo.columnar import export_columns
+
+
+class ExportColumnsTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ExportColumnsTestCase, self).setUp()
+
+        class Opportunity(Document):
+            value = IntField()
+            confidence = FloatField(db_field='c')
+            date_won = DateTimeField()
+            status = StringField()
+            is_active = BooleanField()
+            tags = ListField(StringField())
+
+        Opportunity.drop_collection()
+
+        base = datetime.datetime(2020, 1, 1)
+        for i in range(10):
+            Opportunity.objects.create(
+                value=i * 100,
+                confidence=i / 10 if i != 5 else None,
+                date_won=base + datetime.timedelta(days=i) if i % 2 else None,
+                status=['won', 'lost'][i % 2],
+                is_active=i < 5,
+                tags=['t%d' % i],
+            )
+
+        self.Opportunity = Opportunity
+
+    def test_export(self):
+        columns = export_columns(
+            self.Opportunity.objects.order_by('value'),
+            ['value', 'confidence', 'date_won', 'status', 'is_active', 'tags'],
+            categorical=['status'],
+            batch_size=3,
+        )
+        self.assertEqual(
+            list(columns),
+            ['value', 'confidence', 'date_won', 'status', 'is_active', 'tags'],
+        )
+
+        self.assertEqual(columns['value'].dtype, np.int64)
+        self.assertEqual(columns['value'].sum(), 4500)
+
+        self.assertEqual(columns['confidence'].dtype, np.float64)
+        self.assertTrue(np.isnan(columns['confidence'][5]))
+        self.assertAlmostEqual(columns['confidence'][4], 0.4)
+
+        self.assertEqual(columns['date_won'].dtype, np.dtype('datetime64[ms]'))
+        self.assertTrue(np.isnat(columns['date_won'][0]))
+        self.assertEqual(
+            columns['date_won'][1], np.datetime64('2020-01-02T00:00:00')
+        )
+
+        self.assertEqual(columns['status'].categories.tolist(), ['won', 'lost'])
+        self.assertEqual(columns['status'].codes.tolist(), [0, 1] * 5)
+
+        self.assertEqual(columns['is_active'].dtype, np.bool_)
+        self.assertEqual(columns['is_active'].sum(), 5)
+
+        self.assertEqual(columns['tags'][0], ['t0'])
+
+    def test_missing_ints(self):
+        self.Opportunity.objects.create(status='won')
+        columns = export_columns(
+            self.Opportunity.objects.order_by('value'), ['value'], size_hint=1
+        )
+        self.assertEqual(columns['value'].dtype, np.float64)
+        self.assertEqual(len(columns['value']), 11)
+        self.assertTrue(np.isnan(columns['value'][0]))
+
+    def test_filter(self):
+        columns = export_columns(
+            self.Opportunity.objects.filter(status='won').limit(2), ['pk']
+        )
+        self.assertEqual(len(columns['pk']), 2)
+        self.assertEqual(
+            len(
+                export_columns(
+                    self.Opportunity.objects.filter(status='x'), ['pk']
+                )['pk']
+            ),
+            0,
+        )
+
+    def test_unhashable_categorical(self):
+        self.assertRaises(
+            ValueError,
+            export_columns,
+            self.Opportunity.objects.all(),
+            ['tags'],
+            categorical=['tags'],
+        )
+
+    def test_invalid_field(self):
+        self.assertRaises(
+            ValueError,
+            export_columns,
+            self.Opportunity.objects.all(),
+            ['nope'],
+        )
@@ -0,0 +1,59 @@
+import datetime
+import unittest
+import uuid
+
+from bson import BSON, Code, Int64, ObjectId, Regex, Timestamp
+from bson.codec_options import CodecOptions
+
+from flask_common.mongo.lazy import LazySON
+
+
+class LazySONTestCase(unittest.TestCase):
+    def setUp(self):
+        super(LazySONTestCase, self).setUp()
+        self.codec_options = CodecOptions(uuid_representation=3)
+        self.doc = {
+            '_id': ObjectId(),
+            'float': 1.5,
+            'str': 'h\xe9llo',
+            'doc': {'list': [1, {'nested': 2}]},
+            'list': [1, 2, 3],
+            'binary': b'\x00\x01',
+            'bool': True,
+            'datetime': datetime.datetime(2020, 1, 1),
+            'null': None,
+            'regex': Regex('a.*', 'i'),
+            'code': Code('f()', {'scope': 1}),
+            'int': 5,
+            'timestamp': Timestamp(1, 2),
+            'int64': Int64(2**40),
+            'uuid': uuid.uuid4(),
+        }
+        self.raw = BSON.encode(self.doc, codec_options=self.codec_options)
+
+    def test_decode(self):
+        son = LazySON(self.raw, self.codec_options)
+        self.assertEqual(list(son), list(self.doc))
+        self.assertEqual(len(son), len(self.doc))
+        for key, value in self.doc.items():
+            self.assertEqual(son[key], value)
+        self.assertEqual(dict(son), self.doc)
+        self.assertEqual(son.get('missing'), None)
+        self.assertFalse('missing' in son)
+
+    def test_only_accessed_fields_are_decoded(self):
+        son = LazySON(self.raw, self.codec_options)
+        self.assertEqual(son['str'], 'h\xe9llo')
+        self.assertEqual(son.get('int'), 5)
+        self.assertEqual(set(son._values), {'str', 'int'})
+
+    def test_assignment(self):
+        son = LazySON(self.raw, self.codec_options)
+        son['str'] = 'bye'
+        son['new'] = 1
+        del son['float']
+        self.assertEqual(son['str'], 'bye')
+        self.assertEqual(son['new'], 1)
+        self.assertFalse('float' in son)
+        self.assertEqual(list(son)[-1], 'new')
+        self.assertEqual(len(son), len(self.doc))
@@ -0,0 +1,157 @@
+import unittest
+
+from bson import ObjectId
+from mongoengine import (
+    Document,
+    DoesNotExist,
+    ReferenceField,
+    SafeReferenceField,
+    StringField,
+)
+from sqlalchemy import Column, Integer, String, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+
+from flask_common.db import MongoReference
+from flask_common.mongo.loader import (
+    BatchLoader,
+    BatchLoaderMixin,
+    get_current_loader,
+)
+from flask_common.mongo.query_counters import custom_query_counter
+
+
+class BatchLoaderTestCase(unittest.TestCase):
+    def setUp(self):
+        super(BatchLoaderTestCase, self).setUp()
+
+        class User(Document):
+            name = StringField()
+
+        class Contact(BatchLoaderMixin, Document):
+            owner = ReferenceField(User)
+            safe_owner = SafeReferenceField(User)
+
+        User.drop_collection()
+        Contact.drop_collection()
+
+        self.user1 = User.objects.create(name='u1')
+        self.user2 = User.objects.create(name='u2')
+        Contact.objects.create(owner=self.user1, safe_owner=self.user2)
+        Contact.objects.create(owner=self.user2, safe_owner=self.user1)
+        Contact.objects.create()
+
+        self.User = User
+        self.Contact = Contact
+
+    def test_current_loader(self):
+        self.assertEqual(get_current_loader(), None)
+        with BatchLoader() as loader:
+            self.assertEqual(get_current_loader(), loader)
+            with BatchLoader() as inner_loader:
+                self.assertEqual(get_current_loader(), inner_loader)
+            self.assertEqual(get_current_loader(), loader)
+        self.assertEqual(get_current_loader(), None)
+
+    def test_load(self):
+        with BatchLoader() as loader:
+            loader.queue(self.User, self.user1.pk)
+            with custom_query_counter() as q:
+                self.assertEqual(
+                    loader.load(self.User, self.user2.pk).name, 'u2'
+                )
+                self.assertEqual(
+                    loader.load(self.User, self.user1.pk).name, 'u1'
+                )
+                self.assertEqual(q, 1)
+
+                # pks are normalized, and missing documents are cached too
+                user = loader.load(self.User, str(self.user1.pk))
+                self.assertEqual(user.name, 'u1')
+                self.assertEqual(loader.load(self.User, ObjectId()), None)
+                self.assertEqual(q, 2)
+
+    def test_mixin(self):
+        with BatchLoader():
+            contacts = list(self.Contact.objects.order_by('id'))
+            with custom_query_counter() as q:
+                self.assertEqual(
+                    [c.owner and c.owner.name for c in contacts],
+                    ['u1', 'u2', None],
+                )
+                self.assertEqual(
+                    [c.safe_owner and c.safe_owner.name for c in contacts],
+                    ['u2', 'u1', None],
+                )
+                self.assertEqual(q, 1)
+            self.assertEqual(contacts[0]._changed_fields, [])
+
+    def test_mixin_without_loader(self):
+        contacts = list(self.Contact.objects.order_by('id'))
+        with custom_query_counter() as q:
+            self.assertEqual(
+                [c.owner and c.owner.name for c in contacts],
+                ['u1', 'u2', None],
+            )
+            self.assertEqual(q, 2)
+
+
+class MongoReferenceTestCase(unittest.TestCase):
+    def setUp(self):
+        super(MongoReferenceTestCase, self).setUp()
+
+        class User(Document):
+            name = StringField()
+
+        User.drop_collection()
+        users = [User.objects.create(name='u%d' % i) for i in range(3)]
+
+        Base = declarative_base()
+
+        class Task(Base):
+            __tablename__ = 'task'
+
+            id = Column(Integer, primary_key=True)
+            owner_id = Column(String)
+            owner = MongoReference('owner_id', User)
+            other_owner_id = Column(String)
+            other_owner = MongoReference(
+                'other_owner_id',
+                User,
+                queryset=User.objects.filter(name__ne='u0'),
+            )
+
+        engine = create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        self.session = sessionmaker(bind=engine)()
+        for user in users:
+            self.session.add(
+                Task(owner_id=str(user.pk), other_owner_id=str(user.pk))
+            )
+        self.session.commit()
+
+        self.Task = Task
+
+    def test_batch_loader(self):
+        tasks = self.session.query(self.Task).order_by(self.Task.id).all()
+        with BatchLoader():
+            with custom_query_counter() as q:
+                self.assertEqual(
+                    [task.owner.name for task in tasks], ['u0', 'u1', 'u2']
+                )
+                self.assertEqual(q, 1)
+
+                # a QuerySet can be given instead of a function
+                self.assertEqual(tasks[1].other_owner.name, 'u1')
+                self.assertEqual(tasks[2].other_owner.name, 'u2')
+                self.assertRaises(
+                    DoesNotExist, getattr, tasks[0], 'other_owner'
+                )
+                self.assertEqual(q, 2)
+
+    def test_without_loader(self):
+        tasks = self.session.query(self.Task).order_by(self.Task.id).all()
+        with custom_query_counter() as q:
+            self.assertEqual(tasks[1].owner.name, 'u1')
+            self.assertEqual(tasks[2].other_owner.name, 'u2')
+            self.assertEqual(q, 2)
@@ -0,0 +1,136 @@
+import base64
+import datetime
+import unittest
+
+from bson import BSON, ObjectId
+from mongoengine import DateTimeField, Document, StringField
+
+from flask_common.mongo.pagination import InvalidPageToken, keyset_paginate
+from flask_common.mongo.query_counters import custom_query_counter
+
+
+class KeysetPaginateTestCase(unittest.TestCase):
+    def setUp(self):
+        super(KeysetPaginateTestCase, self).setUp()
+
+        class Lead(Document):
+            name = StringField()
+            date_updated = DateTimeField(db_field='du')
+
+        Lead.drop_collection()
+
+        # several leads share the same date, so that the _id tie-breaker is
+        # needed to page through them
+        base = datetime.datetime(2020, 1, 1)
+        for i in range(10):
+            Lead.objects.create(
+                name=str(i), date_updated=base + datetime.timedelta(days=i // 3)
+            )
+
+        self.Lead = Lead
+
+    def get_all_pages(self, query_set, sort, limit):
+        names = []
+        token = None
+        while True:
+            page = keyset_paginate(query_set, sort, limit, token=token)
+            self.assertTrue(len(page.objs) <= limit)
+            names.extend(lead.name for lead in page.objs)
+            if page.next_token is None:
+                return names
+            token = page.next_token
+
+    def test_ascending(self):
+        names = self.get_all_pages(
+            self.Lead.objects.all(), ('date_updated',), limit=4
+        )
+        self.assertEqual(names, [str(i) for i in range(10)])
+
+    def test_descending(self):
+        names = self.get_all_pages(
+            self.Lead.objects.all(), ('-date_updated', 'id'), limit=3
+        )
+        expected = [
+            lead.name
+            for lead in self.Lead.objects.order_by('-date_updated', 'id')
+        ]
+        self.assertEqual(names, expected)
+        self.assertEqual(len(names), 10)
+
+    def test_filtered(self):
+        query_set = self.Lead.objects.filter(name__in=['1', '2', '5', '9'])
+        names = self.get_all_pages(query_set, ('-date_updated',), limit=1)
+        self.assertEqual(names, ['9', '5', '1', '2'])
+
+    def test_single_query_per_page(self):
+        page = keyset_paginate(self.Lead.objects.all(), ('date_updated',), 5)
+        with custom_query_counter() as q:
+            keyset_paginate(
+                self.Lead.objects.all(),
+                ('date_updated',),
+                5,
+                token=page.next_token,
+            )
+            self.assertEqual(q, 1)
+
+    def test_last_page(self):
+        page = keyset_paginate(self.Lead.objects.all(), ('date_updated',), 10)
+        self.assertEqual(len(page.objs), 10)
+        self.assertEqual(page.next_token, None)
+
+    def test_empty_page(self):
+        page = keyset_paginate(
+            self.Lead.objects.filter(name='none'), ('date_updated',), 2
+        )
+        self.assertEqual(page, ([], None))
+
+    def test_invalid_limit(self):
+        for limit in (0, -1):
+            self.assertRaises(
+                ValueError,
+                keyset_paginate,
+                self.Lead.objects.all(),
+                ('date_updated',),
+                limit,
+            )
+
+    def test_invalid_token(self):
+        query_set = self.Lead.objects.all()
+        page = keyset_paginate(query_set, ('date_updated',), 2)
+        self.assertRaises(
+            InvalidPageToken,
+            keyset_paginate,
+            query_set,
+            ('date_updated',),
+            2,
+            token='not a token',
+        )
+        # tokens can't be reused with another sort
+        self.assertRaises(
+            InvalidPageToken,
+            keyset_paginate,
+            query_set,
+            ('-date_updated',),
+            2,
+            token=page.next_token,
+        )
+
+    def test_forged_token(self):
+        # a token with an operator instead of a date, which would match
+        # every document
+        data = BSON.encode(
+            {'s': ['du:1', '_id:1'], 'v': [{'$ne': None}, ObjectId()]}
+        )
+        self.assertRaises(
+            InvalidPageToken,
+            keyset_paginate,
+            self.Lead.objects.all(),
+            ('date_updated',),
+            2,
+            token=base64.urlsafe_b64encode(data).decode('ascii'),
+        )
+
+    def test_invalid_field(self):
+        self.assertRaises(
+            ValueError, keyset_paginate, self.Lead.objects.all(), ('foo',), 2
+        )
@@ -1,18 +1,47 @@
+import threading
 import unittest
 import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 from mongoengine import (
     Document,
     DoesNotExist,
+    EmbeddedDocument,
+    EmbeddedDocumentField,
+    GenericReferenceField,
     IntField,
+    ListField,
+    MapField,
     ReferenceField,
     SafeReferenceField,
     SafeReferenceListField,
     StringField,
 )
 
+from flask_common.mongo.batching import AdaptiveBatchSize
+from flask_common.mongo.cache import (
+    BoundedCacheMap,
+    PartialCacheMap,
+    SingleFlight,
+    UnloadedFieldError,
+)
+from flask_common.mongo.lazy import LazySON
 from flask_common.mongo.query_counters import custom_query_counter
-from flask_common.mongo.utils import fetch_related, iter_no_cache
+from flask_common.mongo.querysets import (
+    ForbiddenQueriesQuerySet,
+    ForbiddenQueryException,
+    PrefetchRelatedQuerySet,
+)
+from flask_common.mongo.utils import (
+    FetchRelatedPlan,
+    FetchRelatedReport,
+    fetch_related,
+    fetch_reverse_related,
+    get_id_ranges,
+    iter_fetch_related,
+    iter_no_cache,
+    parallel_scan,
+)
 
 
 class IterNoCacheTestCase(unittest.TestCase):
@@ -55,6 +84,223 @@ class IterNoCacheTestCase(unittest.TestCase):
             set(range(1)),
         )
 
+    def test_adaptive(self):
+        class D(Document):
+            i = IntField()
+            s = StringField()
+
+        D.drop_collection()
+
+        for i in range(100):
+            D(i=i, s='x' * 1000).save()
+
+        batch_size = AdaptiveBatchSize(
+            initial_size=5, min_size=5, target_bytes=20000, target_time=10
+        )
+        with custom_query_counter() as q:
+            docs = list(
+                iter_no_cache(D.objects.order_by('i'), adaptive=batch_size)
+            )
+            self.assertEqual([d.i for d in docs], list(range(100)))
+            self.assertEqual(docs[0].s, 'x' * 1000)
+
+            # a batch of 5, then a batch of ~20 documents (20KB) at a time
+            self.assertEqual(batch_size.get_size(D), 19)
+            self.assertEqual(q, 7)
+
+        self.assertEqual(batch_size.stats[D]['documents'], 100)
+
+        # the QuerySet's filter, projection, skip and limit are respected
+        docs = list(
+            iter_no_cache(
+                D.objects.filter(i__gte=50).only('i').skip(10).limit(5),
+                adaptive=batch_size,
+            )
+        )
+        self.assertEqual(sorted(d.i for d in docs), list(range(60, 65)))
+        self.assertEqual(docs[0].s, None)
+
+    def test_read_ahead(self):
+        class D(Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i).save()
+
+        thread_count = threading.active_count()
+
+        self.assertEqual(
+            [
+                d.i
+                for d in iter_no_cache(
+                    D.objects.order_by('i').batch_size(3), read_ahead=2
+                )
+            ],
+            list(range(10)),
+        )
+
+        # with an adaptive batch size too
+        batch_size = AdaptiveBatchSize(initial_size=3)
+        self.assertEqual(
+            {
+                d.i
+                for d in iter_no_cache(
+                    D.objects.all(), adaptive=batch_size, read_ahead=1
+                )
+            },
+            set(range(10)),
+        )
+
+        # the background thread stops when the iteration is abandoned
+        iterator = iter_no_cache(D.objects.batch_size(2), read_ahead=1)
+        self.assertTrue(isinstance(next(iterator), D))
+        iterator.close()
+        self.assertEqual(threading.active_count(), thread_count)
+
+    def test_lazy(self):
+        class D(Document):
+            i = IntField()
+            s = StringField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i, s=str(i)).save()
+
+        docs = list(
+            iter_no_cache(D.objects.order_by('i').batch_size(3), lazy=True)
+        )
+        self.assertEqual([d.i for d in docs], list(range(10)))
+        self.assertTrue(isinstance(docs[0]._db_data, LazySON))
+        self.assertFalse('s' in docs[0]._db_data._values)
+        self.assertEqual(docs[0].s, '0')
+
+    def test_raw_query_set_options(self):
+        class D(Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(10):
+            D(i=i).save()
+
+        # the cursor options (e.g. the hint) of the QuerySet are used
+        qs = D.objects.order_by('i').hint([('_id', 1)])
+        with custom_query_counter() as q:
+            docs = list(iter_no_cache(qs, lazy=True))
+            self.assertEqual([d.i for d in docs], list(range(10)))
+            self.assertEqual(
+                q.db.system.profile.find_one({'op': 'query'})['query']['hint'],
+                {'_id': 1},
+            )
+
+        class ForbiddenQuerySet(ForbiddenQueriesQuerySet):
+            forbidden_queries = [{'query_shape': {'i': 1}}]
+
+        class E(Document):
+            i = IntField()
+            meta = {'queryset_class': ForbiddenQuerySet}
+
+        qs = E.objects.filter(i=1)
+        self.assertRaises(
+            ForbiddenQueryException, list, iter_no_cache(qs, lazy=True)
+        )
+        self.assertRaises(
+            ForbiddenQueryException,
+            list,
+            iter_no_cache(qs, adaptive=AdaptiveBatchSize()),
+        )
+        self.assertEqual(list(iter_no_cache(qs.mark_as_safe(), lazy=True)), [])
+
+
+class ParallelScanTestCase(unittest.TestCase):
+    def setUp(self):
+        super(ParallelScanTestCase, self).setUp()
+
+        class D(Document):
+            i = IntField()
+
+        D.drop_collection()
+
+        for i in range(100):
+            D(i=i).save()
+
+        self.D = D
+        self.pks = [d.pk for d in D.objects.order_by('id')]
+
+    def test_get_id_ranges(self):
+        ranges = get_id_ranges(self.D.objects.all(), 4)
+        self.assertEqual(len(ranges), 4)
+        self.assertEqual(ranges[0][0], None)
+        self.assertEqual(ranges[-1][1], None)
+        for (_, max_id), (min_id, _) in zip(ranges, ranges[1:]):
+            self.assertEqual(max_id, min_id)
+
+        self.assertEqual(get_id_ranges(self.D.objects.all(), 1), [(None, None)])
+        self.assertEqual(
+            get_id_ranges(self.D.objects.filter(i=-1), 4), [(None, None)]
+        )
+
+    def test_parallel_scan(self):
+        pks = []
+        saved = []
+
+        def on_checkpoint(checkpoints):
+            saved.append([dict(checkpoint) for checkpoint in checkpoints])
+
+        checkpoints = parallel_scan(
+            self.D.objects.filter(i__gte=10).batch_size(7),
+            lambda batch: pks.extend(d.pk for d in batch),
+            partitions=4,
+            on_checkpoint=on_checkpoint,
+        )
+        self.assertEqual(sorted(pks), self.pks[10:])
+        self.assertTrue(all(checkpoint['done'] for checkpoint in checkpoints))
+        self.assertEqual(saved[-1], checkpoints)
+
+    def test_resume(self):
+        checkpoints = [
+            {
+                'min_id': None,
+                'max_id': self.pks[50],
+                'last_id': None,
+                'done': False,
+            },
+            # finished ranges are skipped
+            {
+                'min_id': self.pks[50],
+                'max_id': None,
+                'last_id': self.pks[-1],
+                'done': True,
+            },
+        ]
+        batches = []
+
+        def interrupted(batch):
+            batches.append(batch)
+            if len(batches) == 2:
+                raise RuntimeError('interrupted')
+
+        with self.assertRaises(RuntimeError):
+            parallel_scan(
+                self.D.objects.batch_size(10),
+                interrupted,
+                checkpoints=checkpoints,
+            )
+        self.assertEqual(checkpoints[0]['last_id'], self.pks[9])
+        self.assertFalse(checkpoints[0]['done'])
+
+        pks = []
+        parallel_scan(
+            self.D.objects.batch_size(10),
+            lambda batch: pks.extend(d.pk for d in batch),
+            checkpoints=checkpoints,
+        )
+        self.assertEqual(sorted(pks), self.pks[10:50])
+        self.assertTrue(checkpoints[0]['done'])
+
 
 class FetchRelatedTestCase(unittest.TestCase):
     def setUp(self):
@@ -165,6 +411,25 @@ class FetchRelatedTestCase(unittest.TestCase):
             # one query for D, one query for C, one query for A
             self.assertEqual(q, 3)
 
+    def test_fetch_related_subdict_merged_levels(self):
+        """
+        Make sure related objects of the same document class on the same
+        depth are fetched in one query, even if they come from different
+        sub-dicts.
+        """
+        objs = list(self.D.objects.all()) + list(self.E.objects.all())
+
+        with custom_query_counter() as q:
+            fetch_related(
+                objs, {'ref_c': {'ref_a': True}, 'ref_b': {'ref': True}}
+            )
+
+            self.assertEqual(objs[0].ref_c.ref_a.txt, 'a3')
+            self.assertEqual(objs[1].ref_b.ref.txt, 'a1')
+
+            # one query for C, one for B, one for A
+            self.assertEqual(q, 3)
+
     def test_fetch_related_subdict_broken_reference(self):
         """
         Make sure that fetching sub-references of a broken reference works.
@@ -194,14 +459,37 @@ class FetchRelatedTestCase(unittest.TestCase):
 
     def test_partial_fetch_fields_conflict(self):
         """
-        Fetching certain fields via fetch_related has a limitation that
-        different fields cannot be fetched for the same document class.
-        Make sure that contraint is respected.
+        Make sure that if different fields are requested for the same
+        document class, the whole objects are fetched in one query if any of
+        the fields requests them.
         """
         objs = list(self.B.objects.all()) + list(self.C.objects.all())
-        self.assertRaises(
-            RuntimeError, fetch_related, objs, {'ref': ["id"], 'ref_a': True}
+        with custom_query_counter() as q:
+            fetch_related(objs, {'ref': ["id"], 'ref_a': True})
+            self.assertEqual(q, 1)
+
+        self.assertEqual(
+            {obj.ref.txt for obj in objs if isinstance(obj, self.B)},
+            {'a1', 'a2'},
         )
+        self.assertEqual(objs[2].ref_a.txt, 'a3')
+
+    def test_partial_fetch_fields_union(self):
+        """
+        Make sure that if different fields are requested for the same
+        document class, a union of the fields is fetched in one query.
+        """
+        objs = list(self.B.objects.all()) + list(self.C.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(objs, {'ref': ["id"], 'ref_a': ["id", "txt"]})
+            self.assertEqual(q, 1)
+
+            query = q.db.system.profile.find_one({'op': 'query'})
+            self.assertEqual(set(query['query']['projection']), {'_id', 'txt'})
+
+        self.assertEqual(objs[0].ref.pk, self.a1.pk)
+        self.assertEqual(objs[2].ref_a.txt, 'a3')
+        self.assertEqual(objs[2].ref_a.shard_a, None)
 
     def test_partial_fetch_cache_map(self):
         """
@@ -312,6 +600,31 @@ class FetchRelatedTestCase(unittest.TestCase):
         assert filters['a']['shard_a'] == self.shard.pk
         assert filters['b']['shard_b'] == self.shard.pk
 
+    def test_extra_filters_first_depth(self):
+        """
+        Ensure extra filters and filter functions only apply to the related
+        objects of the given objs, not to the deeper levels.
+        """
+        objs = list(self.D.objects.all())
+
+        with custom_query_counter() as q:
+            fetch_related(
+                objs,
+                {'ref_c': {'ref_a': True}},
+                extra_filters={
+                    self.C: {'shard_c': self.shard},
+                    self.A: {'txt': 'other'},
+                },
+                filter_funcs={self.A: lambda **kwargs: self.fail()},
+            )
+            self.assertEqual(q, 2)
+
+        self.assertEqual(objs[0].ref_c.ref_a.txt, 'a3')
+        ops = list(q.db.system.profile.find({'op': 'query'}))
+        filters = {op['query']['find']: op['query']['filter'] for op in ops}
+        self.assertEqual(filters['c']['shard_c'], self.shard.pk)
+        self.assertEqual(set(filters['a']), {'_id'})
+
     def test_batch_size_1(self):
         """
         Ensure we batch requests properly, if a batch size is given.
@@ -343,3 +656,736 @@ class FetchRelatedTestCase(unittest.TestCase):
 
             # All 3 objects are fetched in one query.
             self.assertEqual(q, 1)
+
+    def test_dotted_paths(self):
+        """
+        Make sure references in embedded documents and MapFields are fetched
+        together with other references to the same document class.
+        """
+
+        class Contact(EmbeddedDocument):
+            owner = ReferenceField(self.A)
+
+        class G(Document):
+            primary = EmbeddedDocumentField(Contact)
+            contacts = ListField(EmbeddedDocumentField(Contact))
+            contacts_by_role = MapField(EmbeddedDocumentField(Contact))
+            owners = MapField(ReferenceField(self.A))
+            ref_b = ReferenceField(self.B)
+
+        G.drop_collection()
+        G.objects.create(
+            primary=Contact(owner=self.a1),
+            contacts=[Contact(owner=self.a2), Contact(owner=self.a3)],
+            contacts_by_role={'admin': Contact(owner=self.a1)},
+            owners={'first': self.a2},
+            ref_b=self.b1,
+        )
+
+        objs = list(G.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(
+                objs,
+                {
+                    'primary.owner': True,
+                    'contacts.owner': True,
+                    'contacts_by_role.owner': True,
+                    'owners': True,
+                    'ref_b': {'ref': True},
+                },
+            )
+
+            obj = objs[0]
+            self.assertEqual(obj.primary.owner.txt, 'a1')
+            self.assertEqual(
+                [contact.owner.txt for contact in obj.contacts], ['a2', 'a3']
+            )
+            self.assertEqual(obj.contacts_by_role['admin'].owner.txt, 'a1')
+            self.assertEqual(obj.owners['first'].txt, 'a2')
+            self.assertEqual(obj.ref_b.ref.txt, 'a1')
+
+            # one query for A, one for B (b1.ref is already fetched)
+            self.assertEqual(q, 2)
+
+    def test_partial_cache_map(self):
+        """
+        Make sure partially fetched objects are reused across calls for
+        subsets of their fields, and raise on access to unloaded fields.
+        """
+        partial_cache_map = PartialCacheMap()
+
+        objs = list(self.B.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(
+                objs,
+                {'ref': ['id', 'txt']},
+                partial_cache_map=partial_cache_map,
+            )
+            self.assertEqual(q, 1)
+
+        self.assertEqual(objs[0].ref.txt, 'a1')
+        self.assertTrue(isinstance(objs[0].ref, self.A))
+        self.assertRaises(UnloadedFieldError, getattr, objs[0].ref, 'shard_a')
+
+        objs2 = list(self.B.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(
+                objs2, {'ref': ['txt']}, partial_cache_map=partial_cache_map
+            )
+            self.assertEqual(q, 0)
+            self.assertTrue(objs2[0].ref is objs[0].ref)
+
+            # other fields are fetched
+            objs3 = list(self.B.objects.all())
+            fetch_related(
+                objs3,
+                {'ref': ['shard_a']},
+                partial_cache_map=partial_cache_map,
+            )
+            self.assertEqual(q, 2)
+            self.assertEqual(objs3[0].ref.shard_a.pk, self.shard.pk)
+
+    def test_shard_keys(self):
+        """
+        Make sure related objects are fetched with one query per shard key
+        value when a shard key is given.
+        """
+        shard2 = self.Shard.objects.create()
+        a4 = self.A.objects.create(shard_a=shard2, txt='a4')
+        self.B.objects.create(shard_b=shard2, ref=a4)
+        shard_keys = {self.A: ('shard_a', lambda b: b.shard_b)}
+
+        objs = list(self.B.objects.all())
+        report = fetch_related(
+            objs, {'ref': True}, shard_keys=shard_keys, dry_run=True
+        )
+        self.assertEqual(
+            sorted(
+                (query['filter']['shard_a'], len(query['filter']['_id']['$in']))
+                for query in report.planned_queries
+            ),
+            sorted([(self.shard.pk, 2), (shard2.pk, 1)]),
+        )
+
+        for raw in (False, True):
+            objs = list(self.B.objects.all())
+            with custom_query_counter() as q:
+                fetch_related(
+                    objs, {'ref': True}, shard_keys=shard_keys, raw=raw
+                )
+                self.assertEqual(
+                    sorted(obj.ref.txt for obj in objs), ['a1', 'a2', 'a4']
+                )
+                self.assertEqual(q, 2)
+
+    def test_plan(self):
+        """
+        Make sure a compiled plan can be executed many times and that it
+        only resolves the field_dict once per document class.
+        """
+        plan = FetchRelatedPlan(
+            {'ref_c': {'ref_a': True}, 'ref_b': {'ref': ['id']}},
+            self.D,
+            self.E,
+        )
+
+        for _ in range(2):
+            objs = list(self.D.objects.all()) + list(self.E.objects.all())
+            with custom_query_counter() as q:
+                plan.execute(objs)
+
+                self.assertEqual(objs[0].ref_c.ref_a.txt, 'a3')
+                self.assertEqual(objs[1].ref_b.ref.pk, self.a1.pk)
+
+                # one query for C, B, and A on the second level
+                self.assertEqual(q, 3)
+
+        # plans can be used with anything that takes a field_dict
+        objs = list(self.D.objects.all())
+        fetch_related(objs, plan, cache_map={})
+        self.assertEqual(objs[0].ref_c.ref_a.txt, 'a3')
+
+        # unsupported fields raise at compile time
+        self.assertRaises(
+            NotImplementedError, FetchRelatedPlan, {'txt': True}, self.A
+        )
+
+    def test_generic_references(self):
+        """
+        Make sure generic references are fetched with one query per document
+        class.
+        """
+
+        class H(Document):
+            target = GenericReferenceField()
+            targets = ListField(GenericReferenceField())
+
+        H.drop_collection()
+        H.objects.create(target=self.b1, targets=[self.a1, self.c1])
+        H.objects.create(target=self.a2, targets=[self.b2])
+
+        objs = list(H.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(objs, {'target': True, 'targets': {'ref_a': True}})
+
+            self.assertEqual(objs[0].target.ref.pk, self.a1.pk)
+            self.assertEqual(objs[1].target.txt, 'a2')
+            self.assertEqual(
+                [type(target) for target in objs[0].targets], [self.A, self.C]
+            )
+            self.assertEqual(objs[0].targets[1].ref_a.txt, 'a3')
+            self.assertEqual(objs[1].targets[0].pk, self.b2.pk)
+
+            # one query for A, one for B and one for C, then one for A
+            # referenced by C
+            self.assertEqual(q, 4)
+
+    def test_generic_references_mixed_fields(self):
+        """
+        Make sure the same field name is resolved with the class of each
+        generic target, even if it references another document class.
+        """
+
+        class G(Document):
+            ref_a = ReferenceField(self.B)
+
+        class H(Document):
+            target = GenericReferenceField()
+
+        G.drop_collection()
+        H.drop_collection()
+        g1 = G.objects.create(ref_a=self.b1)
+        H.objects.create(target=self.c1)
+        H.objects.create(target=g1)
+
+        objs = list(H.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(objs, {'target': {'ref_a': True}})
+
+            self.assertEqual(objs[0].target.ref_a.txt, 'a3')
+            self.assertTrue(isinstance(objs[1].target.ref_a, self.B))
+            self.assertEqual(objs[1].target.ref_a.ref.pk, self.a1.pk)
+
+            # one query for C and one for G, then one for A referenced by C
+            # and one for B referenced by G
+            self.assertEqual(q, 4)
+
+    def test_single_flight(self):
+        claimed = threading.Event()
+
+        class NotifyingSingleFlight(SingleFlight):
+            def claim(self, document_class, pks):
+                result = super(NotifyingSingleFlight, self).claim(
+                    document_class, pks
+                )
+                claimed.set()
+                return result
+
+        single_flight = NotifyingSingleFlight()
+
+        # another thread is fetching a1 already, and finishes once
+        # fetch_related is waiting for it
+        single_flight.claim(self.A, [self.a1.pk])
+        claimed.clear()
+
+        def resolve():
+            claimed.wait(5)
+            single_flight.resolve(self.A, [self.a1.pk], {self.a1.pk: self.a1})
+
+        thread = threading.Thread(target=resolve)
+
+        objs = list(self.E.objects.all())
+        report = FetchRelatedReport()
+        with custom_query_counter() as q:
+            thread.start()
+            fetch_related(
+                objs,
+                {'refs_a': True},
+                single_flight=single_flight,
+                report=report,
+            )
+            thread.join()
+            self.assertEqual(
+                [a.txt for a in objs[0].refs_a], ['a1', 'a2', 'a3']
+            )
+            self.assertTrue(objs[0].refs_a[0] is self.a1)
+            self.assertEqual(q, 1)
+
+        self.assertEqual(report.stats[(0, self.A)]['inflight_ids'], 1)
+        self.assertEqual(report.stats[(0, self.A)]['documents'], 2)
+        self.assertEqual(single_flight._flights[self.A], {})
+
+    def test_single_flight_cached_after_planning(self):
+        cache_map = {}
+        a1 = self.a1
+
+        class CachingSingleFlight(SingleFlight):
+            def claim(self, document_class, pks):
+                # another thread fetched and cached a1 after fetch_related
+                # planned the level, but before it claimed the IDs
+                cache_map.setdefault(document_class, {})[a1.pk] = a1
+                return super(CachingSingleFlight, self).claim(
+                    document_class, pks
+                )
+
+        single_flight = CachingSingleFlight()
+        objs = list(self.B.objects.all())
+        report = FetchRelatedReport()
+        with custom_query_counter() as q:
+            fetch_related(
+                objs,
+                {'ref': True},
+                cache_map=cache_map,
+                single_flight=single_flight,
+                report=report,
+            )
+            self.assertTrue(objs[0].ref is self.a1)
+            self.assertEqual(objs[1].ref.txt, 'a2')
+            self.assertEqual(q, 1)
+
+            # only a2 is fetched
+            query = q.db.system.profile.find_one({'op': 'query'})
+            self.assertEqual(
+                query['query']['filter']['_id']['$in'], [self.a2.pk]
+            )
+
+        self.assertEqual(report.stats[(0, self.A)]['cached_ids'], 1)
+        self.assertEqual(single_flight._flights[self.A], {})
+
+    def test_lazy(self):
+        objs = list(self.B.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(objs, {'ref': True}, lazy=True)
+            self.assertEqual({obj.ref.txt for obj in objs}, {'a1', 'a2'})
+            self.assertTrue(isinstance(objs[0].ref._db_data, LazySON))
+            self.assertEqual(objs[0].ref.shard_a.pk, self.shard.pk)
+            self.assertEqual(q, 2)
+
+    def test_adaptive_batch_size(self):
+        objs = list(self.E.objects.all())
+        batch_size = AdaptiveBatchSize(initial_size=1, min_size=1)
+
+        with custom_query_counter() as q:
+            fetch_related(objs, {'refs_a': True}, batch_size=batch_size)
+            self.assertEqual(
+                [a.txt for a in objs[0].refs_a], ['a1', 'a2', 'a3']
+            )
+            self.assertEqual(q, 3)
+
+        self.assertEqual(batch_size.stats[self.A]['documents'], 3)
+        self.assertTrue(batch_size.get_size(self.A) > 1)
+
+    def test_raw(self):
+        """
+        Make sure raw queries fetch the same documents with the same filters
+        and projection as the QuerySet-based ones.
+        """
+        objs = list(self.E.objects.all())
+
+        with custom_query_counter() as q:
+            fetch_related(
+                objs,
+                {'refs_a': ['txt'], 'ref_b': {'ref': True}},
+                extra_filters={self.A: {'shard_a': self.shard}},
+                raw=True,
+            )
+
+            self.assertEqual(
+                [a.txt for a in objs[0].refs_a], ['a1', 'a2', 'a3']
+            )
+            self.assertEqual(objs[0].refs_a[0].shard_a, None)
+            self.assertTrue(isinstance(objs[0].ref_b, self.B))
+            self.assertEqual(objs[0].ref_b.ref.txt, 'a1')
+
+            # one query for A and B, then one for A referenced by B
+            self.assertEqual(q, 3)
+            ops = [
+                op['query']
+                for op in q.db.system.profile.find({'op': 'query'})
+                if op['query']['find'] == 'a'
+            ]
+            self.assertEqual(
+                [op.get('projection') for op in ops], [{'txt': 1}, None]
+            )
+            # the extra_filters don't apply to the A referenced by B
+            self.assertEqual(
+                [op['filter'].get('shard_a') for op in ops],
+                [self.shard.pk, None],
+            )
+
+    def test_as_dicts(self):
+        """
+        Make sure related objects can be attached as plain dicts, which
+        aren't cached.
+        """
+        cache_map = {}
+        objs = list(self.E.objects.all())
+        fetch_related(
+            objs,
+            {'refs_a': ['txt'], 'ref_b': True},
+            cache_map=cache_map,
+            as_dicts=True,
+        )
+
+        self.assertEqual(
+            objs[0].refs_a,
+            [
+                {'_id': self.a1.pk, 'txt': 'a1'},
+                {'_id': self.a2.pk, 'txt': 'a2'},
+                {'_id': self.a3.pk, 'txt': 'a3'},
+            ],
+        )
+        self.assertEqual(objs[0].ref_b['_id'], self.b1.pk)
+        self.assertEqual(objs[0].ref_b['ref'], self.a1.pk)
+        self.assertEqual(cache_map, {})
+
+        self.assertRaises(
+            ValueError,
+            fetch_related,
+            objs,
+            {'ref_b': {'ref': True}},
+            as_dicts=True,
+        )
+
+    def test_report(self):
+        """
+        Make sure the report describes the queries fetch_related issued.
+        """
+        self.c1.delete()
+        cache_map = {self.A: {self.a3.pk: self.a3}}
+        objs = list(self.D.objects.all()) + list(self.E.objects.all())
+        report = FetchRelatedReport()
+
+        with custom_query_counter() as q:
+            returned = fetch_related(
+                objs,
+                {'ref_c': True, 'refs_a': True, 'ref_b': {'ref': True}},
+                cache_map=cache_map,
+                batch_size=1,
+                report=report,
+            )
+            self.assertEqual(report.queries, q)
+
+        self.assertTrue(returned is report)
+        self.assertEqual(
+            [
+                (depth, document_class, stats['requested_ids'])
+                for (depth, document_class), stats in report.stats.items()
+            ],
+            [(0, self.C, 1), (0, self.A, 3), (0, self.B, 1), (1, self.A, 1)],
+        )
+        self.assertEqual(report.stats[(0, self.A)]['cached_ids'], 1)
+        self.assertEqual(report.stats[(0, self.A)]['queries'], 2)
+        self.assertEqual(report.stats[(0, self.C)]['missing_ids'], 1)
+        self.assertEqual(report.stats[(1, self.A)]['cached_ids'], 1)
+        self.assertEqual(report.stats[(1, self.A)]['queries'], 0)
+        self.assertTrue(report.wall_time > 0)
+
+    def test_report_hook_and_dry_run(self):
+        """
+        Make sure the report can be passed to a hook and that a dry run
+        doesn't issue any queries.
+        """
+        reports = []
+        objs = list(self.B.objects.all())
+        fetch_related(objs, {'ref': True}, report=reports.append)
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0].queries, 1)
+
+        objs = list(self.B.objects.all())
+        with custom_query_counter() as q:
+            report = fetch_related(objs, {'ref': ['txt']}, dry_run=True)
+            self.assertEqual(q, 0)
+
+        self.assertEqual(report.queries, 0)
+        self.assertEqual(
+            [
+                (planned['collection'], planned['projection'])
+                for planned in report.planned_queries
+            ],
+            [('a', {'txt': 1})],
+        )
+        self.assertEqual(
+            set(report.planned_queries[0]['filter']['_id']['$in']),
+            {self.a1.pk, self.a2.pk},
+        )
+
+    def test_executor(self):
+        """
+        Ensure batches are fetched correctly when they're issued concurrently,
+        both with a caller-supplied executor and with a number of workers.
+        """
+        objs = list(self.D.objects.all())
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            with custom_query_counter() as q:
+                fetch_related(
+                    objs,
+                    {'ref_a': True, 'ref_c': {'ref_a': True}},
+                    executor=executor,
+                )
+                self.assertEqual(objs[0].ref_a.txt, 'a3')
+                self.assertEqual(objs[0].ref_c.ref_a.txt, 'a3')
+
+                # one query for C, one query for A
+                self.assertEqual(q, 2)
+
+        objs = list(self.B.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(objs, {'ref': True}, batch_size=1, executor=2)
+            self.assertEqual({obj.ref.txt for obj in objs}, {'a1', 'a2'})
+
+            # one query per batch
+            self.assertEqual(q, 2)
+
+    def test_bounded_cache_map(self):
+        """
+        Make sure fetch_related works with a bounded cache map, even if the
+        cache map is smaller than the number of fetched objects.
+        """
+        cache_map = BoundedCacheMap(max_entries=1)
+        objs = list(self.E.objects.all())
+
+        with custom_query_counter() as q:
+            fetch_related(objs, {'refs_a': True}, cache_map=cache_map)
+            self.assertEqual(
+                [a.txt for a in objs[0].refs_a], ['a1', 'a2', 'a3']
+            )
+            self.assertEqual(len(cache_map[self.A]), 1)
+            self.assertEqual(cache_map[self.A].evictions, 2)
+            self.assertEqual(q, 1)
+
+        # the one cached object isn't fetched again
+        cached_pk = list(cache_map[self.A])[0]
+        objs = list(self.E.objects.all())
+        with custom_query_counter() as q:
+            fetch_related(objs, {'refs_a': True}, cache_map=cache_map)
+            self.assertEqual(q, 1)
+            self.assertNotIn(
+                cached_pk,
+                q.db.system.profile.find_one({'op': 'query'})['query'][
+                    'filter'
+                ]['_id']['$in'],
+            )
+        self.assertEqual(cache_map[self.A].hits, 1)
+
+
+class FetchReverseRelatedTestCase(unittest.TestCase):
+    def setUp(self):
+        super(FetchReverseRelatedTestCase, self).setUp()
+
+        class Lead(Document):
+            name = StringField()
+
+        class Contact(Document):
+            lead = ReferenceField(Lead)
+            name = StringField()
+
+        class Task(Document):
+            leads = ListField(ReferenceField(Lead))
+
+        Lead.drop_collection()
+        Contact.drop_collection()
+        Task.drop_collection()
+
+        self.lead1 = Lead.objects.create(name='l1')
+        self.lead2 = Lead.objects.create(name='l2')
+        self.lead3 = Lead.objects.create(name='l3')
+        self.contact1 = Contact.objects.create(lead=self.lead1, name='c1')
+        self.contact2 = Contact.objects.create(lead=self.lead1, name='c2')
+        self.contact3 = Contact.objects.create(lead=self.lead2, name='c3')
+        self.task = Task.objects.create(leads=[self.lead1, self.lead3])
+
+        self.Lead = Lead
+        self.Contact = Contact
+        self.Task = Task
+
+    def test_fetch_reverse_related(self):
+        cache_map = {}
+        leads = list(self.Lead.objects.order_by('name'))
+
+        with custom_query_counter() as q:
+            fetch_reverse_related(
+                leads,
+                self.Contact,
+                'lead',
+                'contacts',
+                cache_map=cache_map,
+                batch_size=2,
+                order_by=('name',),
+            )
+
+            self.assertEqual(
+                [[contact.name for contact in lead.contacts] for lead in leads],
+                [['c1', 'c2'], ['c3'], []],
+            )
+            self.assertTrue(leads[0].contacts[0].lead is leads[0])
+            self.assertEqual(leads[0].contacts[0]._changed_fields, [])
+
+            # one query per batch of leads
+            self.assertEqual(q, 2)
+
+        self.assertEqual(
+            set(cache_map[self.Contact]),
+            {self.contact1.pk, self.contact2.pk, self.contact3.pk},
+        )
+
+    def test_list_field(self):
+        leads = list(self.Lead.objects.order_by('name'))
+        fetch_reverse_related(
+            leads,
+            self.Task,
+            'leads',
+            'tasks',
+            extra_filters={self.Task: {'pk': self.task.pk}},
+            fields_to_fetch=['id'],
+        )
+        self.assertEqual(
+            [[task.pk for task in lead.tasks] for lead in leads],
+            [[self.task.pk], [], [self.task.pk]],
+        )
+
+
+class IterFetchRelatedTestCase(unittest.TestCase):
+    def setUp(self):
+        super(IterFetchRelatedTestCase, self).setUp()
+
+        class A(Document):
+            txt = StringField()
+
+        class B(Document):
+            i = IntField()
+            ref = ReferenceField(A)
+            meta = {'queryset_class': PrefetchRelatedQuerySet}
+
+        A.drop_collection()
+        B.drop_collection()
+
+        for i in range(5):
+            B.objects.create(i=i, ref=A.objects.create(txt='a%d' % i))
+
+        self.A = A
+        self.B = B
+
+    def get_a_queries(self, q):
+        return [
+            op
+            for op in q.db.system.profile.find({'op': 'query'})
+            if op['ns'].split('.')[1] == 'a'
+        ]
+
+    def get_b_ops(self, q):
+        return list(q.db.system.profile.find({'ns': q.db.name + '.b'}))
+
+    def test_iter_fetch_related(self):
+        qs = self.B.objects.order_by('i').batch_size(2)
+        with custom_query_counter() as q:
+            self.assertEqual(
+                [b.ref.txt for b in iter_fetch_related(qs, {'ref': True})],
+                ['a0', 'a1', 'a2', 'a3', 'a4'],
+            )
+
+            # one query for A per batch of B
+            self.assertEqual(
+                [
+                    len(op['query']['filter']['_id']['$in'])
+                    for op in self.get_a_queries(q)
+                ],
+                [2, 2, 1],
+            )
+
+    def test_prefetch_related(self):
+        qs = (
+            self.B.objects.order_by('i')
+            .batch_size(3)
+            .prefetch_related({'ref': ['id']})
+        )
+        a_pks = [a.pk for a in self.A.objects.order_by('txt')[:4]]
+        with custom_query_counter() as q:
+            objs = list(qs.filter(i__lt=4))
+            self.assertEqual([b.ref.pk for b in objs], a_pks)
+            self.assertEqual(len(self.get_a_queries(q)), 2)
+
+            # the Bs are streamed with one find (plus a getmore for the
+            # second batch), without a count or a fully cached result first
+            self.assertEqual(
+                [op['op'] for op in self.get_b_ops(q)], ['query', 'getmore']
+            )
+
+            # the fetched fields are limited as requested
+            self.assertEqual({b.ref.txt for b in objs}, {None})
+
+        self.assertRaises(TypeError, len, qs)
+
+    def test_lookup(self):
+        qs = self.B.objects.filter(i__gte=1).order_by('-i').limit(3)
+        cache_map = {}
+        with custom_query_counter() as q:
+            objs = list(
+                iter_fetch_related(
+                    qs, {'ref': True}, lookup=True, cache_map=cache_map
+                )
+            )
+            self.assertEqual([b.ref.txt for b in objs], ['a4', 'a3', 'a2'])
+
+            # the related objects are joined in the aggregation
+            self.assertEqual(self.get_a_queries(q), [])
+
+        self.assertEqual(set(cache_map[self.A]), {b.ref.pk for b in objs})
+        self.assertEqual(objs[0]._changed_fields, [])
+
+        # partial fetches through prefetch_related
+        qs = self.B.objects.order_by('i').prefetch_related(
+            {'ref': ['id']}, lookup=True
+        )
+        objs = list(qs)
+        self.assertEqual(
+            [b.ref.pk for b in objs],
+            [a.pk for a in self.A.objects.order_by('txt')],
+        )
+        self.assertEqual({b.ref.txt for b in objs}, {None})
+
+        # the fields to fetch are picked from the joined documents
+        objs = list(
+            iter_fetch_related(
+                self.B.objects.order_by('i'), {'ref': ['id']}, lookup=True
+            )
+        )
+        self.assertEqual(
+            [b.ref._db_data for b in objs],
+            [{'_id': a.pk} for a in self.A.objects.order_by('txt')],
+        )
+
+        # only one level can be joined
+        self.assertRaises(
+            ValueError,
+            iter_fetch_related,
+            self.B.objects.all(),
+            {'ref': {'ref': True}},
+            lookup=True,
+        )
+
+    def test_lookup_list_field(self):
+        class C(Document):
+            refs = ListField(ReferenceField(self.A))
+
+        C.drop_collection()
+        a_objs = list(self.A.objects.order_by('txt'))
+        C.objects.create(refs=a_objs[:2])
+
+        version = tuple(C._get_db().client.server_info()['versionArray'][:2])
+        if version < (3, 4):
+            # $lookup doesn't match the elements of arrays before 3.4
+            self.assertRaises(
+                NotImplementedError,
+                iter_fetch_related,
+                C.objects.all(),
+                {'refs': True},
+                lookup=True,
+            )
+            return
+
+        objs = list(
+            iter_fetch_related(C.objects.all(), {'refs': True}, lookup=True)
+        )
+        self.assertEqual([a.txt for a in objs[0].refs], ['a0', 'a1'])